@@ -14,22 +14,39 @@ Desarrollado por Claude para BloomsPal - Febrero 2026
 """
 
 import os
+import io
+import re
+import sys
 import json
+import tempfile
+import hashlib
+import bisect
+import unicodedata
+import importlib.util
 import base64
 import asyncio
 import logging
 import httpx
 import sqlite3
+import time
+from collections import deque, OrderedDict
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable, Awaitable, BinaryIO, Union
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request, HTTPException, Query, File, UploadFile, Form
-from fastapi.responses import PlainTextResponse, JSONResponse
+from fastapi.responses import PlainTextResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import anthropic
 import xmlrpc.client
 import uuid
+import random
+from email.utils import parsedate_to_datetime
+
+try:
+    import resource
+except ImportError:  # No disponible en Windows
+    resource = None
 
 # ══════════════════════════════════════════════════════════════════════════════
 # LOGGING CONFIGURATION
@@ -51,6 +68,7 @@ WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID", "275484188971164")
 WHATSAPP_VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "sonia_bloomspal_2026")
 WHATSAPP_API_URL = "https://graph.facebook.com/v18.0"
+WHATSAPP_MAX_TEXT_LENGTH = 4096  # Límite de caracteres por mensaje de texto
 
 # Claude API (Anthropic)
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
@@ -62,12 +80,29 @@ FEDEX_TRACK_API_KEY = os.getenv("FEDEX_TRACK_API_KEY", FEDEX_API_KEY)
 FEDEX_TRACK_SECRET_KEY = os.getenv("FEDEX_TRACK_SECRET_KEY", FEDEX_SECRET_KEY)
 FEDEX_ACCOUNT_USA = os.getenv("FEDEX_ACCOUNT_USA", "202958384")  # Andean-2 (legacy var, misma cuenta)
 FEDEX_ACCOUNT_WORLD = os.getenv("FEDEX_ACCOUNT_WORLD", "202958384")  # Andean-2
+# Cuentas a cotizar en paralelo (tarifas negociadas distintas); se ignoran repetidas
+FEDEX_ACCOUNTS = list(dict.fromkeys(
+    account.strip()
+    for account in [FEDEX_ACCOUNT_WORLD, FEDEX_ACCOUNT_USA] + os.getenv("FEDEX_EXTRA_ACCOUNTS", "").split(",")
+    if account.strip()
+))
+FEDEX_ACCOUNT_TIMEOUT = float(os.getenv("FEDEX_ACCOUNT_TIMEOUT", "15"))  # Segundos por cuenta
 FEDEX_BASE_URL = "https://apis.fedex.com"
+FEDEX_TOKEN_REFRESH_MARGIN = float(os.getenv("FEDEX_TOKEN_REFRESH_MARGIN", "300"))  # Segundos antes de expirar
+FEDEX_TOKEN_DEFAULT_TTL = float(os.getenv("FEDEX_TOKEN_DEFAULT_TTL", "3600"))  # Si OAuth no envía expires_in
+FEDEX_RATE_CACHE_TTL = float(os.getenv("FEDEX_RATE_CACHE_TTL", "21600"))  # Segundos; la fecha de envío va en la clave
+FEDEX_RATE_CACHE_SIZE = int(os.getenv("FEDEX_RATE_CACHE_SIZE", "2000"))  # Entradas en memoria (0 = sin caché)
+FEDEX_MAX_IN_FLIGHT = int(os.getenv("FEDEX_MAX_IN_FLIGHT", "4"))  # Peticiones simultáneas a apis.fedex.com
+QUOTE_MAX_SCENARIOS = int(os.getenv("QUOTE_MAX_SCENARIOS", "4"))  # Alternativas por turno además de la base
 
 # Precios fijos para envíos USA <70kg
 PRECIO_POR_KG_USA = 5.0  # USD por kg
 PRECIO_POR_DIRECCION = 8.0  # USD por dirección
 
+# Tarifarios locales (precio fijo por ruta); sin archivo se usa la regla CO→US de arriba
+RATE_CARDS_PATH = os.getenv("RATE_CARDS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rate_cards.json"))
+RATE_CARDS_RELOAD_INTERVAL = float(os.getenv("RATE_CARDS_RELOAD_INTERVAL", "30"))  # Segundos entre revisiones del archivo
+
 # Odoo API
 ODOO_URL = os.getenv("ODOO_URL", "https://bloomspal.odoo.com")
 ODOO_DB = os.getenv("ODOO_DB", "bloomspal")
@@ -77,6 +112,80 @@ ODOO_HELPDESK_TEAM_ID = int(os.getenv("ODOO_HELPDESK_TEAM_ID", "1"))
 ODOO_SALES_TEAM_ID = int(os.getenv("ODOO_SALES_TEAM_ID", "7"))
 ODOO_SPREADSHEET_ID = int(os.getenv("ODOO_SPREADSHEET_ID", "114"))
 
+# Cola de procesamiento del webhook (responder a Meta de inmediato y procesar en background)
+WEBHOOK_QUEUE_MODE = os.getenv("WEBHOOK_QUEUE_MODE", "true").lower() in ("1", "true", "yes")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_MAXSIZE = int(os.getenv("WEBHOOK_QUEUE_MAXSIZE", "500"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+
+# Ventana para combinar ráfagas de mensajes del mismo número en un solo turno
+COALESCE_QUIET_SECONDS = float(os.getenv("COALESCE_QUIET_SECONDS", "2.0"))
+COALESCE_MAX_WAIT_SECONDS = float(os.getenv("COALESCE_MAX_WAIT_SECONDS", "8.0"))
+
+# Clientes HTTP compartidos (keep-alive, HTTP/2 si el paquete h2 está instalado)
+HTTP_HTTP2 = os.getenv("HTTP_HTTP2", "true").lower() in ("1", "true", "yes")
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "120"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+
+# Cola de envío saliente de WhatsApp (límites de Meta)
+WHATSAPP_MESSAGES_PER_SECOND = float(os.getenv("WHATSAPP_MESSAGES_PER_SECOND", "80"))  # Tier de throughput
+WHATSAPP_SEND_BURST = int(os.getenv("WHATSAPP_SEND_BURST", "80"))
+WHATSAPP_RECIPIENT_INTERVAL = float(os.getenv("WHATSAPP_RECIPIENT_INTERVAL", "1.0"))  # Segundos entre mensajes al mismo número
+WHATSAPP_SEND_WORKERS = int(os.getenv("WHATSAPP_SEND_WORKERS", "8"))
+WHATSAPP_SEND_MAX_ATTEMPTS = int(os.getenv("WHATSAPP_SEND_MAX_ATTEMPTS", "6"))
+WHATSAPP_SEND_MAX_AGE = float(os.getenv("WHATSAPP_SEND_MAX_AGE", "86400"))  # Pendientes más viejos no se reenvían al reiniciar (0 = sin límite)
+WHATSAPP_BACKOFF_BASE = float(os.getenv("WHATSAPP_BACKOFF_BASE", "2.0"))
+WHATSAPP_BACKOFF_MAX = float(os.getenv("WHATSAPP_BACKOFF_MAX", "300"))
+
+# Deduplicación de mensajes (reentregas de Meta)
+DEDUP_TTL_HOURS = float(os.getenv("DEDUP_TTL_HOURS", "72"))
+DEDUP_MEMORY_SIZE = int(os.getenv("DEDUP_MEMORY_SIZE", "5000"))
+
+# Transferencia de media (streaming a archivo temporal en lugar de buffers completos)
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(25 * 1024 * 1024)))
+MEDIA_SPOOL_MAX_MEMORY = int(os.getenv("MEDIA_SPOOL_MAX_MEMORY", str(1024 * 1024)))  # Sobre esto se pasa a disco
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# Caché de media_id de Meta por contenido (Meta conserva los archivos subidos 30 días)
+MEDIA_CACHE_TTL_DAYS = float(os.getenv("MEDIA_CACHE_TTL_DAYS", "29"))
+
+# System prompt por secciones según estado del usuario (false = prompt completo siempre)
+MODULAR_PROMPTS = os.getenv("MODULAR_PROMPTS", "true").lower() in ("1", "true", "yes")
+
+# Salida estructurada de Claude: "tools" (tool use con esquemas) o "json" (legado: JSON en texto)
+CLAUDE_OUTPUT_MODE = os.getenv("CLAUDE_OUTPUT_MODE", "tools").lower()
+
+# Modelos de Claude: el grande para extraer cotizaciones, el pequeño para charla y clasificación
+CLAUDE_MODEL_LARGE = os.getenv("CLAUDE_MODEL_LARGE", "claude-sonnet-4-20250514")
+CLAUDE_MODEL_SMALL = os.getenv("CLAUDE_MODEL_SMALL", "claude-3-5-haiku-20241022")
+CLAUDE_MODEL_TRANSCRIPTION = os.getenv("CLAUDE_MODEL_TRANSCRIPTION", CLAUDE_MODEL_LARGE)
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "true").lower() in ("1", "true", "yes")
+
+# Contexto de conversación: ventana de mensajes recientes + resumen acumulado de los anteriores
+CONVERSATION_WINDOW = int(os.getenv("CONVERSATION_WINDOW", "6"))
+QUOTE_DRAFT_TTL_HOURS = float(os.getenv("QUOTE_DRAFT_TTL_HOURS", "24"))  # Borradores y última cotización sin tocar se descartan
+SUMMARY_MIN_NEW_MESSAGES = int(os.getenv("SUMMARY_MIN_NEW_MESSAGES", "2"))
+
+# Gateway de la API de Anthropic (concurrencia, reintentos y circuit breaker)
+ANTHROPIC_MAX_IN_FLIGHT = int(os.getenv("ANTHROPIC_MAX_IN_FLIGHT", "8"))
+ANTHROPIC_QUEUE_TIMEOUT = float(os.getenv("ANTHROPIC_QUEUE_TIMEOUT", "20"))  # Espera máxima por un cupo
+ANTHROPIC_REQUEST_DEADLINE = float(os.getenv("ANTHROPIC_REQUEST_DEADLINE", "90"))  # Incluye cola y reintentos
+ANTHROPIC_MAX_ATTEMPTS = int(os.getenv("ANTHROPIC_MAX_ATTEMPTS", "4"))
+ANTHROPIC_BACKOFF_BASE = float(os.getenv("ANTHROPIC_BACKOFF_BASE", "1.0"))
+ANTHROPIC_BACKOFF_MAX = float(os.getenv("ANTHROPIC_BACKOFF_MAX", "30"))
+ANTHROPIC_BREAKER_THRESHOLD = int(os.getenv("ANTHROPIC_BREAKER_THRESHOLD", "5"))  # Fallos seguidos para abrir
+ANTHROPIC_BREAKER_COOLDOWN = float(os.getenv("ANTHROPIC_BREAKER_COOLDOWN", "30"))
+
+# Atajo local (sin Claude) para guías, agradecimientos y confirmaciones simples
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+FAST_PATH_MIN_CONFIDENCE = float(os.getenv("FAST_PATH_MIN_CONFIDENCE", "0.8"))
+
+# Caché de respuestas de Claude para preguntas frecuentes sin estado (acción chat)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "500"))
+
 # ══════════════════════════════════════════════════════════════════════════════
 # VALIDACIÓN DE VARIABLES CRÍTICAS AL INICIAR
 # ══════════════════════════════════════════════════════════════════════════════
@@ -174,6 +283,83 @@ def init_database():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
+
+    # Tabla de mensajes ya recibidos (idempotencia ante reentregas de Meta)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            message_id TEXT PRIMARY KEY,
+            phone_number TEXT,
+            received_at REAL NOT NULL,
+            duplicate_hits INTEGER DEFAULT 0
+        )
+    """)
+
+    # Cola persistente de envíos salientes de WhatsApp (sobrevive reinicios)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbound_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            last_error TEXT DEFAULT '',
+            wamid TEXT DEFAULT '',
+            created_at REAL NOT NULL,
+            sent_at REAL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbound_status ON outbound_messages (status, id)")
+
+    # Resumen acumulado de cada conversación (lo que ya salió de la ventana reciente)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            conversation_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            refreshes INTEGER DEFAULT 0,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+    # Estado estructurado de la conversación (borrador de cotización)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            conversation_id INTEGER PRIMARY KEY,
+            quote_draft TEXT DEFAULT '{}',
+            last_quote TEXT DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+    """)
+    try:
+        cursor.execute("ALTER TABLE conversation_state ADD COLUMN last_quote TEXT DEFAULT '{}'")
+    except sqlite3.OperationalError:
+        pass  # La columna ya existe
+
+    # media_id de Meta ya subidos, por hash del contenido (evita re-subir el mismo archivo)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            content_hash TEXT NOT NULL,
+            mime_type TEXT NOT NULL,
+            media_id TEXT NOT NULL,
+            size INTEGER DEFAULT 0,
+            uploaded_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            hits INTEGER DEFAULT 0,
+            PRIMARY KEY (content_hash, mime_type)
+        )
+    """)
+
+    # Caché de tarifas FedEx por envío normalizado (sobrevive reinicios)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fedex_rate_cache (
+            cache_key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            hits INTEGER DEFAULT 0
+        )
+    """)
     conn.commit()
     conn.close()
 
@@ -222,12 +408,12 @@ def get_conversation_history(conversation_id: int, limit: int = 10) -> List[Dict
     conn = sqlite3.connect("sonia_conversations.db")
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT role, content FROM messages
+        SELECT id, role, content FROM messages
         WHERE conversation_id = ?
-        ORDER BY created_at DESC LIMIT ?
+        ORDER BY created_at DESC, id DESC LIMIT ?
     """, (conversation_id, limit))
 
-    messages = [{"role": row[0], "content": row[1]} for row in cursor.fetchall()]
+    messages = [{"id": row[0], "role": row[1], "content": row[2]} for row in cursor.fetchall()]
     conn.close()
     return list(reversed(messages))
 
@@ -259,6 +445,727 @@ def save_quotation(conversation_id: int, phone_number: str, quote_data: Dict):
     conn.close()
 
 
+# Campos obligatorios de una cotización (clave del borrador -> nombre para el usuario)
+QUOTE_SLOTS = {
+    "origin_country": "país de origen",
+    "origin_city": "ciudad de origen",
+    "origin_postal": "código postal de origen",
+    "destination_country": "país de destino",
+    "destination_city": "ciudad de destino",
+    "destination_postal": "código postal de destino",
+    "weight_kg": "peso total (kg)",
+    "is_pallet": "si es paletizado",
+    "num_boxes": "número de cajas",
+    "packages": "dimensiones de cada paquete",
+    "declared_value": "valor declarado (USD)",
+    "shipping_date": "fecha de salida"
+}
+
+
+def get_quote_state(conversation_id: int) -> Dict:
+    """{"quote_draft": {...}, "last_quote": {...}}; vacíos si vencieron (QUOTE_DRAFT_TTL_HOURS)"""
+    conn = sqlite3.connect("sonia_conversations.db")
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT quote_draft, last_quote, updated_at FROM conversation_state WHERE conversation_id = ?",
+        (conversation_id,)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    state = {"quote_draft": {}, "last_quote": {}}
+    if not row or time.time() - row[2] > QUOTE_DRAFT_TTL_HOURS * 3600:
+        return state
+    for key, value in zip(("quote_draft", "last_quote"), row[:2]):
+        try:
+            state[key] = json.loads(value) if value else {}
+        except json.JSONDecodeError:
+            pass
+    return state
+
+
+def save_quote_draft(conversation_id: int, draft: Dict):
+    conn = sqlite3.connect("sonia_conversations.db")
+    conn.execute("""
+        INSERT INTO conversation_state (conversation_id, quote_draft, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(conversation_id) DO UPDATE SET quote_draft = excluded.quote_draft, updated_at = excluded.updated_at
+    """, (conversation_id, json.dumps(draft, ensure_ascii=False), time.time()))
+    conn.commit()
+    conn.close()
+
+
+def archive_quote_draft(conversation_id: int, quote_data: Optional[Dict]):
+    """Cierra el borrador: pasa a última cotización (o se descarta con None, ej. tras crear la orden)"""
+    conn = sqlite3.connect("sonia_conversations.db")
+    conn.execute("""
+        INSERT INTO conversation_state (conversation_id, quote_draft, last_quote, updated_at) VALUES (?, '{}', ?, ?)
+        ON CONFLICT(conversation_id) DO UPDATE SET
+            quote_draft = '{}', last_quote = excluded.last_quote, updated_at = excluded.updated_at
+    """, (conversation_id, json.dumps(quote_data or {}, ensure_ascii=False), time.time()))
+    conn.commit()
+    conn.close()
+
+
+def merge_quote_draft(draft: Dict, update: Optional[Dict]) -> Dict:
+    """Aplica al borrador solo los campos que llegaron con valor (un cambio toca un solo campo).
+
+    Peso total y paquetes se mantienen coherentes: si cambia el peso sin paquetes nuevos, un
+    paquete único toma el peso nuevo y varios se descartan (hay que volver a pedirlos); si
+    llegan paquetes con peso, el total se recalcula.
+    """
+    merged = dict(draft)
+    changed = set()
+    for key, value in (update or {}).items():
+        if key in QUOTE_SLOTS and value not in (None, "", []):
+            if merged.get(key) != value:
+                changed.add(key)
+            merged[key] = value
+
+    if "weight_kg" in changed and "packages" not in changed and merged.get("packages"):
+        if len(merged["packages"]) == 1:
+            merged["packages"] = [{**merged["packages"][0], "weight_kg": merged["weight_kg"]}]
+        else:
+            del merged["packages"]
+    elif "packages" in changed and "weight_kg" not in changed:
+        weights = [pkg.get("weight_kg") for pkg in merged["packages"] if isinstance(pkg, dict)]
+        if weights and len(weights) == len(merged["packages"]) and all(isinstance(w, (int, float)) and w > 0 for w in weights):
+            merged["weight_kg"] = round(sum(weights), 2)
+    return merged
+
+
+def seed_from_last_quote(last_quote: Dict, update: Optional[Dict]) -> Dict:
+    """Base para "lo mismo pero...": la fecha pasada y, si cambia el peso, el valor declarado se vuelven a pedir"""
+    seed = {key: value for key, value in last_quote.items() if key in QUOTE_SLOTS}
+    if (update or {}).get("weight_kg") not in (None, "", seed.get("weight_kg")):
+        seed.pop("declared_value", None)
+    if not shipping_date_is_current(seed.get("shipping_date")):
+        seed.pop("shipping_date", None)
+    return seed
+
+
+def shipping_date_is_current(value) -> bool:
+    """La fecha de salida es de hoy en adelante (las fechas con otro formato se dejan a FedEx)"""
+    if not isinstance(value, str) or not re.fullmatch(r"\d{4}-\d{2}-\d{2}", value):
+        return True
+    return value >= datetime.now().strftime("%Y-%m-%d")
+
+
+def missing_quote_slots(draft: Dict) -> List[str]:
+    missing = [key for key in QUOTE_SLOTS if draft.get(key) in (None, "", [])]
+    if "shipping_date" not in missing and not shipping_date_is_current(draft.get("shipping_date")):
+        missing.append("shipping_date")
+    # Con el detalle de paquetes (o un pallet) el número de cajas ya se conoce
+    if "num_boxes" in missing and (draft.get("is_pallet") or draft.get("packages")):
+        missing.remove("num_boxes")
+    return missing
+
+
+def format_quote_draft(draft: Dict) -> str:
+    """Bloque compacto conocido / faltante para Claude"""
+    if not draft:
+        return ""
+    known = []
+    for key in QUOTE_SLOTS:
+        if key not in draft:
+            continue
+        value = draft[key]
+        if key == "packages":
+            value = "; ".join(
+                f"{p.get('weight_kg', '?')}kg {p.get('length', '?')}x{p.get('width', '?')}x{p.get('height', '?')}cm"
+                for p in value
+            )
+        known.append(f"- {key}: {value}")
+    missing = missing_quote_slots(draft)
+    return (
+        "BORRADOR DE COTIZACIÓN (datos ya confirmados, NO los vuelvas a pedir):\n"
+        + "\n".join(known)
+        + f"\nFaltan: {', '.join(missing) if missing else 'nada - se puede cotizar'}"
+    )
+
+
+def format_last_quote(last_quote: Dict) -> str:
+    """Resumen de la última cotización, para que Claude pueda cotizar "lo mismo pero..." """
+    if not last_quote:
+        return ""
+    fields = ", ".join(f"{key}: {last_quote[key]}" for key in QUOTE_SLOTS if key in last_quote and key != "packages")
+    packages = last_quote.get("packages") or []
+    return (
+        "ÚLTIMA COTIZACIÓN (ya presentada; el borrador está vacío):\n"
+        f"- {fields}" + (f", {len(packages)} paquete(s)" if packages else "")
+        + "\nSi el usuario pide lo mismo con cambios, usa \"from_last_quote\": true y envía solo lo que cambia."
+    )
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# DEDUPLICACIÓN DE MENSAJES
+# ══════════════════════════════════════════════════════════════════════════════
+
+class MessageDeduplicator:
+    """Registro de message_id ya recibidos: LRU en memoria delante de una tabla SQLite con TTL.
+
+    Se consulta antes de cualquier trabajo costoso (Claude, FedEx, Odoo, envío), de modo
+    que una reentrega de Meta no genere una segunda respuesta ni un segundo ticket.
+    """
+
+    def __init__(self, ttl_hours: float = DEDUP_TTL_HOURS, memory_size: int = DEDUP_MEMORY_SIZE):
+        self.ttl_seconds = ttl_hours * 3600
+        self.memory_size = memory_size
+        self.recent: OrderedDict = OrderedDict()  # message_id -> timestamp de recepción
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._claims_since_purge = 0
+
+    def _remember(self, message_id: str, received_at: float):
+        self.recent[message_id] = received_at
+        self.recent.move_to_end(message_id)
+        while len(self.recent) > self.memory_size:
+            self.recent.popitem(last=False)
+
+    def claim(self, message_id: str, phone_number: str = "") -> bool:
+        """Registra el mensaje. Retorna True si es nuevo, False si es una reentrega."""
+        now = time.time()
+
+        received_at = self.recent.get(message_id)
+        if received_at is not None:
+            if now - received_at < self.ttl_seconds:
+                self.recent.move_to_end(message_id)
+                self.memory_hits += 1
+                self._record_hit(message_id)
+                return False
+            del self.recent[message_id]
+
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO processed_messages (message_id, phone_number, received_at) VALUES (?, ?, ?)",
+                (message_id, phone_number, now)
+            )
+            if cursor.rowcount == 0:
+                cursor.execute("SELECT received_at FROM processed_messages WHERE message_id = ?", (message_id,))
+                row = cursor.fetchone()
+                if row and now - row[0] < self.ttl_seconds:
+                    cursor.execute(
+                        "UPDATE processed_messages SET duplicate_hits = duplicate_hits + 1 WHERE message_id = ?",
+                        (message_id,)
+                    )
+                    conn.commit()
+                    conn.close()
+                    self._remember(message_id, row[0])
+                    self.db_hits += 1
+                    return False
+                # Registro expirado: se considera mensaje nuevo
+                cursor.execute(
+                    "UPDATE processed_messages SET received_at = ?, phone_number = ?, duplicate_hits = 0 WHERE message_id = ?",
+                    (now, phone_number, message_id)
+                )
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            # Si SQLite falla, procesar de todos modos (mejor duplicar que perder un mensaje)
+            self.errors += 1
+            logger.warning(f"⚠️ Error en deduplicación de {message_id}: {e}")
+
+        self._remember(message_id, now)
+        self.misses += 1
+
+        self._claims_since_purge += 1
+        if self._claims_since_purge >= 500:
+            self.purge_expired()
+        return True
+
+    def release(self, message_id: str):
+        """Olvida un mensaje que no se pudo encolar, para aceptar la reentrega de Meta"""
+        self.recent.pop(message_id, None)
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            conn.execute("DELETE FROM processed_messages WHERE message_id = ?", (message_id,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Error liberando {message_id} de deduplicación: {e}")
+
+    def _record_hit(self, message_id: str):
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            conn.execute(
+                "UPDATE processed_messages SET duplicate_hits = duplicate_hits + 1 WHERE message_id = ?",
+                (message_id,)
+            )
+            conn.commit()
+            conn.close()
+        except Exception:
+            pass
+
+    def purge_expired(self) -> int:
+        """Elimina registros más viejos que el TTL"""
+        self._claims_since_purge = 0
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM processed_messages WHERE received_at < ?", (time.time() - self.ttl_seconds,))
+            deleted = cursor.rowcount
+            conn.commit()
+            conn.close()
+            if deleted:
+                logger.info(f"🧹 Deduplicación: {deleted} registros expirados eliminados")
+            return deleted
+        except Exception as e:
+            logger.warning(f"⚠️ Error purgando deduplicación: {e}")
+            return 0
+
+    def stats(self) -> Dict:
+        """Reentregas detectadas (cada una es un turno de Claude/FedEx/envío ahorrado)"""
+        duplicates = self.memory_hits + self.db_hits
+        total = duplicates + self.misses
+        stored, lifetime_hits = 0, 0
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*), COALESCE(SUM(duplicate_hits), 0) FROM processed_messages")
+            stored, lifetime_hits = cursor.fetchone()
+            conn.close()
+        except Exception:
+            pass
+        return {
+            "unique_messages": self.misses,
+            "duplicates_suppressed": duplicates,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "duplicate_rate": round(duplicates / total, 4) if total else 0.0,
+            "stored_ids": stored,
+            "duplicates_suppressed_ttl_window": lifetime_hits,
+            "errors": self.errors,
+            "ttl_hours": self.ttl_seconds / 3600
+        }
+
+
+deduplicator = MessageDeduplicator()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# CLIENTES HTTP COMPARTIDOS
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Un cliente por host upstream, con timeouts propios (segundos)
+HTTP_UPSTREAMS = {
+    "graph": {  # graph.facebook.com: mensajes, metadatos y subida de media
+        "timeout": httpx.Timeout(30.0, connect=5.0, pool=HTTP_POOL_TIMEOUT)
+    },
+    "media": {  # lookaside.fbsbx.com: descarga de archivos multimedia
+        "timeout": httpx.Timeout(60.0, connect=5.0, pool=HTTP_POOL_TIMEOUT)
+    },
+    "fedex": {  # apis.fedex.com: OAuth, tarifas y rastreo
+        "timeout": httpx.Timeout(30.0, connect=5.0, pool=HTTP_POOL_TIMEOUT)
+    },
+}
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Transporte httpx que mide conexiones abiertas/reusadas y espera del pool (trace de httpcore)"""
+
+    def __init__(self, name: str, **transport_kwargs):
+        self.name = name
+        self.transport = httpx.AsyncHTTPTransport(**transport_kwargs)
+        self.requests = 0
+        self.errors = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.pool_wait_total = 0.0
+        self.pool_wait_max = 0.0
+        self.connect_time_total = 0.0
+        self.http_versions: Dict[str, int] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.monotonic()
+        marks: Dict[str, float] = {}
+        parent_trace = request.extensions.get("trace")
+
+        async def trace(event_name: str, info: Dict):
+            if event_name == "connection.connect_tcp.started":
+                marks.setdefault("connect_started", time.monotonic())
+            elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                marks["connect_done"] = time.monotonic()
+            elif event_name.endswith("send_request_headers.started"):
+                marks.setdefault("headers_started", time.monotonic())
+            if parent_trace:
+                await parent_trace(event_name, info)
+
+        request.extensions = {**request.extensions, "trace": trace}
+        self.requests += 1
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception:
+            self.errors += 1
+            raise
+
+        if "connect_started" in marks:
+            self.connections_opened += 1
+            wait = marks["connect_started"] - started
+            self.connect_time_total += marks.get("connect_done", marks["connect_started"]) - marks["connect_started"]
+        else:
+            self.connections_reused += 1
+            wait = marks.get("headers_started", started) - started
+        self.pool_wait_total += wait
+        self.pool_wait_max = max(self.pool_wait_max, wait)
+
+        version = response.extensions.get("http_version", b"")
+        version = version.decode() if isinstance(version, bytes) else str(version)
+        self.http_versions[version] = self.http_versions.get(version, 0) + 1
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def stats(self) -> Dict:
+        pool = getattr(self.transport, "_pool", None)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "connections_opened": self.connections_opened,
+            "connections_reused": self.connections_reused,
+            "reuse_rate": round(self.connections_reused / self.requests, 4) if self.requests else 0.0,
+            "open_connections": len(getattr(pool, "connections", []) or []),
+            "avg_pool_wait_ms": round(self.pool_wait_total / self.requests * 1000, 2) if self.requests else 0.0,
+            "max_pool_wait_ms": round(self.pool_wait_max * 1000, 2),
+            "avg_connect_ms": round(self.connect_time_total / self.connections_opened * 1000, 2) if self.connections_opened else 0.0,
+            "http_versions": self.http_versions
+        }
+
+
+class HTTPClientPool:
+    """Clientes httpx de larga vida (uno por host upstream), creados en lifespan y cerrados al apagar"""
+
+    def __init__(self):
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.transports: Dict[str, InstrumentedTransport] = {}
+        self.http2 = HTTP_HTTP2 and importlib.util.find_spec("h2") is not None
+        if HTTP_HTTP2 and not self.http2:
+            logger.warning("⚠️ Paquete 'h2' no instalado - clientes HTTP usarán HTTP/1.1 con keep-alive")
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """Retorna el cliente del upstream (lo crea si aún no existe)"""
+        client = self.clients.get(name)
+        if client is None or client.is_closed:
+            config = HTTP_UPSTREAMS[name]
+            limits = httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            )
+            transport = InstrumentedTransport(name, http2=self.http2, limits=limits)
+            client = httpx.AsyncClient(transport=transport, timeout=config["timeout"])
+            self.transports[name] = transport
+            self.clients[name] = client
+        return client
+
+    def start(self):
+        for name in HTTP_UPSTREAMS:
+            self.get(name)
+        logger.info(
+            f"🌐 Clientes HTTP listos ({', '.join(HTTP_UPSTREAMS)}) - "
+            f"HTTP/2={'sí' if self.http2 else 'no'}, máx {HTTP_MAX_CONNECTIONS} conexiones por host"
+        )
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients = {}
+
+    def stats(self) -> Dict:
+        return {
+            "http2": self.http2,
+            "upstreams": {name: transport.stats() for name, transport in self.transports.items()}
+        }
+
+
+http_clients = HTTPClientPool()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# TRANSFERENCIAS DE MEDIA (STREAMING)
+# ══════════════════════════════════════════════════════════════════════════════
+
+def process_max_rss_bytes() -> Optional[int]:
+    """RSS máximo del proceso desde que arrancó (None si la plataforma no lo reporta)"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def spooled_memory_bytes(data: Union[bytes, BinaryIO], size: int) -> int:
+    """Bytes del archivo que residen en RAM (un SpooledTemporaryFile volcado a disco no cuenta)"""
+    if isinstance(data, (bytes, bytearray, io.BytesIO)):
+        return size
+    if isinstance(data, tempfile.SpooledTemporaryFile):
+        return 0 if getattr(data, "_rolled", False) else size
+    return 0
+
+
+def file_size(fileobj: BinaryIO) -> int:
+    position = fileobj.tell()
+    size = fileobj.seek(0, os.SEEK_END)
+    fileobj.seek(position)
+    return size
+
+
+def encode_base64(data: Union[bytes, BinaryIO], chunk_size: int = 3 * MEDIA_CHUNK_SIZE) -> str:
+    """Codifica en base64 leyendo el archivo por bloques (múltiplos de 3 bytes)"""
+    if isinstance(data, (bytes, bytearray)):
+        return base64.standard_b64encode(data).decode("utf-8")
+    data.seek(0)
+    parts = []
+    while True:
+        chunk = data.read(chunk_size)
+        if not chunk:
+            break
+        parts.append(base64.standard_b64encode(chunk).decode("utf-8"))
+    return "".join(parts)
+
+
+class MediaTransferStats:
+    """Tamaño, duración y memoria pico de cada descarga/subida de media"""
+
+    def __init__(self, history: int = 20):
+        self.totals = {
+            direction: {
+                "transfers": 0,
+                "bytes": 0,
+                "max_peak_memory_bytes": 0,
+                "spooled_to_disk": 0,
+                "rejected_too_large": 0
+            }
+            for direction in ("download", "upload")
+        }
+        self.recent = deque(maxlen=history)
+
+    def record(self, direction: str, size: int, peak_memory: int, on_disk: bool, duration: float):
+        totals = self.totals[direction]
+        totals["transfers"] += 1
+        totals["bytes"] += size
+        totals["max_peak_memory_bytes"] = max(totals["max_peak_memory_bytes"], peak_memory)
+        if on_disk:
+            totals["spooled_to_disk"] += 1
+        self.recent.append({
+            "direction": direction,
+            "bytes": size,
+            "peak_memory_bytes": peak_memory,
+            "on_disk": on_disk,
+            "duration_ms": round(duration * 1000, 1),
+            "at": datetime.now().isoformat(timespec="seconds")
+        })
+
+    def reject(self, direction: str):
+        self.totals[direction]["rejected_too_large"] += 1
+
+    def stats(self) -> Dict:
+        return {
+            "process_max_rss_bytes": process_max_rss_bytes(),
+            "max_bytes": MEDIA_MAX_BYTES,
+            "spool_max_memory": MEDIA_SPOOL_MAX_MEMORY,
+            **self.totals,
+            "recent": list(self.recent)
+        }
+
+
+media_transfers = MediaTransferStats()
+
+
+def content_sha256(data: Union[bytes, BinaryIO]) -> str:
+    """SHA-256 del contenido, leyendo archivos por bloques y dejándolos al inicio"""
+    if isinstance(data, (bytes, bytearray)):
+        return hashlib.sha256(data).hexdigest()
+    digest = hashlib.sha256()
+    data.seek(0)
+    while True:
+        chunk = data.read(MEDIA_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    data.seek(0)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """media_id de Meta indexados por SHA-256 del contenido + MIME type, con vencimiento.
+
+    Un mismo PDF o tarifario enviado a muchos clientes se sube una sola vez; los envíos
+    siguientes van directo a /messages con el media_id guardado.
+    """
+
+    def __init__(self, ttl_days: float = MEDIA_CACHE_TTL_DAYS):
+        self.ttl_seconds = ttl_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+        self.bytes_saved = 0
+        self.errors = 0
+
+    def lookup(self, content_hash: str, mime_type: str) -> Optional[str]:
+        """Retorna el media_id vigente para el contenido, o None si hay que subirlo"""
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT media_id, size, expires_at FROM media_cache WHERE content_hash = ? AND mime_type = ?",
+                (content_hash, mime_type)
+            )
+            row = cursor.fetchone()
+            if row and row[2] > time.time():
+                cursor.execute(
+                    "UPDATE media_cache SET hits = hits + 1 WHERE content_hash = ? AND mime_type = ?",
+                    (content_hash, mime_type)
+                )
+                conn.commit()
+                conn.close()
+                self.hits += 1
+                self.bytes_saved += row[1] or 0
+                return row[0]
+            if row:
+                cursor.execute(
+                    "DELETE FROM media_cache WHERE content_hash = ? AND mime_type = ?",
+                    (content_hash, mime_type)
+                )
+                conn.commit()
+                self.expired += 1
+            conn.close()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Error consultando caché de media: {e}")
+        self.misses += 1
+        return None
+
+    def store(self, content_hash: str, mime_type: str, media_id: str, size: int):
+        now = time.time()
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            conn.execute(
+                """INSERT OR REPLACE INTO media_cache
+                   (content_hash, mime_type, media_id, size, uploaded_at, expires_at, hits)
+                   VALUES (?, ?, ?, ?, ?, ?, 0)""",
+                (content_hash, mime_type, media_id, size, now, now + self.ttl_seconds)
+            )
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Error guardando media {media_id} en caché: {e}")
+
+    def invalidate(self, content_hash: str, mime_type: str):
+        """Descarta un media_id que Meta rechazó (el acierto previo no cuenta como ahorro)"""
+        self.invalidated += 1
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT size FROM media_cache WHERE content_hash = ? AND mime_type = ?",
+                (content_hash, mime_type)
+            )
+            row = cursor.fetchone()
+            if row:
+                self.hits -= 1
+                self.misses += 1
+                self.bytes_saved -= row[0] or 0
+            cursor.execute(
+                "DELETE FROM media_cache WHERE content_hash = ? AND mime_type = ?",
+                (content_hash, mime_type)
+            )
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Error invalidando caché de media: {e}")
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        stored, lifetime_bytes_saved = 0, 0
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT COUNT(*), COALESCE(SUM(hits * size), 0) FROM media_cache WHERE expires_at > ?",
+                (time.time(),)
+            )
+            stored, lifetime_bytes_saved = cursor.fetchone()
+            conn.close()
+        except Exception:
+            pass
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "bytes_saved_cached_entries": lifetime_bytes_saved,
+            "expired": self.expired,
+            "invalidated": self.invalidated,
+            "stored_media": stored,
+            "errors": self.errors,
+            "ttl_days": self.ttl_seconds / 86400
+        }
+
+
+media_cache = MediaCache()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# DIVISIÓN DE MENSAJES LARGOS
+# ══════════════════════════════════════════════════════════════════════════════
+
+WHATSAPP_BOLD_SPAN = re.compile(r"\*[^*\n]+\*")
+
+
+def split_whatsapp_text(text: str, limit: int = WHATSAPP_MAX_TEXT_LENGTH) -> List[str]:
+    """Divide un texto en partes de hasta `limit` caracteres.
+
+    Corta preferentemente entre párrafos, luego entre líneas y luego entre palabras,
+    nunca dentro de un span *negrita* de WhatsApp.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    chunks = []
+    remaining = text
+    while len(remaining) > limit:
+        bold_spans = []
+        for match in WHATSAPP_BOLD_SPAN.finditer(remaining):
+            if match.start() >= limit:
+                break
+            bold_spans.append(match.span())
+
+        def valid(pos: int) -> bool:
+            return pos > 0 and not any(start < pos < end for start, end in bold_spans)
+
+        cut = None
+        for separator in ("\n\n", "\n", " "):
+            pos = remaining.rfind(separator, 0, limit)
+            while pos > 0 and not valid(pos):
+                pos = remaining.rfind(separator, 0, pos)
+            if pos > 0:
+                cut = pos
+                break
+
+        if cut is None:
+            # Sin separadores: corte duro, retrocediendo al inicio de una negrita si cae dentro
+            cut = limit
+            for start, end in bold_spans:
+                if start < cut < end and start > 0:
+                    cut = start
+
+        chunk = remaining[:cut].rstrip()
+        if chunk:
+            chunks.append(chunk)
+        remaining = remaining[cut:].lstrip("\n")
+        if remaining.startswith(" "):
+            remaining = remaining[1:]
+
+    if remaining.strip():
+        chunks.append(remaining)
+    return chunks
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # CLIENTE WHATSAPP
 # ══════════════════════════════════════════════════════════════════════════════
@@ -271,102 +1178,152 @@ class WhatsAppClient:
         self.phone_number_id = WHATSAPP_PHONE_NUMBER_ID
         self.api_url = WHATSAPP_API_URL
 
-    async def send_message(self, to: str, text: str, retries: int = 3) -> Dict:
-        """Envía un mensaje de texto con reintentos"""
-        url = f"{self.api_url}/{self.phone_number_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
+    async def send_message(self, to: str, text: str, wait: bool = True) -> Dict:
+        """Envía un mensaje de texto a través de la cola de salida.
 
-        # WhatsApp tiene límite de 4096 caracteres por mensaje
-        if len(text) > 4096:
-            text = text[:4090] + "..."
+        Los textos de más de 4096 caracteres se dividen en partes que se encolan juntas;
+        la cola de salida garantiza que lleguen en orden. Con wait=True espera el
+        resultado (incluidos reintentos) y lanza excepción si alguna parte falla
+        definitivamente; con wait=False solo encola y retorna de inmediato.
+        """
+        chunks = split_whatsapp_text(text)
+        if len(chunks) > 1:
+            logger.info(f"✂️ Mensaje a {to} dividido en {len(chunks)} partes ({len(text)} caracteres)")
 
-        payload = {
+        payloads = [{
             "messaging_product": "whatsapp",
             "recipient_type": "individual",
             "to": to,
             "type": "text",
-            "text": {"body": text}
-        }
+            "text": {"body": chunk}
+        } for chunk in chunks]
 
-        last_error = None
-        for attempt in range(retries):
-            try:
-                async with httpx.AsyncClient(timeout=30) as client:
-                    response = await client.post(url, headers=headers, json=payload)
+        if not wait:
+            outbound_ids = [outbound.submit(to, payload) for payload in payloads]
+            return {"queued": True, "outbound_id": outbound_ids[0], "outbound_ids": outbound_ids, "chunks": len(chunks)}
 
-                    if response.status_code == 200 or response.status_code == 201:
-                        result = response.json()
-                        logger.info(f"✅ Mensaje enviado exitosamente a {to}")
-                        return result
-                    else:
-                        error_text = response.text
-                        logger.error(
-                            f"❌ WhatsApp API error (intento {attempt+1}/{retries}): "
-                            f"Status {response.status_code} - {error_text}"
-                        )
-                        last_error = f"HTTP {response.status_code}: {error_text}"
-
-                        # Si es error de autenticación, no reintentar
-                        if response.status_code in (401, 403):
-                            logger.error("🔐 TOKEN DE WHATSAPP INVÁLIDO O EXPIRADO - Verificar en Railway")
-                            raise Exception(f"Token WhatsApp inválido: {response.status_code}")
-
-            except httpx.TimeoutException:
-                logger.error(f"⏱️ Timeout enviando mensaje (intento {attempt+1}/{retries})")
-                last_error = "Timeout"
-            except Exception as e:
-                if "Token WhatsApp inválido" in str(e):
-                    raise  # No reintentar errores de auth
-                logger.error(f"❌ Error enviando mensaje (intento {attempt+1}/{retries}): {e}")
-                last_error = str(e)
+        results = await asyncio.gather(*(outbound.send(to, payload) for payload in payloads))
+        result = dict(results[0])
+        result["messages"] = [msg for r in results for msg in (r.get("messages") or [])]
+        result["chunks"] = len(chunks)
+        return result
+
+    async def post_message(self, payload: Dict) -> Dict:
+        """Un solo intento de POST /messages; clasifica el error para el despachador de salida"""
+        url = f"{self.api_url}/{self.phone_number_id}/messages"
+        headers = {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json"
+        }
 
-            if attempt < retries - 1:
-                wait_time = 2 * (attempt + 1)
-                logger.info(f"⏳ Reintentando en {wait_time}s...")
-                await asyncio.sleep(wait_time)
+        try:
+            response = await http_clients.get("graph").post(url, headers=headers, json=payload)
+        except httpx.TimeoutException:
+            raise WhatsAppSendError("Timeout")
+        except httpx.HTTPError as e:
+            raise WhatsAppSendError(f"Error de red: {e}")
 
-        raise Exception(f"No se pudo enviar mensaje después de {retries} intentos: {last_error}")
+        if response.status_code in (200, 201):
+            return response.json()
 
-    async def download_media(self, media_id: str) -> Optional[bytes]:
-        """Descarga un archivo multimedia (audio, imagen, etc.)"""
+        try:
+            error = response.json().get("error", {}) or {}
+        except Exception:
+            error = {}
+        error_code = error.get("code")
+        detail = f"HTTP {response.status_code}: {error.get('message') or response.text[:300]}"
+        error_details = " ".join(filter(None, [error.get("message"), (error.get("error_data") or {}).get("details")]))
+
+        if response.status_code in (401, 403) or error_code == 190:
+            logger.error("🔐 TOKEN DE WHATSAPP INVÁLIDO O EXPIRADO - Verificar en Railway")
+            raise WhatsAppSendError(f"Token WhatsApp inválido: {detail}", response.status_code, error_code, retryable=False)
+
+        retry_after = parse_retry_after(response.headers.get("retry-after"))
+        if error_code in WHATSAPP_GLOBAL_RATE_LIMIT_CODES:
+            raise WhatsAppSendError(detail, response.status_code, error_code, retry_after, scope="global")
+        if error_code in WHATSAPP_RECIPIENT_RATE_LIMIT_CODES:
+            raise WhatsAppSendError(detail, response.status_code, error_code, retry_after, scope="recipient")
+        if response.status_code == 429:
+            raise WhatsAppSendError(detail, response.status_code, error_code, retry_after, scope="global")
+        if response.status_code >= 500 or error_code in WHATSAPP_TRANSIENT_CODES:
+            raise WhatsAppSendError(detail, response.status_code, error_code, retry_after)
+
+        # Resto de errores 4xx (número inválido, fuera de ventana de 24h, etc.): no reintentar
+        raise WhatsAppSendError(detail, response.status_code, error_code, retryable=False, details=error_details)
+
+    async def download_media(self, media_id: str) -> Optional[BinaryIO]:
+        """Descarga un archivo multimedia (audio, imagen, etc.) a un archivo temporal.
+
+        El contenido se escribe por bloques en un SpooledTemporaryFile (en RAM hasta
+        MEDIA_SPOOL_MAX_MEMORY, luego en disco) y se corta si supera MEDIA_MAX_BYTES.
+        Retorna el archivo posicionado al inicio; el llamador debe cerrarlo.
+        """
         # Primero obtener la URL del media
         url = f"{self.api_url}/{media_id}"
         headers = {"Authorization": f"Bearer {self.token}"}
 
+        spool = None
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.get(url, headers=headers)
+            response = await http_clients.get("graph").get(url, headers=headers)
 
-                if response.status_code != 200:
-                    logger.error(f"❌ Error obteniendo URL del media {media_id}: {response.status_code}")
-                    return None
+            if response.status_code != 200:
+                logger.error(f"❌ Error obteniendo URL del media {media_id}: {response.status_code}")
+                return None
 
-                media_data = response.json()
-                media_url = media_data.get("url")
+            media_data = response.json()
+            media_url = media_data.get("url")
 
-                if not media_url:
-                    logger.error(f"❌ No se encontró URL del media en respuesta: {media_data}")
-                    return None
+            if not media_url:
+                logger.error(f"❌ No se encontró URL del media en respuesta: {media_data}")
+                return None
 
-                # Descargar el archivo
-                download_response = await client.get(
-                    media_url,
-                    headers=headers,
-                    follow_redirects=True
-                )
+            if int(media_data.get("file_size") or 0) > MEDIA_MAX_BYTES:
+                logger.error(f"❌ Media {media_id} excede el límite: {media_data.get('file_size')} bytes")
+                media_transfers.reject("download")
+                return None
 
+            # Descargar el archivo por bloques
+            started = time.monotonic()
+            async with http_clients.get("media").stream(
+                "GET",
+                media_url,
+                headers=headers,
+                follow_redirects=True
+            ) as download_response:
                 if download_response.status_code != 200:
                     logger.error(f"❌ Error descargando media: {download_response.status_code}")
                     return None
 
-                logger.info(f"✅ Media descargado: {len(download_response.content)} bytes")
-                return download_response.content
+                if int(download_response.headers.get("content-length") or 0) > MEDIA_MAX_BYTES:
+                    logger.error(f"❌ Media {media_id} excede el límite: {download_response.headers['content-length']} bytes")
+                    media_transfers.reject("download")
+                    return None
+
+                spool = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_MAX_MEMORY)
+                size = 0
+                largest_chunk = 0
+                async for chunk in download_response.aiter_bytes(MEDIA_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MEDIA_MAX_BYTES:
+                        logger.error(f"❌ Media {media_id} excede el límite de {MEDIA_MAX_BYTES} bytes - descarga cancelada")
+                        media_transfers.reject("download")
+                        spool.close()
+                        return None
+                    largest_chunk = max(largest_chunk, len(chunk))
+                    spool.write(chunk)
+
+            in_memory = spooled_memory_bytes(spool, size)
+            media_transfers.record(
+                "download", size, in_memory + largest_chunk, in_memory == 0 and size > 0, time.monotonic() - started
+            )
+            spool.seek(0)
+            logger.info(f"✅ Media descargado: {size} bytes ({'disco' if in_memory == 0 else 'memoria'})")
+            return spool
 
         except Exception as e:
             logger.error(f"❌ Error descargando media {media_id}: {e}")
+            if spool is not None:
+                spool.close()
             return None
 
     async def mark_as_read(self, message_id: str):
@@ -383,66 +1340,455 @@ class WhatsAppClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                await client.post(url, headers=headers, json=payload)
+            await http_clients.get("graph").post(url, headers=headers, json=payload, timeout=10)
         except Exception as e:
             logger.warning(f"⚠️ No se pudo marcar mensaje como leído: {e}")
 
-    async def send_document(self, to: str, file_data: bytes, filename: str, caption: str = "", mime_type: str = "application/octet-stream") -> Dict:
-        """Envía un documento (archivo) vía WhatsApp Cloud API."""
+    async def upload_media(self, file_data: Union[bytes, BinaryIO], filename: str, mime_type: str) -> Dict:
+        """Sube un archivo a /media. Retorna {"id": media_id} o {"error": ...}.
+
+        file_data puede ser bytes o un archivo abierto; los archivos se suben por bloques
+        sin copiarlos completos a memoria.
+        """
         upload_url = f"{self.api_url}/{self.phone_number_id}/media"
         headers = {"Authorization": f"Bearer {self.token}"}
 
-        try:
-            async with httpx.AsyncClient(timeout=60) as client:
-                response = await client.post(
-                    upload_url,
-                    headers=headers,
-                    files={"file": (filename, file_data, mime_type)},
-                    data={"messaging_product": "whatsapp", "type": mime_type}
-                )
+        if isinstance(file_data, (bytes, bytearray)):
+            size = in_memory = len(file_data)
+        else:
+            file_data.seek(0)
+            size = file_size(file_data)
+            in_memory = spooled_memory_bytes(file_data, size)
+
+        started = time.monotonic()
+        response = await http_clients.get("graph").post(
+            upload_url,
+            headers=headers,
+            files={"file": (filename, file_data, mime_type)},
+            data={"messaging_product": "whatsapp", "type": mime_type},
+            timeout=60
+        )
+        media_transfers.record(
+            "upload", size, in_memory + min(size, MEDIA_CHUNK_SIZE), in_memory == 0 and size > 0,
+            time.monotonic() - started
+        )
 
-                if response.status_code not in (200, 201):
-                    logger.error(f"❌ Error uploading media: {response.status_code} - {response.text}")
-                    return {"error": f"Media upload failed: {response.status_code}"}
+        if response.status_code not in (200, 201):
+            logger.error(f"❌ Error uploading media: {response.status_code} - {response.text}")
+            return {"error": f"Media upload failed: {response.status_code}"}
 
-                media_data = response.json()
-                media_id = media_data.get("id")
-                if not media_id:
-                    logger.error(f"❌ No media ID in upload response: {media_data}")
-                    return {"error": "No media ID in upload response"}
+        media_data = response.json()
+        media_id = media_data.get("id")
+        if not media_id:
+            logger.error(f"❌ No media ID in upload response: {media_data}")
+            return {"error": "No media ID in upload response"}
+        return {"id": media_id, "size": size}
 
-            msg_url = f"{self.api_url}/{self.phone_number_id}/messages"
-            msg_headers = {
-                "Authorization": f"Bearer {self.token}",
-                "Content-Type": "application/json"
-            }
-            payload = {
-                "messaging_product": "whatsapp",
-                "recipient_type": "individual",
-                "to": to,
-                "type": "document",
-                "document": {
-                    "id": media_id,
-                    "caption": caption or filename,
-                    "filename": filename
+    async def send_document(self, to: str, file_data: Union[bytes, BinaryIO], filename: str, caption: str = "", mime_type: str = "application/octet-stream") -> Dict:
+        """Envía un documento (archivo) vía WhatsApp Cloud API.
+
+        Si el mismo contenido ya se subió (media_cache) se reutiliza su media_id; si Meta
+        lo rechaza por vencido o inválido, se sube de nuevo y se reintenta una vez.
+        """
+        try:
+            content_hash = content_sha256(file_data)
+            media_id = media_cache.lookup(content_hash, mime_type)
+            cached = media_id is not None
+
+            while True:
+                if not cached:
+                    upload = await self.upload_media(file_data, filename, mime_type)
+                    if "error" in upload:
+                        return upload
+                    media_id = upload["id"]
+                    media_cache.store(content_hash, mime_type, media_id, upload["size"])
+
+                payload = {
+                    "messaging_product": "whatsapp",
+                    "recipient_type": "individual",
+                    "to": to,
+                    "type": "document",
+                    "document": {
+                        "id": media_id,
+                        "caption": caption or filename,
+                        "filename": filename
+                    }
                 }
-            }
 
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.post(msg_url, headers=msg_headers, json=payload)
-                if response.status_code in (200, 201):
-                    logger.info(f"📎 Documento enviado a {to}: {filename}")
-                    return response.json()
-                else:
-                    logger.error(f"❌ Error sending document: {response.status_code} - {response.text}")
-                    return {"error": f"Send document failed: {response.status_code}"}
+                try:
+                    result = await outbound.send(to, payload)
+                except WhatsAppSendError as e:
+                    if cached and media_rejected(e, media_id):
+                        logger.warning(f"♻️ Meta rechazó media_id en caché {media_id} ({e.error_code}) - subiendo de nuevo")
+                        media_cache.invalidate(content_hash, mime_type)
+                        cached = False
+                        continue
+                    logger.error(f"❌ Error sending document: {e}")
+                    return {"error": f"Send document failed: {e}"}
+                except Exception as e:
+                    logger.error(f"❌ Error sending document: {e}")
+                    return {"error": f"Send document failed: {e}"}
+                logger.info(f"📎 Documento enviado a {to}: {filename}{' (media en caché)' if cached else ''}")
+                return result
 
         except Exception as e:
             logger.error(f"❌ Error en send_document: {e}")
             return {"error": str(e)}
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# COLA DE ENVÍO SALIENTE (WHATSAPP)
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Códigos de error de Meta: https://developers.facebook.com/docs/whatsapp/cloud-api/support/error-codes
+WHATSAPP_GLOBAL_RATE_LIMIT_CODES = {4, 80007, 130429}       # Límite de la app / cuenta / throughput del número
+WHATSAPP_RECIPIENT_RATE_LIMIT_CODES = {131048, 131056}     # Spam rate limit / límite por par emisor-destinatario
+WHATSAPP_TRANSIENT_CODES = {1, 2, 131000, 131016}          # Errores temporales del servicio
+WHATSAPP_MEDIA_REJECTED_CODES = {131052, 131053}         # Media vencida o no descargable por Meta
+WHATSAPP_INVALID_PARAMETER_CODES = {100, 131009}          # Parámetro inválido: solo cuenta si apunta al media_id
+
+
+def media_rejected(error: "WhatsAppSendError", media_id: str) -> bool:
+    """El error se debe al media_id (vencido o inválido) y no a otro campo del mensaje"""
+    if error.error_code in WHATSAPP_MEDIA_REJECTED_CODES:
+        return True
+    if error.error_code in WHATSAPP_INVALID_PARAMETER_CODES:
+        details = (error.details or "").lower()
+        return str(media_id) in details or re.search(r"media|document\W+id", details) is not None
+    return False
+
+
+class WhatsAppSendError(Exception):
+    """Error al enviar un mensaje por WhatsApp, clasificado para decidir el reintento"""
+
+    def __init__(self, message: str, status_code: int = None, error_code: int = None,
+                 retry_after: float = None, retryable: bool = True, scope: str = None, details: str = ""):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error_code = error_code
+        self.details = details  # error.message + error.error_data.details de Meta
+        self.retry_after = retry_after
+        self.retryable = retryable
+        self.scope = scope  # "global" (pausa todos los envíos) o "recipient"
+
+    @property
+    def rate_limited(self) -> bool:
+        return self.scope is not None
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Interpreta el header Retry-After (segundos o fecha HTTP)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class TokenBucket:
+    """Token bucket asíncrono para limitar el ritmo global de envíos"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = max(rate, 0.001)
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Toma un token, esperando si hace falta. Retorna los segundos esperados."""
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+
+class OutboundDispatcher:
+    """Despachador de mensajes salientes de WhatsApp.
+
+    - Token bucket global dimensionado al tier de mensajería del número
+    - Orden FIFO y ritmo mínimo por destinatario
+    - Reintentos con backoff exponencial y jitter que respetan Retry-After y los códigos de Meta
+    - Cola persistida en SQLite: los pendientes se retoman tras un reinicio
+    """
+
+    def __init__(self, workers: int = WHATSAPP_SEND_WORKERS):
+        self.num_workers = max(1, workers)
+        self.bucket = TokenBucket(WHATSAPP_MESSAGES_PER_SECOND, WHATSAPP_SEND_BURST)
+        self.sender: Optional[Callable[[Dict], Awaitable[Dict]]] = None
+        self.queues: Dict[str, deque] = {}    # destinatario -> mensajes pendientes en orden
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.scheduled = set()                # destinatarios en cola de listos, en proceso o con timer
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+        self.last_sent: Dict[str, float] = {}
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.paused_until = 0.0
+        self.tasks: List[asyncio.Task] = []
+        self.started = False
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.expired = 0
+        self.in_flight = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.http_latency_total = 0.0
+
+    def start(self, sender: Callable[[Dict], Awaitable[Dict]]):
+        """Arranca los workers y retoma los envíos pendientes guardados en SQLite"""
+        if self.started:
+            return
+        self.sender = sender
+        self.started = True
+        restored = self._load_pending()
+        for i in range(self.num_workers):
+            self.tasks.append(asyncio.create_task(self._worker(i)))
+        logger.info(
+            f"📮 Cola de salida iniciada: {WHATSAPP_MESSAGES_PER_SECOND:g} msg/s, "
+            f"{self.num_workers} workers, {restored} pendientes retomados"
+        )
+
+    async def stop(self):
+        """Detiene los workers; lo pendiente queda en SQLite para el próximo arranque"""
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers = {}
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.started = False
+        for future in self.waiters.values():
+            if not future.done():
+                future.set_exception(Exception("Cola de salida detenida; el envío se retomará al reiniciar"))
+        self.waiters = {}
+        self.queues = {}
+        self.scheduled = set()
+        self.ready = asyncio.Queue()
+
+    def _load_pending(self) -> int:
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM outbound_messages WHERE status != 'pending' AND created_at < ?",
+                           (time.time() - 7 * 86400,))
+            if WHATSAPP_SEND_MAX_AGE > 0:
+                # Tras una caída larga la respuesta ya no sirve (y Meta la rechaza fuera de la ventana de 24h)
+                cursor.execute(
+                    """UPDATE outbound_messages SET status = 'expired', last_error = 'Vencido antes de reenviar'
+                       WHERE status = 'pending' AND created_at < ?""",
+                    (time.time() - WHATSAPP_SEND_MAX_AGE,)
+                )
+                if cursor.rowcount:
+                    self.expired += cursor.rowcount
+                    logger.warning(f"⌛ {cursor.rowcount} envío(s) pendiente(s) con más de {WHATSAPP_SEND_MAX_AGE:g}s marcados como vencidos")
+            cursor.execute("""
+                SELECT id, recipient, payload, attempts, next_attempt_at, created_at
+                FROM outbound_messages WHERE status = 'pending' ORDER BY id
+            """)
+            rows = cursor.fetchall()
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"❌ Error cargando envíos pendientes: {e}")
+            return 0
+        for row_id, recipient, payload, attempts, next_attempt_at, created_at in rows:
+            self._schedule_item(recipient, {
+                "id": row_id,
+                "payload": json.loads(payload),
+                "attempts": attempts,
+                "next_attempt_at": next_attempt_at,
+                "created_at": created_at
+            })
+        return len(rows)
+
+    def submit(self, to: str, payload: Dict) -> int:
+        """Persiste y encola un mensaje. Retorna el id del envío (no espera el resultado)."""
+        if not self.started:
+            self.start(whatsapp.post_message)
+        now = time.time()
+        conn = sqlite3.connect("sonia_conversations.db")
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO outbound_messages (recipient, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+            (to, json.dumps(payload), now, now)
+        )
+        row_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        self._schedule_item(to, {"id": row_id, "payload": payload, "attempts": 0,
+                                 "next_attempt_at": now, "created_at": now})
+        return row_id
+
+    async def send(self, to: str, payload: Dict) -> Dict:
+        """Encola un mensaje y espera su resultado final (respuesta de Meta o excepción)"""
+        future = asyncio.get_running_loop().create_future()
+        row_id = self.submit(to, payload)
+        self.waiters[row_id] = future
+        return await future
+
+    def _schedule_item(self, recipient: str, item: Dict):
+        self.queues.setdefault(recipient, deque()).append(item)
+        if recipient not in self.scheduled:
+            self.scheduled.add(recipient)
+            self.ready.put_nowait(recipient)
+
+    def _reschedule(self, recipient: str):
+        """Programa al destinatario para cuando su próximo mensaje pueda salir"""
+        queue = self.queues.get(recipient)
+        if not queue:
+            self.queues.pop(recipient, None)
+            self.scheduled.discard(recipient)
+            return
+        next_at = max(queue[0]["next_attempt_at"],
+                      self.last_sent.get(recipient, 0) + WHATSAPP_RECIPIENT_INTERVAL)
+        delay = next_at - time.time()
+        if delay <= 0:
+            self.ready.put_nowait(recipient)
+        else:
+            self.timers[recipient] = asyncio.get_running_loop().call_later(delay, self._wake, recipient)
+
+    def _wake(self, recipient: str):
+        self.timers.pop(recipient, None)
+        self.ready.put_nowait(recipient)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            recipient = await self.ready.get()
+            try:
+                queue = self.queues.get(recipient)
+                if not queue:
+                    continue
+                item = queue[0]
+                now = time.time()
+                not_before = max(item["next_attempt_at"],
+                                 self.last_sent.get(recipient, 0) + WHATSAPP_RECIPIENT_INTERVAL)
+                if not_before > now:
+                    continue  # _reschedule en finally lo despierta a tiempo
+
+                # Pausa global por límite de throughput del número/app
+                if self.paused_until > time.monotonic():
+                    await asyncio.sleep(self.paused_until - time.monotonic())
+                await self.bucket.acquire()
+
+                await self._attempt(recipient, queue, item)
+            finally:
+                self.ready.task_done()
+                self._reschedule(recipient)
+
+    async def _attempt(self, recipient: str, queue: deque, item: Dict):
+        item["attempts"] += 1
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            result = await self.sender(item["payload"])
+        except WhatsAppSendError as e:
+            self._handle_failure(recipient, queue, item, e)
+            return
+        except Exception as e:
+            self._handle_failure(recipient, queue, item, WhatsAppSendError(str(e)))
+            return
+        finally:
+            self.in_flight -= 1
+            self.http_latency_total += time.monotonic() - started
+
+        queue.popleft()
+        self.last_sent[recipient] = time.time()
+        latency = time.time() - item["created_at"]
+        self.sent += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        wamid = (result.get("messages") or [{}])[0].get("id", "") if isinstance(result, dict) else ""
+        self._update_row(item["id"], status="sent", attempts=item["attempts"], wamid=wamid, sent_at=time.time())
+        logger.info(f"✅ Mensaje enviado exitosamente a {recipient} ({latency:.2f}s en cola)")
+        future = self.waiters.pop(item["id"], None)
+        if future and not future.done():
+            future.set_result(result)
+
+    def _handle_failure(self, recipient: str, queue: deque, item: Dict, error: WhatsAppSendError):
+        attempts = item["attempts"]
+        if error.rate_limited:
+            self.rate_limited += 1
+
+        if not error.retryable or attempts >= WHATSAPP_SEND_MAX_ATTEMPTS:
+            queue.popleft()
+            self.failed += 1
+            self._update_row(item["id"], status="failed", attempts=attempts, last_error=str(error)[:500])
+            logger.error(f"❌ Envío a {recipient} falló definitivamente tras {attempts} intento(s): {error}")
+            future = self.waiters.pop(item["id"], None)
+            if future and not future.done():
+                future.set_exception(WhatsAppSendError(
+                    f"No se pudo enviar mensaje después de {attempts} intentos: {error}",
+                    error.status_code, error.error_code, retryable=False, details=error.details
+                ))
+            return
+
+        # Backoff exponencial con jitter; Retry-After de Meta manda si es mayor
+        backoff = min(WHATSAPP_BACKOFF_MAX, WHATSAPP_BACKOFF_BASE * (2 ** (attempts - 1)))
+        delay = random.uniform(backoff / 2, backoff)
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        if error.scope == "global":
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        item["next_attempt_at"] = time.time() + delay
+        self.retries += 1
+        self._update_row(item["id"], attempts=attempts, next_attempt_at=item["next_attempt_at"],
+                         last_error=str(error)[:500])
+        logger.warning(
+            f"⏳ Envío a {recipient} reintentará en {delay:.1f}s "
+            f"(intento {attempts}/{WHATSAPP_SEND_MAX_ATTEMPTS}, código {error.error_code}): {error}"
+        )
+
+    def _update_row(self, row_id: int, **fields):
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            assignments = ", ".join(f"{k} = ?" for k in fields)
+            conn.execute(f"UPDATE outbound_messages SET {assignments} WHERE id = ?", (*fields.values(), row_id))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Error actualizando envío {row_id}: {e}")
+
+    def stats(self) -> Dict:
+        depth = sum(len(q) for q in self.queues.values())
+        oldest = min((q[0]["created_at"] for q in self.queues.values() if q), default=None)
+        return {
+            "depth": depth,
+            "recipients_pending": len([q for q in self.queues.values() if q]),
+            "oldest_pending_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "expired": self.expired,
+            "paused_seconds_remaining": round(max(0.0, self.paused_until - time.monotonic()), 3),
+            "avg_send_latency_seconds": round(self.latency_total / self.sent, 3) if self.sent else 0.0,
+            "max_send_latency_seconds": round(self.latency_max, 3),
+            "avg_http_latency_ms": round(self.http_latency_total / (self.sent + self.failed + self.retries) * 1000, 2)
+                                   if (self.sent + self.failed + self.retries) else 0.0,
+            "messages_per_second": WHATSAPP_MESSAGES_PER_SECOND,
+            "recipient_interval_seconds": WHATSAPP_RECIPIENT_INTERVAL
+        }
+
+
+outbound = OutboundDispatcher()
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # NORMALIZACIÓN DE ESTADOS DE ENVÍO
 # ══════════════════════════════════════════════════════════════════════════════
@@ -496,19 +1842,64 @@ def get_short_status(status_code: str, description: str) -> str:
 # CLIENTE FEDEX
 # ══════════════════════════════════════════════════════════════════════════════
 
-class FedExClient:
-    """Cliente para interactuar con FedEx API"""
+class FedExAuthError(Exception):
+    """No se pudo obtener un token OAuth de FedEx"""
+
+
+class FedExTokenManager:
+    """Token OAuth de FedEx compartido por un par de credenciales.
+
+    Respeta expires_in, se renueva en segundo plano FEDEX_TOKEN_REFRESH_MARGIN segundos
+    antes de expirar y agrupa las renovaciones concurrentes en una sola petición
+    (single-flight), de modo que ninguna cotización o rastreo espera un OAuth de más.
+    """
+
+    def __init__(self, api_key: str, secret_key: str):
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.token: Optional[str] = None
+        self.expires_at = 0.0
+        self._inflight: Optional[asyncio.Task] = None
+        self._proactive: Optional[asyncio.Task] = None
+        self.started = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.proactive_refreshes = 0
+        self.forced_refreshes = 0
+        self.failures = 0
+
+    def _fresh(self) -> bool:
+        return bool(self.token) and time.monotonic() < self.expires_at - FEDEX_TOKEN_REFRESH_MARGIN
+
+    async def get(self, rejected: Optional[str] = None) -> Optional[str]:
+        """Token vigente; con rejected (token que recibió 401) fuerza una renovación,
+        salvo que otra petición ya lo haya reemplazado"""
+        if rejected is None:
+            if self._fresh():
+                self.hits += 1
+                return self.token
+            if self.token and time.monotonic() < self.expires_at:
+                # Dentro del margen: se usa el actual y se renueva en segundo plano
+                self.hits += 1
+                self._schedule_refresh(0)
+                return self.token
+            self.misses += 1
+        elif self.token and self.token != rejected:
+            self.hits += 1
+            return self.token
+        else:
+            self.forced_refreshes += 1
+            self.token = None
+        return await self._refresh()
 
-    def __init__(self, api_key=None, secret_key=None):
-        self.api_key = api_key or FEDEX_API_KEY
-        self.secret_key = secret_key or FEDEX_SECRET_KEY
-        self.base_url = FEDEX_BASE_URL
-        self.token = None
-        self.token_expires = None
+    async def _refresh(self) -> Optional[str]:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._fetch())
+        return await asyncio.shield(self._inflight)
 
-    async def get_token(self) -> str:
-        """Obtiene token de autenticación OAuth2"""
-        url = f"{self.base_url}/oauth/token"
+    async def _fetch(self) -> Optional[str]:
+        url = f"{FEDEX_BASE_URL}/oauth/token"
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         data = {
             "grant_type": "client_credentials",
@@ -517,21 +1908,310 @@ class FedExClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=15) as client:
-                response = await client.post(url, headers=headers, data=data)
+            response = await http_clients.get("fedex").post(url, headers=headers, data=data, timeout=15)
 
-                if response.status_code != 200:
-                    logger.error(f"❌ FedEx OAuth error: {response.status_code} - {response.text}")
-                    return None
+            if response.status_code != 200:
+                self.failures += 1
+                logger.error(f"❌ FedEx OAuth error: {response.status_code} - {response.text}")
+                return None
 
-                token_data = response.json()
-                self.token = token_data.get("access_token")
-                logger.info("✅ FedEx token obtenido")
-                return self.token
+            token_data = response.json()
+            try:
+                ttl = float(token_data.get("expires_in") or FEDEX_TOKEN_DEFAULT_TTL)
+            except (TypeError, ValueError):
+                ttl = FEDEX_TOKEN_DEFAULT_TTL
+            self.token = token_data.get("access_token")
+            self.expires_at = time.monotonic() + ttl
+            self.refreshes += 1
+            logger.info(f"✅ FedEx token obtenido ({self.label}, expira en {int(ttl)}s)")
+            self._schedule_refresh(max(ttl - FEDEX_TOKEN_REFRESH_MARGIN, 0))
+            return self.token
         except Exception as e:
+            self.failures += 1
             logger.error(f"❌ Error obteniendo token FedEx: {e}")
             return None
 
+    def _schedule_refresh(self, delay: float):
+        """Renovación proactiva: una sola tarea programada por par de credenciales"""
+        if self._proactive and not self._proactive.done():
+            if delay > 0:
+                self._proactive.cancel()
+            else:
+                return
+        self._proactive = asyncio.create_task(self._refresh_later(delay))
+
+    async def _refresh_later(self, delay: float):
+        await asyncio.sleep(delay)
+        if self._inflight and not self._inflight.done():
+            return
+        self.proactive_refreshes += 1
+        self._proactive = None
+        await self._refresh()
+
+    async def stop(self):
+        tasks = [t for t in (self._proactive, self._inflight) if t and not t.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @property
+    def label(self) -> str:
+        return f"{self.api_key[:6]}…" if self.api_key else "sin-credenciales"
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        hours = max(time.monotonic() - self.started, 1.0) / 3600
+        return {
+            "valid": self._fresh(),
+            "expires_in": max(int(self.expires_at - time.monotonic()), 0) if self.token else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "refreshes": self.refreshes,
+            "proactive_refreshes": self.proactive_refreshes,
+            "forced_refreshes": self.forced_refreshes,
+            "refreshes_per_hour": round(self.refreshes / hours, 2),
+            "failures": self.failures
+        }
+
+
+class FedExTokenRegistry:
+    """Un FedExTokenManager por par (api_key, secret_key), compartido por todos los clientes"""
+
+    def __init__(self):
+        self.managers: Dict[tuple, FedExTokenManager] = {}
+
+    def for_credentials(self, api_key: str, secret_key: str) -> FedExTokenManager:
+        key = (api_key, secret_key)
+        if key not in self.managers:
+            self.managers[key] = FedExTokenManager(api_key, secret_key)
+        return self.managers[key]
+
+    async def stop(self):
+        await asyncio.gather(*(m.stop() for m in self.managers.values()), return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {m.label: m.stats() for m in self.managers.values()}
+
+
+fedex_tokens = FedExTokenRegistry()
+
+
+def rate_cache_key(payload: Dict) -> str:
+    """Clave de un envío normalizado: mismo resultado para la misma consulta escrita distinto
+    (códigos postales con espacios, cajas en otro orden o con las medidas permutadas)"""
+    shipment = payload.get("requestedShipment", {})
+
+    def address(party: str) -> List[str]:
+        addr = shipment.get(party, {}).get("address", {})
+        return [
+            re.sub(r"[\s-]", "", str(addr.get("postalCode") or "")).upper(),
+            str(addr.get("countryCode") or "").upper()
+        ]
+
+    def number(value) -> float:
+        try:
+            return round(float(value or 0), 1)
+        except (TypeError, ValueError):
+            return -1.0  # Medida no numérica: FedEx la rechazará igual
+
+    packages = []
+    for item in shipment.get("requestedPackageLineItems", []):
+        dims = item.get("dimensions") or {}
+        sides = sorted(number(dims.get(side)) for side in ("length", "width", "height"))
+        packages.append([number(item.get("weight", {}).get("value")), sides])
+    packages.sort()
+
+    customs = shipment.get("customsClearanceDetail", {}).get("commodities", [{}])[0]
+    normalized = {
+        "account": payload.get("accountNumber", {}).get("value"),
+        "from": address("shipper"),
+        "to": address("recipient"),
+        "pickup": shipment.get("pickupType"),
+        "packages": packages,
+        "declared_value": number(customs.get("customsValue", {}).get("amount")),
+        "ship_date": shipment.get("shipDateStamp")
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+class RateCache:
+    """Respuestas de FedEx Rate API por envío normalizado: LRU en memoria + SQLite, con vencimiento.
+
+    Consultas idénticas simultáneas comparten una sola llamada a FedEx (single-flight) y
+    solo se guardan respuestas exitosas, así un error transitorio no queda cacheado.
+    """
+
+    def __init__(self, ttl: float = FEDEX_RATE_CACHE_TTL, max_size: int = FEDEX_RATE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()  # clave -> (respuesta, vence_en)
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stores = 0
+        self.errors = 0
+
+    def get(self, key: str) -> Optional[Dict]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] > time.time():
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            del self.entries[key]
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT response, expires_at FROM fedex_rate_cache WHERE cache_key = ? AND expires_at > ?",
+                (key, time.time())
+            )
+            row = cursor.fetchone()
+            if row:
+                cursor.execute("UPDATE fedex_rate_cache SET hits = hits + 1 WHERE cache_key = ?", (key,))
+                conn.commit()
+            conn.close()
+            if row:
+                response = json.loads(row[0])
+                self._remember(key, response, row[1])
+                self.db_hits += 1
+                return response
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Error consultando caché de tarifas: {e}")
+        return None
+
+    def _remember(self, key: str, response: Dict, expires_at: float):
+        self.entries[key] = (response, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def put(self, key: str, response: Dict):
+        now = time.time()
+        self._remember(key, response, now + self.ttl)
+        self.stores += 1
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            conn.execute(
+                """INSERT OR REPLACE INTO fedex_rate_cache (cache_key, response, created_at, expires_at, hits)
+                   VALUES (?, ?, ?, ?, 0)""",
+                (key, json.dumps(response), now, now + self.ttl)
+            )
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Error guardando tarifa en caché: {e}")
+
+    async def fetch(self, key: str, loader: Callable[[], Awaitable[Dict]]) -> Dict:
+        """Respuesta cacheada o una única llamada a loader() compartida por los concurrentes"""
+        if self.max_size <= 0:
+            return await loader()
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # Tarea propia: si quien la pidió se rinde (timeout), la respuesta igual queda en caché
+            pending = asyncio.create_task(self._load(key, loader))
+            self.inflight[key] = pending
+        return await asyncio.shield(pending)
+
+    async def _load(self, key: str, loader: Callable[[], Awaitable[Dict]]) -> Dict:
+        try:
+            response = await loader()
+            if "output" in response:
+                self.put(key, response)
+            return response
+        finally:
+            self.inflight.pop(key, None)
+
+    def purge_expired(self) -> int:
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM fedex_rate_cache WHERE expires_at < ?", (time.time(),))
+            deleted = cursor.rowcount
+            conn.commit()
+            conn.close()
+            if deleted:
+                logger.info(f"🧹 Caché de tarifas: {deleted} entradas expiradas eliminadas")
+            return deleted
+        except Exception as e:
+            logger.warning(f"⚠️ Error purgando caché de tarifas: {e}")
+            return 0
+
+    def stats(self) -> Dict:
+        hits = self.memory_hits + self.db_hits
+        lookups = hits + self.coalesced + self.misses
+        return {
+            "entries": len(self.entries),
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": round((hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            "fedex_calls_avoided": hits + self.coalesced,
+            "stores": self.stores,
+            "errors": self.errors,
+            "ttl_seconds": self.ttl
+        }
+
+
+rate_cache = RateCache()
+
+# Tope de peticiones simultáneas a FedEx (escenarios y cuentas en paralelo comparten el cupo)
+fedex_limiter = asyncio.Semaphore(FEDEX_MAX_IN_FLIGHT)
+
+
+class FedExClient:
+    """Cliente para interactuar con FedEx API"""
+
+    def __init__(self, api_key=None, secret_key=None):
+        self.api_key = api_key or FEDEX_API_KEY
+        self.secret_key = secret_key or FEDEX_SECRET_KEY
+        self.base_url = FEDEX_BASE_URL
+        self.tokens = fedex_tokens.for_credentials(self.api_key, self.secret_key)
+
+    @property
+    def token(self) -> Optional[str]:
+        return self.tokens.token
+
+    async def get_token(self, rejected: str = None) -> str:
+        """Obtiene token de autenticación OAuth2 (compartido por credenciales)"""
+        return await self.tokens.get(rejected)
+
+    async def post_authorized(self, url: str, payload: Dict, timeout: float = None) -> httpx.Response:
+        """POST con Bearer; ante un 401 renueva el token una sola vez y reintenta"""
+        token = await self.get_token()
+        if not token:
+            raise FedExAuthError("No se pudo autenticar con FedEx")
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            "X-locale": "en_US"
+        }
+        kwargs = {"timeout": timeout} if timeout else {}
+        client = http_clients.get("fedex")
+        async with fedex_limiter:
+            response = await client.post(url, headers=headers, json=payload, **kwargs)
+        if response.status_code == 401:
+            logger.info("🔄 Token FedEx rechazado, renovando y reintentando...")
+            token = await self.get_token(rejected=token)
+            if not token:
+                raise FedExAuthError("No se pudo autenticar con FedEx")
+            headers["Authorization"] = f"Bearer {token}"
+            async with fedex_limiter:
+                response = await client.post(url, headers=headers, json=payload, **kwargs)
+        return response
+
     async def get_rate_quote(
         self,
         origin_postal: str,
@@ -546,24 +2226,33 @@ class FedExClient:
         declared_value: float = None,
         shipping_date: str = None
     ) -> Dict:
-        """Obtiene cotización de FedEx con soporte para múltiples paquetes"""
+        """Obtiene cotización de FedEx con soporte para múltiples paquetes (vía caché de tarifas)"""
+        payload = self.build_rate_payload(
+            origin_postal, origin_country, dest_postal, dest_country, weight_kg,
+            packages=packages, dimensions=dimensions, account_number=account_number,
+            declared_value=declared_value, shipping_date=shipping_date
+        )
+        return await rate_cache.fetch(rate_cache_key(payload), lambda: self.request_rates(payload))
 
-        if not self.token:
-            token = await self.get_token()
-            if not token:
-                return {"error": "No se pudo autenticar con FedEx"}
+    def build_rate_payload(
+        self,
+        origin_postal: str,
+        origin_country: str,
+        dest_postal: str,
+        dest_country: str,
+        weight_kg: float,
+        packages: List[Dict] = None,
+        dimensions: Dict = None,
+        account_number: str = None,
+        declared_value: float = None,
+        shipping_date: str = None
+    ) -> Dict:
+        """Arma el payload de Rate API"""
 
         # Siempre usar cuenta Andean-2
         if account_number is None:
             account_number = FEDEX_ACCOUNT_WORLD
 
-        url = f"{self.base_url}/rate/v1/rates/quotes"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json",
-            "X-locale": "en_US"
-        }
-
         # Construir lista de paquetes
         package_line_items = []
 
@@ -649,19 +2338,25 @@ class FedExClient:
                 }]
             }
 
+        return payload
+
+    async def request_rates(self, payload: Dict) -> Dict:
+        """Consulta Rate API (sin caché)"""
+        url = f"{self.base_url}/rate/v1/rates/quotes"
+        shipment = payload["requestedShipment"]
+        declared_value = shipment.get("customsClearanceDetail", {}).get("commodities", [{}])[0].get("customsValue", {}).get("amount")
+
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                logger.info(f"📦 FedEx request: {len(package_line_items)} paquete(s), pickup=CONTACT_FEDEX_TO_SCHEDULE, declared_value={declared_value}")
-                response = await client.post(url, headers=headers, json=payload)
-
-                if response.status_code != 200:
-                    logger.error(f"❌ FedEx Rate error: {response.status_code} - {response.text}")
-                    if response.status_code == 401:
-                        logger.info("🔄 Renovando token FedEx...")
-                        await self.get_token()
-                    return {"error": f"FedEx API error: {response.status_code}", "details": response.text[:500]}
-
-                return response.json()
+            logger.info(f"📦 FedEx request: {shipment['packageCount']} paquete(s), pickup=CONTACT_FEDEX_TO_SCHEDULE, declared_value={declared_value}")
+            response = await self.post_authorized(url, payload)
+
+            if response.status_code != 200:
+                logger.error(f"❌ FedEx Rate error: {response.status_code} - {response.text}")
+                return {"error": f"FedEx API error: {response.status_code}", "details": response.text[:500]}
+
+            return response.json()
+        except FedExAuthError as e:
+            return {"error": str(e)}
         except Exception as e:
             logger.error(f"❌ Error consultando FedEx: {e}")
             return {"error": str(e)}
@@ -669,17 +2364,7 @@ class FedExClient:
     async def track_shipment(self, tracking_number: str) -> Dict:
         """Obtiene información de rastreo de FedEx Track API"""
 
-        if not self.token:
-            token = await self.get_token()
-            if not token:
-                return {"error": "No se pudo autenticar con el sistema de rastreo"}
-
         url = f"{self.base_url}/track/v1/trackingnumbers"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json",
-            "X-locale": "en_US"
-        }
 
         payload = {
             "includeDetailedScans": True,
@@ -693,21 +2378,16 @@ class FedExClient:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=15) as client:
-                response = await client.post(url, headers=headers, json=payload)
-
-                if response.status_code == 401:
-                    logger.info("🔄 Token expirado, renovando para tracking...")
-                    await self.get_token()
-                    headers["Authorization"] = f"Bearer {self.token}"
-                    response = await client.post(url, headers=headers, json=payload)
+            response = await self.post_authorized(url, payload, timeout=15)
 
-                if response.status_code != 200:
-                    logger.error(f"❌ FedEx Track error: {response.status_code} - {response.text[:500]}")
-                    return {"error": f"Error del sistema de rastreo: {response.status_code}"}
+            if response.status_code != 200:
+                logger.error(f"❌ FedEx Track error: {response.status_code} - {response.text[:500]}")
+                return {"error": f"Error del sistema de rastreo: {response.status_code}"}
 
-                logger.info(f"✅ FedEx Track API respondió exitosamente para {tracking_number}")
-                return response.json()
+            logger.info(f"✅ FedEx Track API respondió exitosamente para {tracking_number}")
+            return response.json()
+        except FedExAuthError:
+            return {"error": "No se pudo autenticar con el sistema de rastreo"}
         except Exception as e:
             logger.error(f"❌ Error rastreando con FedEx: {e}")
             return {"error": str(e)}
@@ -717,19 +2397,12 @@ class FedExClient:
 # PROCESADOR DE IA (CLAUDE)
 # ══════════════════════════════════════════════════════════════════════════════
 
-class SonIAProcessor:
-    """Procesador de mensajes usando Claude AI"""
-
-    SYSTEM_PROMPT = """Eres SonIA, la asistente virtual de BloomsPal.
+# El system prompt se arma por secciones según el estado del usuario y la fase de la
+# conversación; cada variante se precompila y es un prefijo cacheable por separado.
+PROMPT_SECTIONS = {
+    "core": """Eres SonIA, la asistente virtual de BloomsPal.
 Tu trabajo es ayudar a los clientes con cotizaciones de envío y rastreo de guías.
 
-⚠️ REGLA FUNDAMENTAL - FORMATO DE RESPUESTA:
-SIEMPRE responde en formato JSON válido. NUNCA respondas con texto plano.
-Cada respuesta DEBE ser un objeto JSON con "action" y "message".
-Para conversación general usa: {"action": "chat", "message": "tu respuesta"}
-Para registro de usuario usa: {"action": "register_user", "data": {...}, "message": "tu respuesta"}
-NO inventes respuestas de texto libre. TODO debe ir dentro del JSON.
-
 ESTILO DE COMUNICACIÓN:
 - Tono amigable, profesional y siempre dispuesta a ayudar
 - Respuestas CONCISAS y directas, sin rodeos innecesarios
@@ -737,7 +2410,25 @@ ESTILO DE COMUNICACIÓN:
 - No repitas información que el usuario ya te dio
 - Sé cálida pero eficiente
 
-INFORMACIÓN QUE NECESITAS EXTRAER (TODAS SON OBLIGATORIAS):
+Si es una conversación general:
+{
+    "action": "chat",
+    "message": "Tu respuesta conversacional"
+}""",
+
+    "format_json": """⚠️ REGLA FUNDAMENTAL - FORMATO DE RESPUESTA:
+SIEMPRE responde en formato JSON válido. NUNCA respondas con texto plano.
+Cada respuesta DEBE ser un objeto JSON con "action" y "message".
+Para conversación general usa: {"action": "chat", "message": "tu respuesta"}
+NO inventes respuestas de texto libre. TODO debe ir dentro del JSON.
+IMPORTANTE: Responde SIEMPRE con un JSON válido. No incluyas texto fuera del JSON.""",
+
+    "format_tools": """⚠️ REGLA FUNDAMENTAL - FORMATO DE RESPUESTA:
+Responde SIEMPRE llamando exactamente UNA herramienta. El nombre de la herramienta es la "action"
+y sus campos son los mismos que muestran los ejemplos JSON de este prompt (sin "action").
+Para conversación general usa la herramienta "chat". El texto para el usuario va en "message".""",
+
+    "quote": """INFORMACIÓN QUE NECESITAS EXTRAER (TODAS SON OBLIGATORIAS):
 1. País de ORIGEN del envío
 2. Ciudad de ORIGEN del envío
 3. Código postal de ORIGEN
@@ -800,16 +2491,24 @@ Si necesitas más información:
 {
     "action": "ask",
     "missing": ["origin_postal", "dimensions", "declared_value", "shipping_date"],
+    "draft": {"origin_city": "Medellin", "weight_kg": 25},
     "message": "Tu mensaje preguntando por la información faltante"
 }
 
-Si es una conversación general:
-{
-    "action": "chat",
-    "message": "Tu respuesta conversacional"
-}
+BORRADOR DE COTIZACIÓN:
+- Los datos ya dados se guardan en un borrador que recibes como BORRADOR DE COTIZACIÓN (conocidos / faltantes)
+- En "draft" (ask) o "data" (quote) envía SOLO los campos que el usuario dio o cambió en este mensaje
+- Ej: "lo mismo pero con 40kg" → {"action": "quote", "data": {"weight_kg": 40}, ...}
+- Si el usuario empieza una cotización distinta, agrega "new_quote": true
+- Después de presentar una cotización el borrador queda vacío; si el usuario pide "lo mismo pero..." agrega "from_last_quote": true y envía solo lo que cambia (la fecha pasada y, si cambia el peso, el valor declarado se vuelven a pedir)
+
+ESCENARIOS ALTERNATIVOS:
+- Si el usuario quiere comparar opciones ("¿y si lo mando el lunes?", "¿y en pallet?", "¿y en 2 cajas?"), cotiza todas en un solo turno con "scenarios"
+- Cada escenario lleva "label" y solo lo que cambia: "shipping_date", "is_pallet" y/o "packages" (un pallet consolidado = un solo paquete con sus medidas)
+- Ej: {"action": "quote", "data": {}, "scenarios": [{"label": "Salida lunes", "shipping_date": "2026-02-16"}, {"label": "En pallet", "is_pallet": true, "packages": [{"weight_kg": 25, "length": 120, "width": 100, "height": 80}]}], ...}
+- Si para una alternativa falta un dato (ej. medidas del pallet), pídelo con "ask" en lugar de suponerlo""",
 
-RASTREO DE ENVÍOS:
+    "tracking": """RASTREO DE ENVÍOS:
 Si el cliente envía un número de rastreo (9-30 dígitos) o pregunta por el estado de un envío/guía:
 {
     "action": "track",
@@ -820,15 +2519,9 @@ Si el cliente envía un número de rastreo (9-30 dígitos) o pregunta por el est
 CÓMO DETECTAR SOLICITUDES DE RASTREO:
 - El cliente envía un número largo (9-30 dígitos) sin contexto de cotización
 - Usa palabras como "rastrear", "tracking", "guía", "estado del envío", "dónde está mi paquete", "seguimiento"
-- Si el cliente pide rastreo pero NO da número, usa action "ask" pidiendo el tracking_number
-
-IMPORTANTE: Responde SIEMPRE con un JSON válido. No incluyas texto fuera del JSON.
-
-Siempre responde en español, de forma amigable y profesional.
-IMPORTANTE: NUNCA menciones FedEx ni ningún proveedor de transporte específico al cliente. Siempre habla de "BloomsPal" como el servicio de envío. No reveles nombres de transportistas.
-
+- Si el cliente pide rastreo pero NO da número, usa action "ask" pidiendo el tracking_number""",
 
-SOPORTE Y CONTACTO (ODOO):
+    "support": """SOPORTE Y CONTACTO (ODOO):
 IMPORTANTE - ANTES de crear CUALQUIER ticket (soporte u orden):
 - Si el CONTEXTO USUARIO ya tiene nombre y empresa, USA esos datos directamente. NO vuelvas a preguntar.
 - Solo pregunta nombre y empresa si NO están en el CONTEXTO USUARIO (usuario nuevo o datos faltantes).
@@ -856,7 +2549,17 @@ Si el cliente necesita:
     "message": "Buscando la información de contacto..."
 }
 
-3. OPORTUNIDAD DE VENTA - Cuando el cliente dice SÍ/proceder/confirmar después de una cotización:
+CÓMO DETECTAR SOLICITUDES DE SOPORTE:
+- Palabras: "queja", "reclamo", "problema", "soporte", "ayuda con mi envío", "daño", "pérdida", "retraso", "caso", "ticket"
+- PRIMERO pregunta el nombre del contacto y el nombre de la compañía
+- Luego pregunta detalles del problema
+- Solo cuando tengas toda la info, genera el JSON con action "support"
+
+CÓMO DETECTAR SOLICITUDES DE CONTACTO:
+- Palabras: "contactar", "hablar con", "teléfono de", "email de", "quién maneja", "responsable de"
+- Si piden hablar con alguien específico, busca el contacto""",
+
+    "order": """OPORTUNIDAD DE VENTA - Cuando el cliente dice SÍ/proceder/confirmar después de una cotización:
 IMPORTANTE: Si el CONTEXTO USUARIO ya tiene nombre y empresa, úsalos directamente para la orden. Solo pregunta si NO están disponibles.
 {
     "action": "order",
@@ -868,25 +2571,16 @@ IMPORTANTE: Si el CONTEXTO USUARIO ya tiene nombre y empresa, úsalos directamen
     "message": "Estoy registrando tu orden de envío..."
 }
 
-CÓMO DETECTAR SOLICITUDES DE SOPORTE:
-- Palabras: "queja", "reclamo", "problema", "soporte", "ayuda con mi envío", "daño", "pérdida", "retraso", "caso", "ticket"
-- PRIMERO pregunta el nombre del contacto y el nombre de la compañía
-- Luego pregunta detalles del problema
-- Solo cuando tengas toda la info, genera el JSON con action "support"
-
 CÓMO DETECTAR CONFIRMACIÓN DE ORDEN:
 - Palabras: "sí", "si", "proceder", "confirmar", "adelante", "sí quiero", "vamos", "acepto", "de acuerdo"
 - Solo aplica si previamente se presentó una cotización en la conversación
 - PRIMERO pregunta el nombre del contacto y el nombre de la compañía
-- Luego genera el JSON con action "order" incluyendo TODOS los detalles de la cotización
-
-CÓMO DETECTAR SOLICITUDES DE CONTACTO:
-- Palabras: "contactar", "hablar con", "teléfono de", "email de", "quién maneja", "responsable de"
-- Si piden hablar con alguien específico, busca el contacto
+- Luego genera el JSON con action "order" incluyendo TODOS los detalles de la cotización""",
 
+    "identity": """IDENTIFICACIÓN DE USUARIO:
+Al inicio de cada conversación se te proporcionará un CONTEXTO USUARIO con información del usuario.""",
 
-IDENTIFICACIÓN DE USUARIO:
-Al inicio de cada conversación se te proporcionará un CONTEXTO USUARIO con información del usuario.
+    "registration": """Para registro de usuario usa: {"action": "register_user", "data": {...}, "message": "tu respuesta"}
 
 Si el usuario es NUEVO (no registrado):
 - Preséntate como SonIA de BloomsPal
@@ -904,22 +2598,25 @@ Si el usuario es NUEVO (no registrado):
         "nickname": "apodo o vacío si no dio"
     },
     "message": "Tu mensaje amigable confirmando registro y preguntando en qué ayudar"
-}
+}""",
 
-Si un usuario REGISTRADO dice "soy empleado", "trabajo en BloomsPal", "soy de BloomsPal" o similar:
+    "claim_employee": """Si un usuario REGISTRADO dice "soy empleado", "trabajo en BloomsPal", "soy de BloomsPal" o similar:
 {
     "action": "claim_employee",
     "message": "Mensaje confirmando que se registró como empleado"
-}
+}""",
 
-Si un usuario registrado dice "llámame...", "dime...", "me gusta que me llamen...", "preféro que me digan..." o similar:
+    "nickname": """Si un usuario registrado dice "llámame...", "dime...", "me gusta que me llamen...", "preféro que me digan..." o similar:
 {
     "action": "update_nickname",
     "data": {
         "nickname": "el nuevo apodo que quiere"
     },
     "message": "Tu mensaje confirmando el cambio de nombre"
-}
+}""",
+
+    "rules": """Siempre responde en español, de forma amigable y profesional.
+IMPORTANTE: NUNCA menciones FedEx ni ningún proveedor de transporte específico al cliente. Siempre habla de "BloomsPal" como el servicio de envío. No reveles nombres de transportistas.
 
 REGLAS DE NOMBRE:
 - Si el contexto incluye un nombre/nickname, SIEMPRE úsalo para personalizar tus respuestas
@@ -928,18 +2625,641 @@ REGLAS DE NOMBRE:
 - Si el usuario ya está registrado, NO vuelvas a pedir su nombre
 
 Empresa: BloomsPal"""
+}
+
+# Secciones por estado del usuario ("pending_key": empleado cuya clave aún no está configurada).
+# "format" se resuelve a format_tools o format_json según CLAUDE_OUTPUT_MODE.
+PROMPT_LAYOUTS = {
+    "new": ["core", "format", "identity", "registration", "rules"],
+    "client": ["core", "format", "quote", "tracking", "support", "identity", "claim_employee", "nickname", "rules"],
+    "employee": ["core", "format", "quote", "tracking", "support", "identity", "nickname", "rules"],
+    "pending_key": ["core", "format", "quote", "tracking", "support", "identity", "nickname", "rules"]
+}
+
+# Secciones extra por fase (se insertan después de "support" en los estados que cotizan)
+PROMPT_PHASE_SECTIONS = {
+    "open": [],
+    "post_quote": ["order"]
+}
+
+FULL_PROMPT_LAYOUT = [
+    "core", "format", "quote", "tracking", "support", "order", "identity",
+    "registration", "claim_employee", "nickname", "rules"
+]
+
+
+def assemble_prompt(section_names: List[str]) -> str:
+    format_section = "format_json" if CLAUDE_OUTPUT_MODE == "json" else "format_tools"
+    return "\n\n".join(PROMPT_SECTIONS[format_section if name == "format" else name] for name in section_names)
+
+
+def _tool(name: str, description: str, properties: Dict = None, required: List[str] = None) -> Dict:
+    """Herramienta cuyo input es la respuesta de la acción (siempre con "message" para el usuario)"""
+    return {
+        "name": name,
+        "description": description,
+        "input_schema": {
+            "type": "object",
+            "properties": {**(properties or {}), "message": {"type": "string", "description": "Texto para el usuario"}},
+            "required": (required or []) + ["message"]
+        }
+    }
+
+
+def _object(properties: Dict, required: List[str] = None) -> Dict:
+    return {"type": "object", "properties": properties, "required": required if required is not None else list(properties)}
+
+
+_STRING = {"type": "string"}
+_NUMBER = {"type": "number"}
+
+QUOTE_DATA_PROPERTIES = {
+    "origin_country": {"type": "string", "description": "Código ISO de 2 letras"},
+    "origin_city": _STRING,
+    "origin_postal": _STRING,
+    "destination_country": {"type": "string", "description": "Código ISO de 2 letras"},
+    "destination_city": _STRING,
+    "destination_postal": _STRING,
+    "weight_kg": _NUMBER,
+    "is_pallet": {"type": "boolean"},
+    "num_boxes": {"type": "integer"},
+    "packages": {"type": "array", "items": _object(
+        {"weight_kg": _NUMBER, "length": _NUMBER, "width": _NUMBER, "height": _NUMBER}
+    )},
+    "declared_value": {"type": "number", "description": "USD"},
+    "shipping_date": {"type": "string", "description": "YYYY-MM-DD"}
+}
+
+_FROM_LAST_QUOTE = {
+    "type": "boolean",
+    "description": "true si el usuario pide lo mismo que la ÚLTIMA COTIZACIÓN con cambios (ej. \"lo mismo con 40kg\")"
+}
+
+# Una herramienta por acción; el input tiene la misma forma que el JSON del modo legado
+SONIA_TOOLS = {
+    "chat": _tool("chat", "Conversación general o respuesta que no requiere ninguna otra acción."),
+    "ask": _tool(
+        "ask", "Pedir al usuario la información que falta para cotizar o rastrear.",
+        {
+            "missing": {"type": "array", "items": _STRING},
+            "draft": {**_object(QUOTE_DATA_PROPERTIES, []),
+                      "description": "Solo los datos de cotización que el usuario dio o cambió en este mensaje"},
+            "new_quote": {"type": "boolean", "description": "true si empieza una cotización distinta (descarta el borrador)"},
+            "from_last_quote": _FROM_LAST_QUOTE
+        },
+        ["missing"]
+    ),
+    "quote": _tool(
+        "quote", "Cotizar un envío cuando, junto con el BORRADOR DE COTIZACIÓN, ya se tienen TODOS los datos obligatorios.",
+        {
+            "data": {**_object(QUOTE_DATA_PROPERTIES, []),
+                     "description": "Datos nuevos o modificados; los demás se toman del borrador"},
+            "new_quote": {"type": "boolean", "description": "true si es una cotización distinta (descarta el borrador)"},
+            "from_last_quote": _FROM_LAST_QUOTE,
+            "scenarios": {
+                "type": "array",
+                "items": _object({
+                    "label": {"type": "string", "description": "Nombre corto, ej. \"Salida lunes\" o \"En pallet\""},
+                    "shipping_date": {"type": "string", "description": "YYYY-MM-DD"},
+                    "is_pallet": {"type": "boolean"},
+                    "packages": {**QUOTE_DATA_PROPERTIES["packages"],
+                                 "description": "Paquetes de esta alternativa (ej. un solo pallet consolidado o cajas divididas)"}
+                }, ["label"]),
+                "description": "Alternativas a comparar con la cotización base; solo los campos que cambian"
+            }
+        },
+        ["data"]
+    ),
+    "track": _tool(
+        "track", "Rastrear un envío con su número de guía.",
+        {"tracking_number": {"type": "string", "description": "Solo dígitos"}}, ["tracking_number"]
+    ),
+    "support": _tool(
+        "support", "Crear un caso de soporte (ya con nombre de contacto y compañía).",
+        {"data": _object({"subject": _STRING, "description": _STRING, "company_name": _STRING, "contact_name": _STRING})},
+        ["data"]
+    ),
+    "contact": _tool(
+        "contact", "Buscar un contacto de BloomsPal.",
+        {"data": _object({"query": _STRING})}, ["data"]
+    ),
+    "order": _tool(
+        "order", "Registrar la orden cuando el cliente confirma una cotización presentada.",
+        {"data": _object({"company_name": _STRING, "contact_name": _STRING, "quote_summary": _STRING})}, ["data"]
+    ),
+    "register_user": _tool(
+        "register_user", "Registrar a un usuario nuevo en cuanto dio su nombre completo y empresa.",
+        {"data": _object({"nombre": _STRING, "cliente": _STRING, "nickname": _STRING}, ["nombre", "cliente"])},
+        ["data"]
+    ),
+    "claim_employee": _tool("claim_employee", "El usuario registrado dice que es empleado de BloomsPal."),
+    "update_nickname": _tool(
+        "update_nickname", "El usuario registrado pide que lo llamen de otra forma.",
+        {"data": _object({"nickname": _STRING})}, ["data"]
+    )
+}
+
+# Herramientas que habilita cada sección del prompt
+SECTION_TOOLS = {
+    "core": ["chat"],
+    "quote": ["quote", "ask"],
+    "tracking": ["track"],
+    "support": ["support", "contact"],
+    "order": ["order"],
+    "registration": ["register_user"],
+    "claim_employee": ["claim_employee"],
+    "nickname": ["update_nickname"]
+}
+
+
+def tools_for_sections(section_names: List[str]) -> List[Dict]:
+    return [SONIA_TOOLS[tool] for name in section_names for tool in SECTION_TOOLS.get(name, [])]
+
+
+def prompt_variant_layouts() -> Dict[str, List[str]]:
+    """Lista de secciones de cada variante ("estado/fase"), más la variante completa"""
+    layouts = {"full": FULL_PROMPT_LAYOUT}
+    for state, sections in PROMPT_LAYOUTS.items():
+        phases = PROMPT_PHASE_SECTIONS if "quote" in sections else {"open": []}
+        for phase, extra in phases.items():
+            if extra:
+                position = sections.index("support") + 1
+                layouts[f"{state}/{phase}"] = sections[:position] + extra + sections[position:]
+            else:
+                layouts[f"{state}/{phase}"] = list(sections)
+    return layouts
+
+
+def prompt_fingerprint(prompt: str, tools: List[Dict]) -> str:
+    return hashlib.sha256((prompt + json.dumps(tools, sort_keys=True)).encode("utf-8")).hexdigest()[:16]
+
+
+def conversation_phase(conversation_history: Optional[List[Dict]], quote_presented: bool = False) -> str:
+    """"post_quote" si SonIA ya presentó una cotización vigente.
+
+    quote_presented viene del estado persistido (última cotización, ver get_quote_state), así
+    la fase no depende de que la cotización siga dentro de los mensajes recientes.
+    """
+    if quote_presented:
+        return "post_quote"
+    for msg in reversed((conversation_history or [])[-6:]):
+        if msg.get("role") == "assistant" and "COTIZACIÓN" in msg.get("content", ""):
+            return "post_quote"
+    return "open"
+
+
+class ClaudeUsageStats:
+    """Tokens por tipo de llamada a Claude, incluidos los de prompt caching"""
+
+    def __init__(self):
+        self.calls: Dict[str, Dict[str, int]] = {}
+
+    def record(self, kind: str, usage) -> Dict[str, int]:
+        tokens = {
+            "input_tokens": getattr(usage, "input_tokens", 0) or 0,
+            "output_tokens": getattr(usage, "output_tokens", 0) or 0,
+            "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+            "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0
+        }
+        totals = self.calls.setdefault(kind, {"calls": 0, "cache_hits": 0, **{key: 0 for key in tokens}})
+        totals["calls"] += 1
+        if tokens["cache_read_input_tokens"]:
+            totals["cache_hits"] += 1
+        for key, value in tokens.items():
+            totals[key] += value
+        logger.info(
+            f"🧠 Tokens {kind}: in={tokens['input_tokens']} out={tokens['output_tokens']} "
+            f"cache_read={tokens['cache_read_input_tokens']} cache_write={tokens['cache_creation_input_tokens']}"
+        )
+        return tokens
+
+    def stats(self) -> Dict:
+        result = {}
+        for kind, totals in self.calls.items():
+            prompt_tokens = (totals["input_tokens"] + totals["cache_read_input_tokens"]
+                             + totals["cache_creation_input_tokens"])
+            result[kind] = {
+                **totals,
+                "cache_hit_rate": round(totals["cache_hits"] / totals["calls"], 4) if totals["calls"] else 0.0,
+                "cached_prompt_share": round(totals["cache_read_input_tokens"] / prompt_tokens, 4) if prompt_tokens else 0.0
+            }
+        return result
+
+
+claude_usage = ClaudeUsageStats()
+
+
+class ClaudeOutputStats:
+    """Respuestas de Claude que no se pudieron interpretar y llamadas extra por turno"""
+
+    def __init__(self):
+        self.turns = 0
+        self.parsed = 0
+        self.failures: Dict[str, int] = {}
+        self.extra_calls = 0
+
+    def record_success(self):
+        self.turns += 1
+        self.parsed += 1
+
+    def record_failure(self, reason: str):
+        self.turns += 1
+        self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    def record_extra_call(self):
+        self.extra_calls += 1
+
+    def stats(self) -> Dict:
+        failed = sum(self.failures.values())
+        return {
+            "mode": CLAUDE_OUTPUT_MODE,
+            "turns": self.turns,
+            "parse_failures": failed,
+            "parse_failure_rate": round(failed / self.turns, 4) if self.turns else 0.0,
+            "failures_by_reason": self.failures,
+            "extra_calls": self.extra_calls,
+            "extra_call_rate": round(self.extra_calls / self.turns, 4) if self.turns else 0.0
+        }
+
+
+claude_output = ClaudeOutputStats()
+
+
+class ModelRouter:
+    """Elige el modelo de cada turno según intención, estado del usuario y complejidad.
+
+    El modelo pequeño atiende saludos, agradecimientos, confirmaciones, cambios de apodo,
+    números de guía sueltos y el registro de usuarios nuevos; todo lo que huela a cotización (o a una orden que
+    debe resumir una cotización) va al modelo grande, que también es el valor por defecto.
+    """
+
+    SMALL_TALK_PATTERN = re.compile(
+        r"^\W*(hola|buen[oa]s?( d[ií]as| tardes| noches)?|hey|hi|hello|gracias|muchas gracias|mil gracias|thanks|"
+        r"ok|okay|vale|listo|perfecto|genial|excelente|s[ií]|no|claro|de acuerdo|dale|chao|adi[oó]s|bye)"
+        r"([\s,!.]+(hola|gracias|sonia|muchas|ok|perfecto|s[ií]|claro|por favor|👍|🙏|😊))*\W*$",
+        re.IGNORECASE
+    )
+    NICKNAME_PATTERN = re.compile(r"\b(ll[aá]mame|dime|me dicen|prefiero que me (digan|llamen)|me gusta que me (digan|llamen))\b", re.IGNORECASE)
+    QUOTE_PATTERN = re.compile(
+        r"cotiz|quote|\bkg\b|kilo|\bcajas?\b|pallet|palet|dimensi|\d+\s*[x×]\s*\d+|\bcm\b|peso|valor declarado|"
+        r"c[oó]digo postal|\bzip\b|env[ií]o|enviar|despach",
+        re.IGNORECASE
+    )
+    QUOTE_FOLLOWUP_PATTERN = re.compile(r"cotiz|peso|dimensi|c[oó]digo postal|valor declarado|fecha de salida|cajas|paquetes", re.IGNORECASE)
+    TRACKING_PATTERN = re.compile(r"^\W*(rastre\w*|tracking|gu[ií]a)?\W*\d[\d\s-]{8,34}\d\W*$", re.IGNORECASE)
+    MAX_SMALL_WORDS = 30
+
+    def __init__(self):
+        self.routes: Dict[str, int] = {}
+        self.models: Dict[str, Dict[str, float]] = {}
+
+    def route(self, text: str, user_state: Optional[str] = None,
+              conversation_history: List[Dict] = None) -> tuple:
+        """Retorna (modelo, motivo) para un turno de chat"""
+        if not MODEL_ROUTING:
+            return CLAUDE_MODEL_LARGE, "routing_disabled"
+
+        words = len(text.split())
+        last_assistant = next(
+            (m.get("content", "") for m in reversed(conversation_history or []) if m.get("role") == "assistant"), ""
+        )
+        if self.QUOTE_PATTERN.search(text):
+            return CLAUDE_MODEL_LARGE, "quote"
+        if last_assistant and self.QUOTE_FOLLOWUP_PATTERN.search(last_assistant):
+            # Respuesta a una pregunta de cotización, o confirmación de una cotización (orden con resumen)
+            return CLAUDE_MODEL_LARGE, "quote_followup"
+        if words <= self.MAX_SMALL_WORDS and self.NICKNAME_PATTERN.search(text):
+            return CLAUDE_MODEL_SMALL, "nickname"
+        if self.SMALL_TALK_PATTERN.match(text.strip()):
+            return CLAUDE_MODEL_SMALL, "small_talk"
+        if self.TRACKING_PATTERN.match(text.strip()):
+            return CLAUDE_MODEL_SMALL, "tracking"
+        if user_state == "new" and words <= self.MAX_SMALL_WORDS:
+            return CLAUDE_MODEL_SMALL, "registration"
+        return CLAUDE_MODEL_LARGE, "default"
+
+    def record_route(self, reason: str):
+        self.routes[reason] = self.routes.get(reason, 0) + 1
+
+    def record_call(self, model: str, latency: float, usage=None, error: bool = False):
+        totals = self.models.setdefault(model, {
+            "calls": 0, "errors": 0, "latency_total": 0.0, "latency_max": 0.0, "input_tokens": 0, "output_tokens": 0
+        })
+        totals["calls"] += 1
+        totals["latency_total"] += latency
+        totals["latency_max"] = max(totals["latency_max"], latency)
+        if error:
+            totals["errors"] += 1
+        if usage is not None:
+            totals["input_tokens"] += (getattr(usage, "input_tokens", 0) or 0) + (getattr(usage, "cache_read_input_tokens", 0) or 0)
+            totals["output_tokens"] += getattr(usage, "output_tokens", 0) or 0
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": MODEL_ROUTING,
+            "large": CLAUDE_MODEL_LARGE,
+            "small": CLAUDE_MODEL_SMALL,
+            "transcription": CLAUDE_MODEL_TRANSCRIPTION,
+            "routes": self.routes,
+            "models": {
+                model: {
+                    "calls": totals["calls"],
+                    "errors": totals["errors"],
+                    "avg_latency_ms": round(totals["latency_total"] / totals["calls"] * 1000, 1) if totals["calls"] else 0.0,
+                    "max_latency_ms": round(totals["latency_max"] * 1000, 1),
+                    "input_tokens": totals["input_tokens"],
+                    "output_tokens": totals["output_tokens"]
+                }
+                for model, totals in self.models.items()
+            }
+        }
+
+
+model_router = ModelRouter()
+
+
+class AnthropicUnavailable(Exception):
+    """La llamada a Claude no se intentó o se abandonó (circuito abierto, cola o plazo vencidos)"""
+
+
+class AnthropicGateway:
+    """Punto único de salida hacia la API de Anthropic.
+
+    - Semáforo de llamadas en vuelo (ANTHROPIC_MAX_IN_FLIGHT) con espera máxima en cola
+    - Reintentos con backoff exponencial y jitter que respetan el header Retry-After
+    - Circuit breaker: tras ANTHROPIC_BREAKER_THRESHOLD fallos seguidos del servicio (5xx,
+      529, red, timeout) se rechaza de inmediato durante ANTHROPIC_BREAKER_COOLDOWN y luego
+      se deja pasar una sola llamada de prueba
+    El SDK se crea con max_retries=0 para que los reintentos sólo ocurran aquí.
+    """
+
+    def __init__(self, client: anthropic.AsyncAnthropic):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(ANTHROPIC_MAX_IN_FLIGHT)
+        self.in_flight = 0
+        self.queued = 0
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self.probe_in_flight = False
+        self.calls = 0
+        self.successes = 0
+        self.attempts = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.rejected_open = 0
+        self.queue_timeouts = 0
+        self.breaker_opened = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.model_latency_total = 0.0
+        self.model_latency_max = 0.0
+
+    @property
+    def state(self) -> str:
+        if self.opened_until == 0.0:
+            return "closed"
+        return "open" if time.monotonic() < self.opened_until else "half_open"
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, (anthropic.RateLimitError, anthropic.InternalServerError,
+                              anthropic.APIConnectionError)):
+            return True
+        return isinstance(error, anthropic.APIStatusError) and error.status_code in (408, 409)
+
+    @staticmethod
+    def _is_service_failure(error: Exception) -> bool:
+        """Fallos que indican API degradada (un 429 es límite de la cuenta, no cuenta para el circuito)"""
+        return isinstance(error, (anthropic.InternalServerError, anthropic.APIConnectionError))
+
+    def _retry_after(self, error: Exception) -> Optional[float]:
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        return parse_retry_after(response.headers.get("retry-after"))
+
+    def _on_success(self):
+        self.consecutive_failures = 0
+        if self.opened_until:
+            logger.info("🟢 Circuito de Anthropic cerrado - API respondiendo de nuevo")
+        self.opened_until = 0.0
+
+    def _on_failure(self, error: Exception):
+        if not self._is_service_failure(error):
+            return
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= ANTHROPIC_BREAKER_THRESHOLD:
+            self.opened_until = time.monotonic() + ANTHROPIC_BREAKER_COOLDOWN
+            self.breaker_opened += 1
+            logger.error(
+                f"🔴 Circuito de Anthropic abierto por {ANTHROPIC_BREAKER_COOLDOWN:.0f}s "
+                f"({self.consecutive_failures} fallos seguidos: {error})"
+            )
+
+    def _admit(self):
+        """Rechaza de inmediato si el circuito está abierto (o ya hay una prueba en curso)"""
+        state = self.state
+        if state == "open" or (state == "half_open" and self.probe_in_flight):
+            self.rejected_open += 1
+            raise AnthropicUnavailable("Circuito de Anthropic abierto")
+        if state == "half_open":
+            self.probe_in_flight = True
+            return True
+        return False
+
+    async def create(self, **params) -> tuple:
+        """messages.create protegido. Retorna (respuesta, espera_en_cola, latencia_del_modelo)."""
+        self.calls += 1
+        deadline = time.monotonic() + ANTHROPIC_REQUEST_DEADLINE
+        queue_wait = 0.0
+        attempt = 0
+        while True:
+            attempt += 1
+            probe = self._admit()
+            try:
+                queued_at = time.monotonic()
+                self.queued += 1
+                try:
+                    timeout = min(ANTHROPIC_QUEUE_TIMEOUT, max(0.0, deadline - queued_at))
+                    await asyncio.wait_for(self.semaphore.acquire(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    self.queue_timeouts += 1
+                    raise AnthropicUnavailable(f"Sin cupo para llamar a Claude tras {timeout:.0f}s en cola")
+                finally:
+                    self.queued -= 1
+                wait = time.monotonic() - queued_at
+                queue_wait += wait
+                self.queue_wait_total += wait
+                self.queue_wait_max = max(self.queue_wait_max, wait)
+
+                self.in_flight += 1
+                self.attempts += 1
+                started = time.monotonic()
+                try:
+                    response = await self.client.messages.create(**params)
+                finally:
+                    self.in_flight -= 1
+                    self.semaphore.release()
+            except AnthropicUnavailable:
+                raise
+            except Exception as e:
+                self._on_failure(e)
+                if isinstance(e, anthropic.RateLimitError):
+                    self.rate_limited += 1
+                backoff = min(ANTHROPIC_BACKOFF_MAX, ANTHROPIC_BACKOFF_BASE * (2 ** (attempt - 1)))
+                delay = random.uniform(backoff / 2, backoff)
+                retry_after = self._retry_after(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                if (not self._is_retryable(e) or attempt >= ANTHROPIC_MAX_ATTEMPTS
+                        or time.monotonic() + delay > deadline or self.state == "open"):
+                    self.failures += 1
+                    raise
+                self.retries += 1
+                logger.warning(f"⚠️ Claude falló (intento {attempt}/{ANTHROPIC_MAX_ATTEMPTS}): {e} - reintento en {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                if probe:
+                    self.probe_in_flight = False
+
+            latency = time.monotonic() - started
+            self.successes += 1
+            self.model_latency_total += latency
+            self.model_latency_max = max(self.model_latency_max, latency)
+            self._on_success()
+            return response, queue_wait, latency
+
+    def stats(self) -> Dict:
+        return {
+            "circuit": self.state,
+            "max_in_flight": ANTHROPIC_MAX_IN_FLIGHT,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "calls": self.calls,
+            "successes": self.successes,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "failures": self.failures,
+            "rejected_circuit_open": self.rejected_open,
+            "queue_timeouts": self.queue_timeouts,
+            "circuit_opened": self.breaker_opened,
+            "avg_queue_wait_ms": round(self.queue_wait_total / self.attempts * 1000, 1) if self.attempts else 0.0,
+            "max_queue_wait_ms": round(self.queue_wait_max * 1000, 1),
+            "avg_model_latency_ms": round(self.model_latency_total / self.successes * 1000, 1) if self.successes else 0.0,
+            "max_model_latency_ms": round(self.model_latency_max * 1000, 1)
+        }
+
+
+class SonIAProcessor:
+    """Procesador de mensajes usando Claude AI"""
+
+    PROMPT_VARIANT_SECTIONS = prompt_variant_layouts()
+    PROMPT_VARIANTS = {name: assemble_prompt(sections) for name, sections in PROMPT_VARIANT_SECTIONS.items()}
+    PROMPT_VARIANT_TOOLS = {name: tools_for_sections(sections) for name, sections in PROMPT_VARIANT_SECTIONS.items()}
+    # Huella de cada variante (prompt + herramientas): cambia si cambia el prompt e invalida la caché de respuestas
+    PROMPT_VARIANT_HASHES = {
+        name: prompt_fingerprint(text, tools)
+        for (name, text), tools in zip(PROMPT_VARIANTS.items(), PROMPT_VARIANT_TOOLS.values())
+    }
+    SYSTEM_PROMPT = PROMPT_VARIANTS["full"]
 
     def __init__(self):
         # CORREGIDO: Usar cliente ASÍNCRONO en vez de síncrono
-        self.client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+        self.client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, max_retries=0)
+        self.gateway = AnthropicGateway(self.client)
+        self.prompt_token_counts: Dict[str, tuple] = {}  # variante -> (tokens, exacto)
+
+    def select_prompt(self, user_state: Optional[str], conversation_history: List[Dict] = None,
+                      quote_presented: bool = False) -> str:
+        """Variante del system prompt para el estado del usuario y la fase de la conversación"""
+        if not MODULAR_PROMPTS or user_state not in PROMPT_LAYOUTS:
+            return "full"
+        variant = f"{user_state}/{conversation_phase(conversation_history, quote_presented)}"
+        return variant if variant in self.PROMPT_VARIANTS else f"{user_state}/open"
+
+    def build_system(self, user_context: str = "", variant: str = "full", summary: str = "",
+                     quote_draft: str = "") -> List[Dict]:
+        """System prompt en bloques: el prompt fijo primero y marcado para caché de Anthropic,
+        el contexto del usuario, el resumen y el borrador (cambian en cada turno) después,
+        fuera del prefijo cacheado."""
+        blocks = [{"type": "text", "text": self.PROMPT_VARIANTS[variant], "cache_control": {"type": "ephemeral"}}]
+        if user_context:
+            blocks.append({"type": "text", "text": user_context})
+        if summary:
+            blocks.append({
+                "type": "text",
+                "text": f"RESUMEN DE LA CONVERSACIÓN (mensajes anteriores a los recientes, datos ya confirmados):\n{summary}"
+            })
+        if quote_draft:
+            blocks.append({"type": "text", "text": quote_draft})
+        return blocks
+
+    async def prompt_report(self) -> Dict:
+        """Tokens de cada variante del system prompt y ahorro frente al prompt completo"""
+        if not self.prompt_token_counts:
+            for variant, text in self.PROMPT_VARIANTS.items():
+                try:
+                    tool_params = {} if CLAUDE_OUTPUT_MODE == "json" else {"tools": self.PROMPT_VARIANT_TOOLS[variant]}
+                    counted = await self.client.messages.count_tokens(
+                        model=CLAUDE_MODEL_LARGE,
+                        system=[{"type": "text", "text": text}],
+                        messages=[{"role": "user", "content": "hola"}],
+                        **tool_params
+                    )
+                    self.prompt_token_counts[variant] = (counted.input_tokens, True)
+                except Exception as e:
+                    logger.warning(f"⚠️ No se pudieron contar tokens de la variante {variant}: {e}")
+                    self.prompt_token_counts = {}
+                    break
+        full_tokens = self.prompt_token_counts.get("full", (len(self.SYSTEM_PROMPT) // 4, False))[0]
+        report = {}
+        for variant, text in self.PROMPT_VARIANTS.items():
+            tokens, exact = self.prompt_token_counts.get(variant, (len(text) // 4, False))
+            report[variant] = {
+                "sections": self.PROMPT_VARIANT_SECTIONS[variant],
+                "tools": [tool["name"] for tool in self.PROMPT_VARIANT_TOOLS[variant]],
+                "chars": len(text),
+                "tokens": tokens,
+                "exact": exact,
+                "cacheable": tokens >= 1024,  # Mínimo de Anthropic para cachear un prefijo (Sonnet)
+                "saving_vs_full": round(1 - tokens / full_tokens, 4) if full_tokens else 0.0
+            }
+        return {"modular_prompts": MODULAR_PROMPTS, "output_mode": CLAUDE_OUTPUT_MODE, "variants": report}
 
-    async def process_text(self, text: str, conversation_history: List[Dict] = None, user_context: str = "") -> Dict:
-        """Procesa un mensaje de texto con Claude AI"""
+    async def create_message(self, kind: str, model: str, **params):
+        """messages.create vía el gateway, con latencia y tokens registrados por modelo y tipo de llamada"""
+        started = time.monotonic()
+        try:
+            response, queue_wait, latency = await self.gateway.create(model=model, **params)
+        except AnthropicUnavailable:
+            raise
+        except Exception:
+            model_router.record_call(model, time.monotonic() - started, error=True)
+            raise
+        model_router.record_call(model, latency, response.usage)
+        claude_usage.record(kind, response.usage)
+        logger.info(f"⏱️ {kind} con {model}: {latency * 1000:.0f} ms (cola {queue_wait * 1000:.0f} ms)")
+        return response
+
+    async def process_text(self, text: str, conversation_history: List[Dict] = None, user_context: str = "",
+                           user_state: Optional[str] = None, summary: str = "", quote_draft: str = "",
+                           quote_presented: bool = False) -> Dict:
+        """Procesa un mensaje de texto con Claude AI.
+
+        user_state ("new", "client", "employee", "pending_key") elige las secciones del
+        system prompt; sin estado se usa el prompt completo. summary es el resumen de los
+        mensajes que ya salieron de la ventana reciente y quote_draft el bloque conocido /
+        faltante del borrador de cotización. quote_presented indica que hay una cotización
+        vigente (habilita la sección y la herramienta "order").
+        """
         messages = []
 
         # Agregar historial de conversación
         if conversation_history:
-            for msg in conversation_history[-6:]:  # Últimos 6 mensajes
+            for msg in conversation_history[-CONVERSATION_WINDOW:]:  # Ventana reciente; lo anterior va en el resumen
                 messages.append({
                     "role": msg["role"],
                     "content": msg["content"]
@@ -947,53 +3267,107 @@ Empresa: BloomsPal"""
 
         # Agregar mensaje actual
         messages.append({"role": "user", "content": text})
+        variant = self.select_prompt(user_state, conversation_history, quote_presented)
 
         try:
             # CORREGIDO: Ahora usa await correctamente con AsyncAnthropic
-            response = await self.client.messages.create(
-                model="claude-sonnet-4-20250514",
+            if CLAUDE_OUTPUT_MODE == "json":
+                tool_params = {}
+            else:
+                tool_params = {
+                    "tools": self.PROMPT_VARIANT_TOOLS[variant],
+                    "tool_choice": {"type": "any", "disable_parallel_tool_use": True}
+                }
+            model, reason = model_router.route(text, user_state, conversation_history)
+            model_router.record_route(reason)
+            logger.info(f"🧭 Modelo {model} ({reason})")
+            response = await self.create_message(
+                f"chat/{variant}",
+                model,
                 max_tokens=1024,
-                system=(user_context + "\n\n" + self.SYSTEM_PROMPT) if user_context else self.SYSTEM_PROMPT,
-                messages=messages
+                system=self.build_system(user_context, variant, summary, quote_draft),
+                messages=messages,
+                **tool_params
             )
 
             if not response.content:
                 logger.error("❌ Claude devolvió respuesta vacía")
+                claude_output.record_failure("empty")
                 return {"action": "chat", "message": "Disculpa, tuve un problema procesando tu mensaje. ¿Podrías repetirlo?"}
 
-            response_text = response.content[0].text
-            logger.info(f"🤖 Claude respondió: {response_text[:100]}...")
-
-            # Intentar parsear como JSON
-            try:
-                if "{" in response_text and "}" in response_text:
-                    start = response_text.find("{")
-                    end = response_text.rfind("}") + 1
-                    json_str = response_text[start:end]
-                    return json.loads(json_str)
-            except json.JSONDecodeError:
-                logger.warning(f"⚠️ Claude no devolvió JSON válido, usando como chat")
-
-            # Si no es JSON, devolver como chat
-            return {
-                "action": "chat",
-                "message": response_text
-            }
+            if tool_params:
+                result = self.parse_tool_response(response, variant)
+            else:
+                result = self.parse_json_response(response.content[0].text)
+            usage = response.usage
+            result["_tokens"] = sum(
+                getattr(usage, field, 0) or 0
+                for field in ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+            )
+            return result
 
         except anthropic.AuthenticationError:
             logger.error("❌ ANTHROPIC_API_KEY es inválida - verificar en Railway")
             return {"action": "chat", "message": "Disculpa, tenemos un problema técnico. Por favor intenta más tarde."}
         except anthropic.RateLimitError:
-            logger.error("❌ Rate limit alcanzado en Anthropic API")
+            logger.error("❌ Rate limit alcanzado en Anthropic API (reintentos agotados)")
+            return {"action": "chat", "message": "Estamos recibiendo muchas consultas. Por favor intenta en unos minutos."}
+        except AnthropicUnavailable as e:
+            logger.error(f"❌ Claude no disponible: {e}")
             return {"action": "chat", "message": "Estamos recibiendo muchas consultas. Por favor intenta en unos minutos."}
         except Exception as e:
             logger.error(f"❌ Error procesando con Claude: {e}")
             return {"action": "chat", "message": "Disculpa, tuve un problema procesando tu mensaje. ¿Podrías repetirlo?"}
 
-    async def process_audio(self, audio_data: bytes, mime_type: str = "audio/ogg") -> Optional[str]:
-        """Transcribe audio usando Claude"""
+    def parse_tool_response(self, response, variant: str) -> Dict:
+        """Convierte la llamada a herramienta en la respuesta de acción {"action": ..., ...}"""
+        tool_call = next((block for block in response.content if block.type == "tool_use"), None)
+        response_text = "".join(block.text for block in response.content if block.type == "text").strip()
+
+        if tool_call is None or not isinstance(tool_call.input, dict):
+            logger.warning(f"⚠️ Claude no llamó ninguna herramienta (stop_reason={response.stop_reason}), usando como chat")
+            claude_output.record_failure("no_tool_call")
+            return {"action": "chat", "message": response_text}
+
+        schema = SONIA_TOOLS.get(tool_call.name, {}).get("input_schema")
+        missing = [key for key in (schema or {}).get("required", []) if key not in tool_call.input]
+        if schema is None or missing:
+            logger.warning(f"⚠️ Herramienta {tool_call.name} inválida o incompleta (faltan: {missing})")
+            claude_output.record_failure("invalid_input")
+        else:
+            claude_output.record_success()
+
+        logger.info(f"🤖 Claude llamó {tool_call.name} ({variant}): {str(tool_call.input)[:100]}...")
+        return {**tool_call.input, "action": tool_call.name}
+
+    def parse_json_response(self, response_text: str) -> Dict:
+        """Modo legado: extrae el JSON del texto de Claude"""
+        logger.info(f"🤖 Claude respondió: {response_text[:100]}...")
+
+        # Intentar parsear como JSON
+        try:
+            if "{" in response_text and "}" in response_text:
+                start = response_text.find("{")
+                end = response_text.rfind("}") + 1
+                json_str = response_text[start:end]
+                parsed = json.loads(json_str)
+                claude_output.record_success()
+                return parsed
+            claude_output.record_failure("no_json")
+        except json.JSONDecodeError:
+            logger.warning(f"⚠️ Claude no devolvió JSON válido, usando como chat")
+            claude_output.record_failure("invalid_json")
+
+        # Si no es JSON, devolver como chat
+        return {
+            "action": "chat",
+            "message": response_text
+        }
+
+    async def process_audio(self, audio_data: Union[bytes, BinaryIO], mime_type: str = "audio/ogg") -> Optional[str]:
+        """Transcribe audio usando Claude (acepta bytes o el archivo temporal de download_media)"""
         # Codificar audio en base64
-        audio_base64 = base64.standard_b64encode(audio_data).decode("utf-8")
+        audio_base64 = encode_base64(audio_data)
 
         # Determinar el tipo de media
         media_type = "audio/webm"  # WhatsApp usa opus en webm/ogg
@@ -1004,8 +3378,9 @@ Empresa: BloomsPal"""
 
         try:
             # CORREGIDO: Ahora usa await correctamente con AsyncAnthropic
-            response = await self.client.messages.create(
-                model="claude-sonnet-4-20250514",
+            response = await self.create_message(
+                "transcription",
+                CLAUDE_MODEL_TRANSCRIPTION,
                 max_tokens=1024,
                 messages=[{
                     "role": "user",
@@ -1039,15 +3414,517 @@ Empresa: BloomsPal"""
             return None
 
 
+class ConversationSummarizer:
+    """Resumen acumulado por conversación de los mensajes que salen de la ventana reciente.
+
+    Se refresca en segundo plano después de cada turno (una tarea por conversación a la
+    vez) y se envía a Claude junto con los últimos CONVERSATION_WINDOW mensajes, de modo
+    que los datos de una cotización larga no se pierden y el contexto no crece.
+    """
+
+    PROMPT = """Actualiza el resumen de una conversación de WhatsApp entre un cliente y SonIA (asistente de envíos de BloomsPal).
+
+RESUMEN ACTUAL:
+{summary}
+
+MENSAJES NUEVOS A INCORPORAR:
+{messages}
+
+Escribe el resumen actualizado en español, en viñetas cortas (máximo 15):
+- Conserva TODOS los datos de cotización ya dados: origen y destino (país, ciudad, código postal), peso, pallet, número de cajas, dimensiones y peso de cada caja, valor declarado, fecha de salida
+- Conserva cotizaciones presentadas (precio y servicio), guías consultadas, tickets u órdenes creados y datos de contacto
+- Si un dato cambió, deja solo el valor más reciente
+- No incluyas saludos ni texto de relleno
+Responde SOLO con el resumen."""
+
+    def __init__(self):
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.dirty: set = set()
+        self.refreshes = 0
+        self.errors = 0
+        self.messages_summarized = 0
+        self.latency_total = 0.0
+
+    def get(self, conversation_id: int) -> Dict:
+        """Resumen vigente: {"summary": str, "last_message_id": int}"""
+        try:
+            conn = sqlite3.connect("sonia_conversations.db")
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT summary, last_message_id FROM conversation_summaries WHERE conversation_id = ?",
+                (conversation_id,)
+            )
+            row = cursor.fetchone()
+            conn.close()
+            if row:
+                return {"summary": row[0], "last_message_id": row[1]}
+        except Exception as e:
+            logger.warning(f"⚠️ Error leyendo resumen de conversación {conversation_id}: {e}")
+        return {"summary": "", "last_message_id": 0}
+
+    def schedule(self, conversation_id: int):
+        """Programa un refresco; si ya hay uno en curso, se repite al terminar"""
+        task = self.tasks.get(conversation_id)
+        if task and not task.done():
+            self.dirty.add(conversation_id)
+            return
+        self.tasks[conversation_id] = asyncio.create_task(self._run(conversation_id))
+
+    async def _run(self, conversation_id: int):
+        try:
+            while True:
+                self.dirty.discard(conversation_id)
+                await self.refresh(conversation_id)
+                if conversation_id not in self.dirty:
+                    break
+        finally:
+            self.tasks.pop(conversation_id, None)
+
+    def _pending_messages(self, conversation_id: int, after_id: int) -> List[Dict]:
+        """Mensajes posteriores al resumen que ya quedaron fuera de la ventana reciente"""
+        conn = sqlite3.connect("sonia_conversations.db")
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, role, content FROM messages
+            WHERE conversation_id = ? AND id > ?
+            ORDER BY id
+        """, (conversation_id, after_id))
+        rows = cursor.fetchall()
+        conn.close()
+        older = rows[:-CONVERSATION_WINDOW] if CONVERSATION_WINDOW > 0 else rows
+        return [{"id": row[0], "role": row[1], "content": row[2]} for row in older]
+
+    async def refresh(self, conversation_id: int) -> bool:
+        current = self.get(conversation_id)
+        try:
+            pending = self._pending_messages(conversation_id, current["last_message_id"])
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Error cargando mensajes para resumen de {conversation_id}: {e}")
+            return False
+        if len(pending) < SUMMARY_MIN_NEW_MESSAGES:
+            return False
+
+        transcript = "\n".join(
+            f"{'Cliente' if m['role'] == 'user' else 'SonIA'}: {m['content'][:1500]}" for m in pending
+        )
+        started = time.monotonic()
+        try:
+            response = await processor.create_message(
+                "summary",
+                CLAUDE_MODEL_SMALL if MODEL_ROUTING else CLAUDE_MODEL_LARGE,
+                max_tokens=600,
+                messages=[{"role": "user", "content": self.PROMPT.format(
+                    summary=current["summary"] or "(vacío)", messages=transcript
+                )}]
+            )
+            summary = "".join(block.text for block in response.content if block.type == "text").strip()
+            if not summary:
+                raise ValueError("resumen vacío")
+
+            conn = sqlite3.connect("sonia_conversations.db")
+            conn.execute("""
+                INSERT INTO conversation_summaries (conversation_id, summary, last_message_id, refreshes, updated_at)
+                VALUES (?, ?, ?, 1, ?)
+                ON CONFLICT(conversation_id) DO UPDATE SET
+                    summary = excluded.summary,
+                    last_message_id = excluded.last_message_id,
+                    refreshes = refreshes + 1,
+                    updated_at = excluded.updated_at
+            """, (conversation_id, summary, pending[-1]["id"], time.time()))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"⚠️ Error refrescando resumen de conversación {conversation_id}: {e}")
+            return False
+
+        self.refreshes += 1
+        self.messages_summarized += len(pending)
+        self.latency_total += time.monotonic() - started
+        logger.info(f"📝 Resumen de conversación {conversation_id} actualizado (+{len(pending)} mensajes)")
+        return True
+
+    async def stop(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {
+            "window": CONVERSATION_WINDOW,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+            "messages_summarized": self.messages_summarized,
+            "in_progress": len(self.tasks),
+            "avg_refresh_ms": round(self.latency_total / self.refreshes * 1000, 1) if self.refreshes else 0.0
+        }
+
+
+summarizer = ConversationSummarizer()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# TARIFARIOS LOCALES (RATE CARDS)
+# ══════════════════════════════════════════════════════════════════════════════
+
+RATE_CARD_MODES = ("box", "pallet", "any")
+RATE_CARD_SURCHARGE_UNITS = ("shipment", "address", "box", "kg")
+
+
+def builtin_rate_cards() -> Dict:
+    """Tarifario por defecto: cajas sueltas < 70kg de Colombia a USA"""
+    return {
+        "version": "builtin",
+        "currency": "USD",
+        "cards": [{
+            "id": "co-us-cajas",
+            "origin_country": "CO",
+            "destination_country": "US",
+            "mode": "box",
+            "weight_breaks": [{"min_kg": 0, "max_kg": 70, "per_kg": PRECIO_POR_KG_USA, "flat": 0}],
+            "surcharges": [{"name": "dirección", "amount": PRECIO_POR_DIRECCION, "per": "address"}]
+        }]
+    }
+
+
+def compile_rate_cards(document: Dict) -> Dict[tuple, List[Dict]]:
+    """Índice (origen, destino, modo) -> tarifas con sus rangos de peso listos para bisect.
+
+    Lanza ValueError si una tarifa está mal formada, así una edición rota no reemplaza
+    al tarifario vigente.
+    """
+    index: Dict[tuple, List[Dict]] = {}
+    for card in document.get("cards", []):
+        card_id = card.get("id") or "?"
+        origin = str(card.get("origin_country") or "").upper()
+        destination = str(card.get("destination_country") or "").upper()
+        mode = card.get("mode", "box")
+        if len(origin) != 2 or len(destination) != 2 or mode not in RATE_CARD_MODES:
+            raise ValueError(f"tarifa {card_id}: ruta o modo inválido ({origin}→{destination}, {mode})")
+
+        breaks = sorted(
+            ({"min_kg": float(b["min_kg"]), "max_kg": float(b["max_kg"]),
+              "per_kg": float(b.get("per_kg", 0)), "flat": float(b.get("flat", 0))}
+             for b in card.get("weight_breaks", [])),
+            key=lambda b: b["min_kg"]
+        )
+        if not breaks:
+            raise ValueError(f"tarifa {card_id}: sin rangos de peso")
+        for previous, current in zip(breaks, breaks[1:]):
+            if current["min_kg"] < previous["max_kg"]:
+                raise ValueError(f"tarifa {card_id}: rangos de peso superpuestos")
+
+        surcharges = []
+        for surcharge in card.get("surcharges", []):
+            if surcharge.get("per", "shipment") not in RATE_CARD_SURCHARGE_UNITS:
+                raise ValueError(f"tarifa {card_id}: recargo {surcharge.get('name')} con unidad inválida")
+            surcharges.append({
+                "name": surcharge.get("name", ""),
+                "amount": float(surcharge["amount"]),
+                "per": surcharge.get("per", "shipment")
+            })
+
+        index.setdefault((origin, destination, mode), []).append({
+            "id": card_id,
+            "valid_from": card.get("valid_from") or "",
+            "valid_to": card.get("valid_to") or "9999-12-31",
+            "break_mins": [b["min_kg"] for b in breaks],
+            "breaks": breaks,
+            "surcharges": surcharges
+        })
+
+    # Si dos tarifas se solapan en fechas, gana la de inicio más reciente
+    for cards in index.values():
+        cards.sort(key=lambda c: c["valid_from"], reverse=True)
+    return index
+
+
+class RateCardEngine:
+    """Precios fijos por ruta desde un tarifario versionado (RATE_CARDS_PATH).
+
+    El archivo se compila a un índice en memoria al arrancar y se recarga solo cuando
+    cambia (revisión cada RATE_CARDS_RELOAD_INTERVAL segundos); FedEx se consulta
+    únicamente para rutas sin tarifa.
+    """
+
+    def __init__(self, path: str = RATE_CARDS_PATH):
+        self.path = path
+        self.index: Dict[tuple, List[Dict]] = {}
+        self.version = ""
+        self.mtime: Optional[float] = None
+        self.loaded_at = 0.0
+        self.next_check = 0.0
+        self.reloads = 0
+        self.reload_errors = 0
+        self.last_error = ""
+        self.hits = 0
+        self.misses = 0
+        self.lookup_time_total = 0.0
+        self.reload(force=True)
+
+    def reload(self, force: bool = False) -> bool:
+        """Recompila el tarifario si el archivo cambió. Retorna True si se cargó una versión nueva."""
+        self.next_check = time.monotonic() + RATE_CARDS_RELOAD_INTERVAL
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if not force and mtime == self.mtime:
+            return False
+
+        try:
+            if mtime is None:
+                document = builtin_rate_cards()
+            else:
+                with open(self.path, encoding="utf-8") as f:
+                    document = json.load(f)
+            index = compile_rate_cards(document)
+        except Exception as e:
+            self.reload_errors += 1
+            self.last_error = str(e)
+            self.mtime = mtime  # No reintentar el mismo archivo roto en cada consulta
+            logger.error(f"❌ Tarifario {self.path} inválido, se mantiene la versión {self.version or 'builtin'}: {e}")
+            if not self.index:
+                self.index = compile_rate_cards(builtin_rate_cards())
+                self.version = "builtin"
+            return False
+
+        self.index = index
+        self.version = str(document.get("version", ""))
+        self.mtime = mtime
+        self.loaded_at = time.time()
+        self.reloads += 1
+        self.last_error = ""
+        logger.info(f"💲 Tarifario {self.version} cargado: {sum(len(c) for c in index.values())} tarifa(s), {len(index)} ruta(s)")
+        return True
+
+    def quote(self, origin_country: str, destination_country: str, is_pallet: bool,
+              weight_kg: float, num_boxes: int = 1, shipping_date: str = None) -> Optional[Dict]:
+        """Precio fijo para el envío, o None si la ruta no tiene tarifa vigente"""
+        started = time.perf_counter()
+        if time.monotonic() >= self.next_check:
+            self.reload()
+
+        day = shipping_date if shipping_date and re.fullmatch(r"\d{4}-\d{2}-\d{2}", shipping_date) else datetime.now().strftime("%Y-%m-%d")
+        mode = "pallet" if is_pallet else "box"
+        quote = None
+        for key in ((origin_country, destination_country, mode), (origin_country, destination_country, "any")):
+            for card in self.index.get(key, ()):
+                if not card["valid_from"] <= day <= card["valid_to"]:
+                    continue
+                position = bisect.bisect_right(card["break_mins"], weight_kg) - 1
+                if position < 0 or weight_kg >= card["breaks"][position]["max_kg"]:
+                    continue
+                quote = self._price(card, card["breaks"][position], weight_kg, num_boxes)
+                break
+            if quote:
+                break
+
+        self.lookup_time_total += time.perf_counter() - started
+        if quote:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return quote
+
+    def _price(self, card: Dict, weight_break: Dict, weight_kg: float, num_boxes: int) -> Dict:
+        total = weight_break["flat"] + weight_break["per_kg"] * weight_kg
+        parts = [f"${weight_break['per_kg']}/kg x {weight_kg}kg"] if weight_break["per_kg"] else []
+        if weight_break["flat"]:
+            parts.append(f"${weight_break['flat']} base")
+        for surcharge in card["surcharges"]:
+            units = {"shipment": 1, "address": 1, "box": max(num_boxes or 1, 1), "kg": weight_kg}[surcharge["per"]]
+            total += surcharge["amount"] * units
+            if surcharge["per"] == "box":
+                parts.append(f"${surcharge['amount']} x {units} caja(s) por {surcharge['name']}")
+            elif surcharge["per"] == "kg":
+                parts.append(f"${surcharge['amount']}/kg por {surcharge['name']}")
+            else:
+                parts.append(f"${surcharge['amount']} por {surcharge['name']}")
+        return {
+            "amount": round(total, 2),
+            "card_id": card["id"],
+            "version": self.version,
+            "details": "Precio fijo: " + " + ".join(parts)
+        }
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "version": self.version,
+            "path": self.path,
+            "lanes": len(self.index),
+            "cards": sum(len(cards) for cards in self.index.values()),
+            "loaded_at": datetime.fromtimestamp(self.loaded_at).isoformat() if self.loaded_at else None,
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+            "last_error": self.last_error,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "avg_lookup_us": round(self.lookup_time_total / lookups * 1e6, 1) if lookups else 0.0
+        }
+
+
+rate_cards = RateCardEngine()
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # CALCULADORA DE COTIZACIONES
 # ══════════════════════════════════════════════════════════════════════════════
 
+def apply_quote_scenario(quote_data: Dict, scenario: Dict) -> Dict:
+    """Datos de cotización de un escenario alternativo (otra fecha, pallet, cajas divididas o consolidadas)"""
+    data = dict(quote_data)
+    for key in ("shipping_date", "is_pallet", "packages"):
+        if scenario.get(key) not in (None, "", []):
+            data[key] = scenario[key]
+    packages = scenario.get("packages")
+    if packages:
+        data["num_boxes"] = len(packages)
+        weights = [pkg.get("weight_kg") for pkg in packages]
+        if all(isinstance(w, (int, float)) and w > 0 for w in weights):
+            data["weight_kg"] = round(sum(weights), 2)
+    return data
+
+
+def format_scenario_table(scenarios: List[Dict]) -> str:
+    """Tabla comparativa para WhatsApp; la opción más económica va marcada con ⭐"""
+    priced = [s for s in scenarios if s["result"]["success"]]
+    best = min(priced, key=lambda s: s["result"]["amount"]) if priced else None
+    lines = ["📊 *COMPARACIÓN DE ESCENARIOS*"]
+    for i, scenario in enumerate(scenarios, 1):
+        data, result = scenario["data"], scenario["result"]
+        packing = "pallet" if data.get("is_pallet") else f"{data.get('num_boxes') or len(data.get('packages') or []) or 1} caja(s)"
+        if result["success"]:
+            per_kg = result["amount"] / (data.get("weight_kg") or 1)
+            lines.append(
+                f"{i}. *{scenario['label']}*{' ⭐' if scenario is best else ''}: ${result['amount']:.2f} USD"
+                f" | {result.get('transit_days', 'N/A')} días | ${per_kg:.2f} USD/kg"
+            )
+        else:
+            lines.append(f"{i}. *{scenario['label']}*: sin tarifa disponible")
+        lines.append(f"   📆 {data.get('shipping_date', 'Por confirmar')} · {packing} · {data.get('weight_kg', 0)} kg")
+    return "\n".join(lines)
+
+
 class QuoteCalculator:
     """Calcula cotizaciones de envío"""
 
     def __init__(self):
         self.fedex = FedExClient()
+        self.scenario_turns = 0
+        self.scenarios_quoted = 0
+        self.account_wins: Dict[str, int] = {}
+        self.account_timeouts: Dict[str, int] = {}
+
+    async def calculate_scenarios(self, quote_data: Dict, scenarios: List[Dict]) -> List[Dict]:
+        """Cotiza la base y sus alternativas en paralelo (FedEx limitado por fedex_limiter).
+
+        Retorna [{"label", "data", "result"}], con la cotización base primero.
+        """
+        variants = [{"label": "Cotización base", "data": quote_data}]
+        for scenario in scenarios:
+            if len(variants) > QUOTE_MAX_SCENARIOS:
+                break
+            if not isinstance(scenario, dict):
+                continue
+            data = apply_quote_scenario(quote_data, scenario)
+            if any(data == variant["data"] for variant in variants):
+                continue
+            variants.append({"label": scenario.get("label") or f"Escenario {len(variants) + 1}", "data": data})
+
+        results = await asyncio.gather(*(self.calculate(variant["data"]) for variant in variants))
+        for variant, result in zip(variants, results):
+            variant["result"] = result
+        self.scenario_turns += 1
+        self.scenarios_quoted += len(variants) - 1
+        logger.info(f"📊 {len(variants)} escenarios cotizados en paralelo")
+        return variants
+
+    async def quote_accounts(self, **shipment) -> Dict[str, Dict]:
+        """Una consulta por cuenta en paralelo; la cuenta que no responde a tiempo se omite"""
+
+        async def quote(account: str) -> Dict:
+            try:
+                return await asyncio.wait_for(
+                    self.fedex.get_rate_quote(account_number=account, **shipment), FEDEX_ACCOUNT_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                self.account_timeouts[account] = self.account_timeouts.get(account, 0) + 1
+                logger.warning(f"⏱️ FedEx cuenta {account} sin respuesta en {FEDEX_ACCOUNT_TIMEOUT}s, se omite")
+                return {"error": f"Timeout cuenta {account}"}
+
+        responses = await asyncio.gather(*(quote(account) for account in FEDEX_ACCOUNTS))
+        return dict(zip(FEDEX_ACCOUNTS, responses))
+
+    def parse_services(self, fedex_response: Dict) -> List[Dict]:
+        """Servicios de una respuesta de Rate API, con precio en USD y días de tránsito"""
+        rate_details = fedex_response.get("output", {}).get("rateReplyDetails", []) if isinstance(fedex_response, dict) else []
+        # Log de la primera respuesta para verificar moneda
+        if rate_details:
+            first_rate = rate_details[0]
+            first_shipment = first_rate.get("ratedShipmentDetails", [{}])[0]
+            logger.info(f"\U0001f4b0 FedEx primer servicio: {first_rate.get('serviceType')} - charge={first_shipment.get('totalNetCharge')} currency={first_shipment.get('currency', 'NOT_SET')}")
+        all_services = []
+        for rate in rate_details:
+            rated_shipment = rate.get("ratedShipmentDetails", [{}])[0]
+            total_charge = rated_shipment.get("totalNetCharge", 0)
+            response_currency = rated_shipment.get("currency", "USD")
+            service_type = rate.get("serviceType", "")
+            service_name = rate.get("serviceName", service_type)
+            # Intentar múltiples paths para transit days según versión de FedEx API
+            commit_obj = rate.get("commit", {})
+            logger.info(f"🔍 FedEx commit object for {service_type}: {commit_obj}")
+            transit_days = "N/A"
+            if commit_obj:
+                # Path 1: commit.dateDetail.dayCount (FedEx Rate API v1)
+                date_detail = commit_obj.get("dateDetail", {})
+                if date_detail and date_detail.get("dayCount"):
+                    transit_days = str(date_detail.get("dayCount"))
+                # Path 2: commit.transitDays (string directo)
+                elif commit_obj.get("transitDays") and not isinstance(commit_obj.get("transitDays"), dict):
+                    transit_days = str(commit_obj.get("transitDays"))
+                # Path 3: operationalDetail.transitDays
+                elif rate.get("operationalDetail", {}).get("transitDays"):
+                    transit_days = str(rate["operationalDetail"]["transitDays"])
+
+            charge_float = round(float(total_charge), 2)
+
+            # Si FedEx devuelve en COP a pesar del preferredCurrency, convertir a USD
+            if response_currency == "COP":
+                cop_to_usd_rate = 4200  # 1 USD ~ 4200 COP
+                charge_usd = round(charge_float / cop_to_usd_rate, 2)
+                logger.info(f"\U0001f4b1 Moneda FedEx: COP - Convirtiendo ${charge_float:,.0f} COP -> ${charge_usd:.2f} USD (tasa {cop_to_usd_rate})")
+                charge_float = charge_usd
+            elif response_currency != "USD":
+                logger.warning(f"\u26a0\ufe0f Moneda inesperada de FedEx: {response_currency} (valor: {charge_float})")
+
+            all_services.append({
+                "service_type": service_type,
+                "service_name": service_name,
+                "total_charge": charge_float,
+                "transit_days": str(transit_days),
+                "original_currency": response_currency
+            })
+
+        return all_services
+
+    def stats(self) -> Dict:
+        return {
+            "scenario_turns": self.scenario_turns,
+            "scenarios_quoted": self.scenarios_quoted,
+            "fedex_max_in_flight": FEDEX_MAX_IN_FLIGHT,
+            "accounts": {
+                account: {
+                    "wins": self.account_wins.get(account, 0),
+                    "timeouts": self.account_timeouts.get(account, 0)
+                }
+                for account in FEDEX_ACCOUNTS
+            }
+        }
 
     async def calculate(self, quote_data: Dict) -> Dict:
         """Calcula la cotización según las reglas de negocio"""
@@ -1072,18 +3949,19 @@ class QuoteCalculator:
             "all_services": []
         }
 
-        # Regla 1: Cajas sueltas < 70kg desde Colombia a USA = precio fijo
-        if dest_country == "US" and origin_country == "CO" and not is_pallet and weight_kg < 70:
-            total = (weight_kg * PRECIO_POR_KG_USA) + PRECIO_POR_DIRECCION
+        # Regla 1: Rutas con tarifario publicado = precio fijo (ej. cajas < 70kg de Colombia a USA)
+        card_quote = rate_cards.quote(origin_country, dest_country, is_pallet, weight_kg, num_boxes, shipping_date)
+        if card_quote:
             result["quote_type"] = "fixed_rate"
-            result["amount"] = round(total, 2)
+            result["amount"] = card_quote["amount"]
             result["fedex_account_used"] = FEDEX_ACCOUNT_WORLD
-            result["details"] = f"Precio fijo: ${PRECIO_POR_KG_USA}/kg x {weight_kg}kg + ${PRECIO_POR_DIRECCION} por dirección"
+            result["details"] = card_quote["details"]
+            result["rate_card"] = f"{card_quote['card_id']}@{card_quote['version']}"
             return result
 
-        # Regla 2: Todo lo demás = cotizar con FedEx API
+        # Regla 2: Todo lo demás = cotizar con FedEx API en todas las cuentas configuradas
         try:
-            fedex_response = await self.fedex.get_rate_quote(
+            responses = await self.quote_accounts(
                 origin_postal=origin_postal,
                 origin_country=origin_country,
                 dest_postal=quote_data.get("destination_postal", ""),
@@ -1096,77 +3974,36 @@ class QuoteCalculator:
                 shipping_date=shipping_date
             )
 
-            # Extraer el precio de la respuesta de FedEx
-            logger.info(f"\U0001f4cb FedEx response keys: {list(fedex_response.keys()) if isinstance(fedex_response, dict) else 'not a dict'}")
-            if "output" in fedex_response:
-                rate_details = fedex_response["output"].get("rateReplyDetails", [])
-                # Log de la primera respuesta para verificar moneda
-                if rate_details:
-                    first_rate = rate_details[0]
-                    first_shipment = first_rate.get("ratedShipmentDetails", [{}])[0]
-                    logger.info(f"\U0001f4b0 FedEx primer servicio: {first_rate.get('serviceType')} - charge={first_shipment.get('totalNetCharge')} currency={first_shipment.get('currency', 'NOT_SET')}")
-                if rate_details:
-                    all_services = []
-                    for rate in rate_details:
-                        rated_shipment = rate.get("ratedShipmentDetails", [{}])[0]
-                        total_charge = rated_shipment.get("totalNetCharge", 0)
-                        response_currency = rated_shipment.get("currency", "USD")
-                        service_type = rate.get("serviceType", "")
-                        service_name = rate.get("serviceName", service_type)
-                        # Intentar múltiples paths para transit days según versión de FedEx API
-                        commit_obj = rate.get("commit", {})
-                        logger.info(f"🔍 FedEx commit object for {service_type}: {commit_obj}")
-                        transit_days = "N/A"
-                        if commit_obj:
-                            # Path 1: commit.dateDetail.dayCount (FedEx Rate API v1)
-                            date_detail = commit_obj.get("dateDetail", {})
-                            if date_detail and date_detail.get("dayCount"):
-                                transit_days = str(date_detail.get("dayCount"))
-                            # Path 2: commit.transitDays (string directo)
-                            elif commit_obj.get("transitDays") and not isinstance(commit_obj.get("transitDays"), dict):
-                                transit_days = str(commit_obj.get("transitDays"))
-                            # Path 3: operationalDetail.transitDays
-                            elif rate.get("operationalDetail", {}).get("transitDays"):
-                                transit_days = str(rate["operationalDetail"]["transitDays"])
-
-                        charge_float = round(float(total_charge), 2)
-
-                        # Si FedEx devuelve en COP a pesar del preferredCurrency, convertir a USD
-                        if response_currency == "COP":
-                            cop_to_usd_rate = 4200  # 1 USD ~ 4200 COP
-                            charge_usd = round(charge_float / cop_to_usd_rate, 2)
-                            logger.info(f"\U0001f4b1 Moneda FedEx: COP - Convirtiendo ${charge_float:,.0f} COP -> ${charge_usd:.2f} USD (tasa {cop_to_usd_rate})")
-                            charge_float = charge_usd
-                        elif response_currency != "USD":
-                            logger.warning(f"\u26a0\ufe0f Moneda inesperada de FedEx: {response_currency} (valor: {charge_float})")
-
-                        all_services.append({
-                            "service_type": service_type,
-                            "service_name": service_name,
-                            "total_charge": charge_float,
-                            "transit_days": str(transit_days),
-                            "original_currency": response_currency
-                        })
-
-                    all_services.sort(key=lambda x: x["total_charge"])
-                    result["all_services"] = all_services
-
-                    if all_services:
-                        cheapest = all_services[0]
-                        result["quote_type"] = "fedex_api"
-                        result["amount"] = cheapest["total_charge"]
-                        result["service_type"] = cheapest["service_type"]
-                        result["service_name"] = cheapest["service_name"]
-                        result["transit_days"] = cheapest["transit_days"]
-                        result["fedex_account_used"] = FEDEX_ACCOUNT_WORLD
-                        result["details"] = f"Opción más económica ({cheapest['transit_days']} días)"
-
-                        logger.info(f"📊 Servicios FedEx disponibles ({len(all_services)}):")
-                        for svc in all_services:
-                            logger.info(f"   - {svc['service_name']}: ${svc['total_charge']} ({svc['transit_days']} días)")
-
-                        return result
+            # Por servicio queda la cuenta más barata
+            best_by_service = {}
+            for account, fedex_response in responses.items():
+                for svc in self.parse_services(fedex_response):
+                    svc["account"] = account
+                    current = best_by_service.get(svc["service_type"])
+                    if current is None or svc["total_charge"] < current["total_charge"]:
+                        best_by_service[svc["service_type"]] = svc
+
+            all_services = sorted(best_by_service.values(), key=lambda x: x["total_charge"])
+            result["all_services"] = all_services
+
+            if all_services:
+                cheapest = all_services[0]
+                result["quote_type"] = "fedex_api"
+                result["amount"] = cheapest["total_charge"]
+                result["service_type"] = cheapest["service_type"]
+                result["service_name"] = cheapest["service_name"]
+                result["transit_days"] = cheapest["transit_days"]
+                result["fedex_account_used"] = cheapest["account"]
+                result["details"] = f"Opción más económica ({cheapest['transit_days']} días)"
+                self.account_wins[cheapest["account"]] = self.account_wins.get(cheapest["account"], 0) + 1
+
+                logger.info(f"📊 Servicios FedEx disponibles ({len(all_services)}, {len(responses)} cuenta(s)):")
+                for svc in all_services:
+                    logger.info(f"   - {svc['service_name']}: ${svc['total_charge']} ({svc['transit_days']} días, cuenta {svc['account']})")
+
+                return result
 
+            fedex_response = next(iter(responses.values()), {})
             error_msg = fedex_response.get("error", "")
             error_details = fedex_response.get("details", "")
             if error_msg:
@@ -1645,6 +4482,484 @@ def get_display_name(user_data: Dict) -> str:
         return nombre.split()[0]
     return "amigo/a"
 
+# ══════════════════════════════════════════════════════════════════════════════
+# PRE-ENRUTADOR DE INTENCIONES (SIN LLM)
+# ══════════════════════════════════════════════════════════════════════════════
+
+class IntentRouter:
+    """Reconoce mensajes triviales con patrones y estado de la conversación, antes de Claude.
+
+    Si la confianza alcanza FAST_PATH_MIN_CONFIDENCE, classify() retorna una respuesta con
+    la misma forma que process_text ({"action": ..., "message": ...}) y el turno va directo
+    al manejador de la acción; si no, retorna None y el turno sigue hacia Claude. La clave
+    de empleados ya se valida sin Claude en el flujo pending_key y aquí solo se contabiliza.
+    """
+
+    TRACKING_PATTERN = re.compile(
+        r"^\W*(?:(?:rastre\w*|tracking|track|gu[ií]a|seguimiento)\W*(?:de\W*)?(?:la\W*)?(?:gu[ií]a)?\W*)?"
+        r"(\d[\d\s-]*\d)\W*$",
+        re.IGNORECASE
+    )
+    FEDEX_TRACKING_LENGTHS = (12, 15, 20)
+    THANKS_PATTERN = re.compile(
+        r"^\W*(muchas |mil |muchísimas )?(gracias|thanks|thank you|te agradezco)( sonia)?\W*$", re.IGNORECASE
+    )
+    CONFIRMATION_PATTERN = re.compile(r"^\W*(ok|okay|vale|listo|perfecto|genial|excelente|entendido|de acuerdo|👍)\W*$", re.IGNORECASE)
+    GREETING_PATTERN = re.compile(r"^\W*(hola|buen[oa]s( d[ií]as| tardes| noches)?|hey|hi|hello)( sonia)?\W*$", re.IGNORECASE)
+
+    def __init__(self):
+        self.turns: Dict[str, int] = {}
+        self.low_confidence = 0
+
+    def classify(self, text: str, user_data: Optional[Dict], conversation_history: List[Dict] = None,
+                 quote_draft: Dict = None, quote_presented: bool = False) -> Optional[Dict]:
+        """Respuesta local para el mensaje, o None si debe decidir Claude"""
+        if not FAST_PATH_ENABLED or not user_data:
+            return None  # Los usuarios nuevos pasan siempre por el registro con Claude
+
+        candidate = self._match(text.strip(), user_data, conversation_history or [], quote_draft or {}, quote_presented)
+        if candidate is None:
+            return None
+        confidence, response = candidate
+        if confidence < FAST_PATH_MIN_CONFIDENCE:
+            self.low_confidence += 1
+            logger.info(f"⚡ Atajo {response['action']} descartado (confianza {confidence:.2f}) - se consulta a Claude")
+            return None
+        logger.info(f"⚡ Atajo sin LLM: {response['action']} (confianza {confidence:.2f})")
+        return {**response, "fast_path": True}
+
+    def _match(self, text: str, user_data: Dict, conversation_history: List[Dict], quote_draft: Dict,
+               quote_presented: bool) -> Optional[tuple]:
+        last_assistant = next(
+            (m.get("content", "") for m in reversed(conversation_history) if m.get("role") == "assistant"), ""
+        )
+        asked_question = last_assistant.rstrip().endswith("?")
+        after_quote = conversation_phase(conversation_history, quote_presented) == "post_quote"
+        dn = get_display_name(user_data)
+
+        tracking = self.TRACKING_PATTERN.match(text)
+        if tracking:
+            digits = re.sub(r"\D", "", tracking.group(1))
+            asked_tracking = re.search(r"gu[ií]a|rastreo|tracking", last_assistant, re.IGNORECASE) is not None
+            if len(digits) in self.FEDEX_TRACKING_LENGTHS:
+                confidence = 0.95
+            elif 9 <= len(digits) <= 30 and asked_tracking:
+                confidence = 0.85
+            else:
+                confidence = 0.5
+            if quote_draft and missing_quote_slots(quote_draft) and not asked_tracking:
+                confidence -= 0.3  # Podría ser un dato de la cotización en curso (código postal, valor...)
+            return confidence, {
+                "action": "track",
+                "tracking_number": digits,
+                "message": "Consultando el estado de tu envío..."
+            }
+
+        if self.THANKS_PATTERN.match(text):
+            return 0.9, {"action": "chat", "message": f"¡Con gusto, {dn}! 😊 ¿Hay algo más en lo que pueda ayudarte?"}
+
+        if self.CONFIRMATION_PATTERN.match(text):
+            # Tras una cotización un "ok" puede ser una orden; tras una pregunta, una respuesta: decide Claude
+            confidence = 0.4 if (after_quote or asked_question) else 0.85
+            return confidence, {"action": "chat", "message": f"👍 Perfecto, {dn}. ¿Hay algo más en lo que pueda ayudarte?"}
+
+        if self.GREETING_PATTERN.match(text):
+            confidence = 0.5 if (asked_question or quote_draft) else 0.85
+            return confidence, {
+                "action": "chat",
+                "message": f"¡Hola {dn}! 👋 Soy SonIA de BloomsPal. ¿Te ayudo con una cotización, el rastreo de una guía o algo más?"
+            }
+        return None
+
+    def record_turn(self, route: str):
+        """route: "llm" o cómo se resolvió el turno sin Claude (fast_track, fast_chat, key_entry, key_prompt)"""
+        self.turns[route] = self.turns.get(route, 0) + 1
+
+    def stats(self) -> Dict:
+        total = sum(self.turns.values())
+        without_llm = total - self.turns.get("llm", 0)
+        return {
+            "enabled": FAST_PATH_ENABLED,
+            "min_confidence": FAST_PATH_MIN_CONFIDENCE,
+            "turns": total,
+            "served_without_llm": without_llm,
+            "served_without_llm_rate": round(without_llm / total, 4) if total else 0.0,
+            "routes": self.turns,
+            "low_confidence_fallbacks": self.low_confidence
+        }
+
+
+intent_router = IntentRouter()
+
+
+class ResponseCache:
+    """Respuestas "chat" de Claude a preguntas frecuentes, por texto normalizado + estado del usuario.
+
+    Solo aplica a una lista cerrada de preguntas generales (servicios, cobertura, cómo cotizar,
+    horarios, pagos, contacto) y saludos, de clientes ya registrados, en turnos sin contexto:
+    sin borrador ni cotización, sin resumen, sin pregunta pendiente de SonIA y sin mensajes
+    previos que no sean saludos o preguntas frecuentes. Nunca guarda respuestas con datos del
+    usuario (nombre, empresa) ni con números (guías, montos, teléfonos). La clave incluye la
+    huella de la variante del prompt, así que un cambio de SYSTEM_PROMPT invalida las entradas.
+    """
+
+    MAX_TEXT_LENGTH = 120
+    CACHEABLE_STATES = ("client", "employee")
+
+    # Sobre texto normalizado (minúsculas, sin tildes ni signos)
+    FAQ_PATTERNS = [re.compile(pattern) for pattern in (
+        r"\b(que|cuales) (servicios|hacen|ofrecen)\b",
+        r"\b(que|quien|quienes) (es|son) bloomspal\b",
+        r"\b(a )?(que|cuales) paises\b",
+        r"\bcomo (cotizo|cotizar|funciona|hago un envio|se hace un envio)\b",
+        r"\bque (datos|informacion) (necesitas|necesitan|se necesita|piden)\b",
+        r"\bhorarios?\b",
+        r"\b(a que hora|cuando) (atienden|abren|cierran)\b",
+        r"\b(formas?|metodos?|medios?) de pago\b",
+        r"\bcomo (pago|se paga)\b",
+        r"\b(como|donde) (los|las|te) (contacto|encuentro)\b",
+        r"\b(correo|email|telefono) de (contacto|soporte|servicio)\b",
+        r"^(hola|buen[oa]s( dias| tardes| noches)?|hey|hi|hello)( sonia)?$",
+    )]
+    # Mensajes que continúan algo anterior ("y cuánto tarda?", "no", "lo mismo...")
+    CONTEXT_OPENER = re.compile(r"^(y|pero|entonces|tambien|ademas|o sea|osea|no|si|ese|esa|eso|esto|lo mismo)\b")
+    # Cierres genéricos de SonIA que no dejan una pregunta pendiente
+    OPEN_OFFER = re.compile(r"(algo mas|en que (te )?puedo ayudar|te ayudo con)")
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_size: int = RESPONSE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()  # clave -> (mensaje, tokens, guardado_en)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.ineligible = 0
+        self.skipped_personalized = 0
+        self.skipped_sensitive = 0
+        self.tokens_saved = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = unicodedata.normalize("NFKD", text.lower())
+        text = "".join(ch for ch in text if not unicodedata.combining(ch))
+        return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+    def is_faq(self, normalized: str) -> bool:
+        return (
+            bool(normalized) and len(normalized) <= self.MAX_TEXT_LENGTH
+            and not re.search(r"\d", normalized)
+            and not self.CONTEXT_OPENER.match(normalized)
+            and any(pattern.search(normalized) for pattern in self.FAQ_PATTERNS)
+        )
+
+    def context_free(self, conversation_history: List[Dict]) -> bool:
+        """La ventana reciente solo tiene saludos/preguntas frecuentes y SonIA no dejó una pregunta abierta"""
+        if conversation_phase(conversation_history) != "open":
+            return False
+        recent = conversation_history[-CONVERSATION_WINDOW:] if CONVERSATION_WINDOW > 0 else conversation_history
+        for message in recent:
+            if message.get("role") == "user" and not self.is_faq(self.normalize(message.get("content", ""))):
+                return False
+        last_assistant = next(
+            (m.get("content", "") for m in reversed(conversation_history) if m.get("role") == "assistant"), ""
+        )
+        if last_assistant.rstrip().endswith("?"):
+            closing = self.normalize(last_assistant.rstrip().rsplit("¿", 1)[-1])
+            return bool(self.OPEN_OFFER.search(closing))
+        return True
+
+    def key_for(self, text: str, user_state: str, conversation_history: List[Dict], stateful: bool) -> Optional[str]:
+        """Clave de caché, o None si el turno no es una pregunta frecuente sin contexto.
+
+        stateful: la conversación tiene borrador, última cotización o resumen de mensajes anteriores.
+        """
+        if RESPONSE_CACHE_SIZE <= 0:
+            return None
+        normalized = self.normalize(text)
+        if (stateful or user_state not in self.CACHEABLE_STATES or not self.is_faq(normalized)
+                or not self.context_free(conversation_history)):
+            self.ineligible += 1
+            return None
+        variant = processor.select_prompt(user_state, conversation_history)
+        return f"{user_state}|{processor.PROMPT_VARIANT_HASHES[variant]}|{normalized}"
+
+    def get(self, key: Optional[str]) -> Optional[Dict]:
+        if key is None:
+            return None
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[2] > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.tokens_saved += entry[1]
+        return {"action": "chat", "message": entry[0], "cached": True}
+
+    def put(self, key: Optional[str], response: Dict, user_data: Optional[Dict]):
+        # Sin "_tokens" la respuesta no vino de Claude (error de la API): no se guarda
+        if key is None or response.get("action") != "chat" or not response.get("message") or not response.get("_tokens"):
+            return
+        message = response["message"]
+        if re.search(r"\d", message):
+            self.skipped_sensitive += 1  # Guías, montos, fechas o teléfonos: nunca se reutilizan
+            return
+        normalized = self.normalize(message)
+        names = [user_data.get("nombre", ""), user_data.get("nickname", "")] if user_data else []
+        company = self.normalize(user_data.get("cliente", "")) if user_data else ""
+        if (any(part and len(part) > 2 and self.normalize(part) in normalized for name in names for part in name.split())
+                or (company and len(company) > 2 and f" {company} " in f" {normalized} ")):
+            self.skipped_personalized += 1
+            return
+        self.entries[key] = (message, response.get("_tokens", 0), time.time())
+        self.entries.move_to_end(key)
+        self.stores += 1
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "ineligible_turns": self.ineligible,
+            "skipped_personalized": self.skipped_personalized,
+            "skipped_sensitive": self.skipped_sensitive,
+            "tokens_saved": self.tokens_saved,
+            "ttl_seconds": self.ttl
+        }
+
+
+response_cache = ResponseCache()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# COLA DE PROCESAMIENTO DE MENSAJES (WORKERS)
+# ══════════════════════════════════════════════════════════════════════════════
+
+class TurnSuperseded(Exception):
+    """El turno fue reemplazado por un mensaje más nuevo del mismo usuario"""
+
+
+class TurnContext:
+    """Estado de un turno en curso, para descartarlo si el usuario envía un mensaje más nuevo"""
+
+    def __init__(self, phone: str):
+        self.phone = phone
+        self.superseded = False
+        self.committed = False
+        self.task: Optional[asyncio.Task] = None
+
+    def commit(self):
+        """Punto seguro antes del primer efecto externo (envío, Odoo, cotización guardada).
+
+        Si el turno ya fue reemplazado, lanza TurnSuperseded; si no, lo marca como
+        comprometido y los mensajes nuevos esperan al siguiente turno.
+        """
+        if self.superseded:
+            raise TurnSuperseded()
+        self.committed = True
+
+    def supersede(self) -> bool:
+        """Descarta el turno si aún no llegó al punto seguro. Retorna True si se descartó."""
+        if self.committed or self.superseded:
+            return False
+        self.superseded = True
+        if self.task and not self.task.done():
+            self.task.cancel()
+        return True
+
+
+class MessageWorkerPool:
+    """Pool de workers asyncio: procesa en orden por número y en paralelo entre usuarios.
+
+    Cada número tiene su propia fila de mensajes pendientes; la cola compartida solo
+    contiene números listos, y un número nunca está en manos de dos workers a la vez.
+    Los mensajes de un número se agrupan durante una ventana de silencio (con espera
+    máxima) y se entregan al handler como un solo turno. Si llega un mensaje nuevo
+    mientras el turno aún no llegó a su punto seguro, el turno se cancela y sus
+    mensajes se combinan con los nuevos.
+    """
+
+    def __init__(self, workers: int = WEBHOOK_WORKERS, max_pending: int = WEBHOOK_QUEUE_MAXSIZE,
+                 quiet_seconds: float = COALESCE_QUIET_SECONDS, max_wait_seconds: float = COALESCE_MAX_WAIT_SECONDS):
+        self.num_workers = max(1, workers)
+        self.max_pending = max_pending
+        self.quiet_seconds = max(0.0, quiet_seconds)
+        self.max_wait_seconds = max(self.quiet_seconds, max_wait_seconds)
+        self.handler: Optional[Callable[[List[Dict], TurnContext], Awaitable[Any]]] = None
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.pending: Dict[str, deque] = {}
+        self.timers: Dict[str, asyncio.TimerHandle] = {}
+        self.queued = set()      # Números en la cola de listos
+        self.processing = set()  # Números en manos de un worker
+        self.current_turns: Dict[str, TurnContext] = {}
+        self.tasks: List[asyncio.Task] = []
+        self.pending_count = 0
+        self.active = 0
+        self.turns = 0
+        self.messages_processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.superseded = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.last_lag = 0.0
+
+    def start(self, handler: Callable[[List[Dict], TurnContext], Awaitable[Any]]):
+        """Arranca los workers con el handler que procesa cada turno"""
+        self.handler = handler
+        for i in range(self.num_workers):
+            self.tasks.append(asyncio.create_task(self._worker(i)))
+        logger.info(
+            f"👷 Pool de mensajes iniciado: {self.num_workers} workers, cola máx {self.max_pending}, "
+            f"ventana {self.quiet_seconds}s (máx {self.max_wait_seconds}s)"
+        )
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Espera a que se vacíe la cola (hasta timeout) y detiene los workers"""
+        # Cerrar las ventanas abiertas para no esperar el silencio al apagar
+        for phone in list(self.timers):
+            self.timers.pop(phone).cancel()
+            self._make_ready(phone)
+
+        deadline = time.monotonic() + timeout
+        while (self.pending_count or self.active) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending_count:
+            logger.warning(f"⚠️ Deteniendo pool con {self.pending_count} mensajes pendientes")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def enqueue(self, phone: str, message: Dict) -> bool:
+        """Encola un mensaje. Retorna False si la cola está llena."""
+        if self.pending_count >= self.max_pending:
+            self.rejected += 1
+            return False
+        self.pending.setdefault(phone, deque()).append({
+            "message": message,
+            "enqueued_at": time.monotonic()
+        })
+        self.pending_count += 1
+
+        # Un mensaje nuevo reemplaza el turno en curso si aún no envió nada
+        turn = self.current_turns.get(phone)
+        if turn and turn.supersede():
+            self.superseded += 1
+            logger.info(f"✂️ Turno en curso de {phone} reemplazado por un mensaje más nuevo")
+
+        if phone not in self.processing and phone not in self.queued:
+            # (Re)iniciar la ventana de silencio; si el número ya está en proceso,
+            # el worker lo reprograma al terminar el turno actual
+            self._arm(phone)
+        return True
+
+    def _window_delay(self, phone: str) -> float:
+        """Segundos hasta cerrar la ventana: silencio tras el último mensaje, acotado por la espera máxima"""
+        jobs = self.pending.get(phone)
+        if not jobs or self.quiet_seconds <= 0:
+            return 0.0
+        closes_at = min(jobs[-1]["enqueued_at"] + self.quiet_seconds,
+                        jobs[0]["enqueued_at"] + self.max_wait_seconds)
+        return max(0.0, closes_at - time.monotonic())
+
+    def _arm(self, phone: str):
+        timer = self.timers.pop(phone, None)
+        if timer:
+            timer.cancel()
+        delay = self._window_delay(phone)
+        if delay <= 0:
+            self._make_ready(phone)
+        else:
+            self.timers[phone] = asyncio.get_running_loop().call_later(delay, self._make_ready, phone)
+
+    def _make_ready(self, phone: str):
+        self.timers.pop(phone, None)
+        if phone in self.queued or phone in self.processing or not self.pending.get(phone):
+            return
+        self.queued.add(phone)
+        self.ready.put_nowait(phone)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            phone = await self.ready.get()
+            self.queued.discard(phone)
+            self.processing.add(phone)
+            try:
+                jobs = self.pending.pop(phone, None)
+                if not jobs:
+                    continue
+                self.pending_count -= len(jobs)
+
+                lag = time.monotonic() - jobs[0]["enqueued_at"]
+                self.last_lag = lag
+                self.lag_total += lag
+                self.lag_max = max(self.lag_max, lag)
+
+                turn = TurnContext(phone)
+                turn.task = asyncio.create_task(self.handler([job["message"] for job in jobs], turn))
+                self.current_turns[phone] = turn
+                self.active += 1
+                try:
+                    await turn.task
+                    self.turns += 1
+                    self.messages_processed += len(jobs)
+                except (asyncio.CancelledError, TurnSuperseded):
+                    if not turn.superseded or asyncio.current_task().cancelling():
+                        raise  # Apagado del pool, no un reemplazo
+                    # Devolver los mensajes al frente para combinarlos con los nuevos
+                    self.pending.setdefault(phone, deque()).extendleft(reversed(jobs))
+                    self.pending_count += len(jobs)
+                except Exception as e:
+                    self.failed += 1
+                    self.turns += 1
+                    self.messages_processed += len(jobs)
+                    logger.error(f"❌ Worker {worker_id} falló procesando turno de {phone}: {e}")
+                finally:
+                    self.active -= 1
+            finally:
+                self.ready.task_done()
+                self.current_turns.pop(phone, None)
+                self.processing.discard(phone)
+                if self.pending.get(phone):
+                    # Llegaron mensajes durante el turno: nueva ventana desde su llegada
+                    self._arm(phone)
+
+    def stats(self) -> Dict:
+        """Profundidad de cola, lag y contadores para dimensionar el pool"""
+        now = time.monotonic()
+        heads = [jobs[0]["enqueued_at"] for jobs in self.pending.values() if jobs]
+        return {
+            "mode": "queue" if WEBHOOK_QUEUE_MODE else "inline",
+            "workers": self.num_workers,
+            "active_workers": self.active,
+            "depth": self.pending_count,
+            "max_depth": self.max_pending,
+            "phones_pending": len(heads),
+            "phones_in_window": len(self.timers),
+            "oldest_pending_seconds": round(now - min(heads), 3) if heads else 0.0,
+            "last_lag_seconds": round(self.last_lag, 3),
+            "avg_lag_seconds": round(self.lag_total / self.turns, 3) if self.turns else 0.0,
+            "max_lag_seconds": round(self.lag_max, 3),
+            "coalesce_quiet_seconds": self.quiet_seconds,
+            "coalesce_max_wait_seconds": self.max_wait_seconds,
+            "turns": self.turns,
+            "messages_processed": self.messages_processed,
+            "messages_coalesced": self.messages_processed - self.turns,
+            "turns_superseded": self.superseded,
+            "failed": self.failed,
+            "rejected": self.rejected
+        }
+
+
+message_pool = MessageWorkerPool()
+
 # ══════════════════════════════════════════════════════════════════════════════
 
 @asynccontextmanager
@@ -1669,10 +4984,25 @@ async def lifespan(app: FastAPI):
         pass  # La columna ya existe
 
     logger.info("✅ Base de datos inicializada")
+
+    deduplicator.purge_expired()
+    rate_cache.purge_expired()
+    http_clients.start()
+    outbound.start(whatsapp.post_message)
+
+    if WEBHOOK_QUEUE_MODE:
+        message_pool.start(process_incoming_messages)
+
     logger.info("✅ SonIA WhatsApp Agent LISTO y escuchando")
     logger.info("=" * 60)
     yield
     # Shutdown
+    if WEBHOOK_QUEUE_MODE:
+        await message_pool.stop()
+    await summarizer.stop()
+    await fedex_tokens.stop()
+    await outbound.stop()
+    await http_clients.close()
     logger.info("👋 SonIA WhatsApp Agent detenido")
 
 
@@ -1687,6 +5017,7 @@ app = FastAPI(
 whatsapp = WhatsAppClient()
 processor = SonIAProcessor()
 calculator = QuoteCalculator()
+tracker = TrackingProcessor()
 
 
 @app.get("/")
@@ -1716,106 +5047,208 @@ async def verify_webhook(
 
 @app.post("/webhook")
 async def handle_webhook(request: Request):
-    """Maneja los mensajes entrantes de WhatsApp"""
-    from_number = None  # Inicializar para evitar NameError en except
+    """Maneja los mensajes entrantes de WhatsApp: valida, encola y responde de inmediato.
+
+    Meta puede agrupar varios entries, changes y mensajes (de varios usuarios) en un
+    solo POST; cada mensaje se despacha como una unidad de trabajo independiente.
+    """
     try:
         body = await request.json()
-        logger.info(f"📩 Webhook recibido: {json.dumps(body)[:200]}...")
+    except Exception as e:
+        logger.error(f"❌ Webhook con cuerpo inválido: {e}")
+        return {"status": "invalid_json"}
+
+    logger.info(f"📩 Webhook recibido: {json.dumps(body)[:200]}...")
+
+    entries = body.get("entry") or []
+    if not entries:
+        return {"status": "no_entry"}
 
-        # Extraer información del mensaje
-        entry = body.get("entry", [])
-        if not entry:
-            return {"status": "no_entry"}
+    counts = {"messages": 0, "queued": 0, "duplicates": 0, "invalid": 0, "rejected": 0, "statuses": 0}
+    inline_by_phone: Dict[str, List[Dict]] = {}
 
-        changes = entry[0].get("changes", [])
-        if not changes:
-            return {"status": "no_changes"}
+    for entry in entries:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
 
-        value = changes[0].get("value", {})
-        messages = value.get("messages", [])
+            # Notificaciones de estado (delivered, read, etc.)
+            for status in value.get("statuses") or []:
+                counts["statuses"] += 1
+                logger.info(
+                    f"📊 Notificación de estado: {status.get('status', 'unknown')} "
+                    f"(destinatario {status.get('recipient_id', '?')}, id {status.get('id', '?')})"
+                )
+
+            for message in value.get("messages") or []:
+                counts["messages"] += 1
+                from_number = message.get("from")
+                message_id = message.get("id")
+                message_type = message.get("type")
+
+                # VALIDACIÓN: verificar que los campos críticos no sean None
+                if not from_number or not message_id or not message_type:
+                    logger.error(f"❌ Datos incompletos: from={from_number}, id={message_id}, type={message_type}")
+                    counts["invalid"] += 1
+                    continue
+
+                # Idempotencia: descartar reentregas antes de cualquier trabajo costoso
+                if not deduplicator.claim(message_id, from_number):
+                    logger.info(f"♻️ Mensaje duplicado ignorado: {message_id} de {from_number}")
+                    counts["duplicates"] += 1
+                    continue
+
+                if not WEBHOOK_QUEUE_MODE:
+                    inline_by_phone.setdefault(from_number, []).append(message)
+                    continue
+
+                # Modo cola: responder 200 a Meta de inmediato y procesar en background
+                if message_pool.enqueue(from_number, message):
+                    counts["queued"] += 1
+                else:
+                    logger.warning(f"🚧 Cola de webhook llena ({message_pool.pending_count}), rechazando mensaje de {from_number}")
+                    deduplicator.release(message_id)
+                    counts["rejected"] += 1
+
+    if counts["messages"] == 0:
+        return {"status": "no_messages", **counts}
+
+    if counts["rejected"]:
+        # Cola llena: 503 para que Meta reentregue; lo ya encolado se descarta por deduplicación
+        return JSONResponse(content={"status": "queue_full", **counts}, status_code=503)
+
+    if inline_by_phone:
+        # Modo inline: los mensajes de un mismo número en el lote forman un solo turno
+        await asyncio.gather(*(process_incoming_messages(msgs) for msgs in inline_by_phone.values()))
+        return {"status": "processed", **counts}
+
+    if counts["queued"]:
+        return {"status": "queued", **counts}
+    if counts["duplicates"]:
+        return {"status": "duplicate", **counts}
+    return {"status": "invalid_data", **counts}
+
+
+async def extract_message_text(message: Dict) -> Optional[str]:
+    """Obtiene el texto de un mensaje (cuerpo o transcripción). None si el tipo no es soportado."""
+    message_type = message.get("type")
+
+    if message_type == "text":
+        user_text = message.get("text", {}).get("body", "")
+        logger.info(f"💬 Texto recibido: {user_text[:100]}")
+        return user_text
+
+    if message_type == "audio":
+        # Descargar y transcribir audio
+        audio_info = message.get("audio", {})
+        media_id = audio_info.get("id")
+        mime_type = audio_info.get("mime_type", "audio/ogg")
+
+        if not media_id:
+            logger.error("❌ Audio sin media_id")
+            return ""
+
+        # Un turno reemplazado se reprocesa combinado: no volver a transcribir
+        if "_transcription" in message:
+            return message["_transcription"]
+
+        logger.info(f"🎵 Descargando audio {media_id}...")
+        audio_file = await whatsapp.download_media(media_id)
+        if audio_file is None:
+            logger.error("❌ No se pudo descargar el audio")
+            return ""
+
+        try:
+            user_text = await processor.process_audio(audio_file, mime_type)
+        finally:
+            audio_file.close()
+        if user_text:
+            logger.info(f"🎤 Transcripción: {user_text[:100]}")
+            message["_transcription"] = user_text
+        else:
+            logger.error("❌ Transcripción de audio falló")
+        return user_text or ""
+
+    logger.info(f"⚠️ Tipo de mensaje no soportado: {message_type}")
+    return None
 
-        if not messages:
-            # Puede ser una notificación de estado (delivered, read, etc.)
-            statuses = value.get("statuses", [])
-            if statuses:
-                logger.info(f"📊 Notificación de estado: {statuses[0].get('status', 'unknown')}")
-            return {"status": "no_messages"}
 
-        message = messages[0]
-        from_number = message.get("from")
-        message_id = message.get("id")
-        message_type = message.get("type")
+async def process_incoming_messages(messages: List[Dict], turn: "TurnContext" = None) -> Dict:
+    """Procesa un turno completo: Claude, FedEx, Odoo y respuesta por WhatsApp.
 
-        # VALIDACIÓN: verificar que los campos críticos no sean None
-        if not from_number or not message_id or not message_type:
-            logger.error(f"❌ Datos incompletos: from={from_number}, id={message_id}, type={message_type}")
-            return {"status": "invalid_data"}
+    Un turno son uno o varios mensajes seguidos del mismo número; se combinan en un solo
+    mensaje de usuario y se responden una sola vez. Hasta llamar a turn.commit() (justo
+    antes del primer envío o escritura en Odoo) el turno puede ser reemplazado por uno
+    más nuevo del mismo usuario.
+    """
+    from_number = messages[0].get("from")
+    turn = turn or TurnContext(from_number)
+    message_types = [m.get("type") for m in messages]
+    message_type = "audio" if "audio" in message_types else "text"
+    inbound = {}  # conversation_id / text del turno, para guardarlo una sola vez
 
-        logger.info(f"📨 Mensaje recibido de {from_number} - Tipo: {message_type}")
+    def save_inbound():
+        """Guarda el mensaje del usuario en el historial (una vez por turno)"""
+        if inbound.get("text") and not inbound.get("saved"):
+            save_message(inbound["conversation_id"], "user", inbound["text"], message_type)
+            inbound["saved"] = True
 
-        # Marcar como leído (no bloqueante, puede fallar sin afectar)
-        await whatsapp.mark_as_read(message_id)
+    try:
+        logger.info(f"📨 {len(messages)} mensaje(s) recibido(s) de {from_number} - Tipo: {', '.join(message_types)}")
+
+        # Marcar como leídos (no bloqueante, puede fallar sin afectar)
+        for message in messages:
+            await whatsapp.mark_as_read(message.get("id"))
 
         # Obtener o crear conversación
         conversation_id = get_or_create_conversation(from_number)
 
-        # Obtener historial
+        # Obtener historial (ventana reciente) y resumen de lo anterior
         history = get_conversation_history(conversation_id)
-
-        # Procesar según tipo de mensaje
-        user_text = ""
-
-        if message_type == "text":
-            user_text = message.get("text", {}).get("body", "")
-            logger.info(f"💬 Texto recibido: {user_text[:100]}")
-
-        elif message_type == "audio":
-            # Descargar y transcribir audio
-            audio_info = message.get("audio", {})
-            media_id = audio_info.get("id")
-            mime_type = audio_info.get("mime_type", "audio/ogg")
-
-            if media_id:
-                logger.info(f"🎵 Descargando audio {media_id}...")
-                audio_data = await whatsapp.download_media(media_id)
-                if audio_data:
-                    user_text = await processor.process_audio(audio_data, mime_type)
-                    if user_text:
-                        logger.info(f"🎤 Transcripción: {user_text[:100]}")
-                    else:
-                        logger.error("❌ Transcripción de audio falló")
-                else:
-                    logger.error("❌ No se pudo descargar el audio")
-            else:
-                logger.error("❌ Audio sin media_id")
-
-        else:
-            logger.info(f"⚠️ Tipo de mensaje no soportado: {message_type}")
+        conversation_summary = summarizer.get(conversation_id)["summary"]
+        quote_state = get_quote_state(conversation_id)
+        quote_draft, last_quote = quote_state["quote_draft"], quote_state["last_quote"]
+
+        # Extraer texto de cada mensaje (texto directo o transcripción de audio)
+        texts = []
+        unsupported = 0
+        for message in messages:
+            text = await extract_message_text(message)
+            if text is None:
+                unsupported += 1
+            elif text.strip():
+                texts.append(text.strip())
+
+        if not texts and unsupported == len(messages):
+            turn.commit()
             # Enviar mensaje al usuario informando
             try:
                 await whatsapp.send_message(
                     from_number,
-                    "Disculpa, por el momento solo puedo procesar mensajes de texto y audio. ¿Podrías escribirme tu consulta?"
+                    "Disculpa, por el momento solo puedo procesar mensajes de texto y audio. ¿Podrías escribirme tu consulta?",
+                    wait=False
                 )
             except Exception:
                 pass
             return {"status": "unsupported_type"}
 
-        if not user_text:
+        if not texts:
+            turn.commit()
             # Enviar feedback al usuario en vez de fallar silenciosamente
             try:
                 await whatsapp.send_message(
                     from_number,
-                    "No pude procesar tu mensaje. ¿Podrías intentar enviarlo de nuevo como texto?"
+                    "No pude procesar tu mensaje. ¿Podrías intentar enviarlo de nuevo como texto?",
+                    wait=False
                 )
             except Exception as send_err:
                 logger.error(f"❌ No se pudo enviar mensaje de error: {send_err}")
             return {"status": "no_text_content"}
 
-        # Guardar mensaje del usuario
-        save_message(conversation_id, "user", user_text, message_type)
+        user_text = "\n".join(texts)
+        inbound.update(conversation_id=conversation_id, text=user_text)
+        if len(texts) > 1:
+            logger.info(f"🧩 {len(texts)} mensajes de {from_number} combinados en un solo turno")
 
-        
         # ===== IDENTIFICACIÓN DE USUARIO =====
         user_data = user_cache.get(from_number)
 
@@ -1862,10 +5295,13 @@ async def handle_webhook(request: Request):
 # ===== BLOQUEO DE USUARIO =====
         if user_data and user_data.get('bloqueo', '').strip().upper() == 'SI':
             logger.info(f"⛔ Mensaje ignorado de usuario bloqueado: {from_number}")
+            turn.commit()
+            save_inbound()
             return JSONResponse(content={"status": "blocked"}, status_code=200)
 
         # Manejar estado pending_key (empleado debe dar clave)
         if user_cache.is_pending_key(from_number):
+            turn.commit()
             user_cache.clear_pending_key(from_number)
             if user_data:
                 try:
@@ -1885,9 +5321,10 @@ async def handle_webhook(request: Request):
                     response_message = "⏳ Tu clave aún no ha sido configurada por el administrador. Puedes seguir usando el servicio mientras tanto. ¿En qué puedo ayudarte?"
             else:
                 response_message = "No pude verificar tu información. ¿Podrías intentar de nuevo?"
-            save_message(conversation_id, "user", user_text, message_type)
+            save_inbound()
             save_message(conversation_id, "assistant", response_message)
-            await whatsapp.send_message(from_number, response_message)
+            await whatsapp.send_message(from_number, response_message, wait=False)
+            intent_router.record_turn("key_entry")
             return {"status": "key_validation"}
 
         # Verificación diaria de empleados
@@ -1899,32 +5336,62 @@ async def handle_webhook(request: Request):
                 except Exception:
                     fresh_clave = ""
                 if fresh_clave:
+                    turn.commit()
                     user_cache.set_pending_key(from_number)
                     dn = get_display_name(user_data)
-                    save_message(conversation_id, "user", user_text, message_type)
+                    save_inbound()
                     response_message = f"¡Hola {dn}! 👋 Para continuar hoy necesito verificar tu identidad. Por favor escribe tu clave de acceso:"
                     save_message(conversation_id, "assistant", response_message)
-                    await whatsapp.send_message(from_number, response_message)
+                    await whatsapp.send_message(from_number, response_message, wait=False)
+                    intent_router.record_turn("key_prompt")
                     return {"status": "key_required"}
 
         # Construir contexto de usuario para Claude
         user_context = ""
+        user_state = "new"
         if user_data:
             dn = get_display_name(user_data)
             rol = user_data.get('rol', 'cliente').lower()
+            user_state = "client"
             if rol == 'empleado':
                 if user_cache.is_employee_validated_today(from_number):
+                    user_state = "employee"
                     user_context = f"CONTEXTO USUARIO: Empleado VERIFICADO de BloomsPal. Nombre: {user_data['nombre']}. Llámalo '{dn}'. Empresa: BloomsPal. NOTA: Ya tienes sus datos, NO le pidas nombre ni empresa."
                 else:
+                    user_state = "pending_key"
                     user_context = f"CONTEXTO USUARIO: Empleado de BloomsPal (sin clave configurada aún). Nombre: {user_data['nombre']}. Llámalo '{dn}'. Empresa: BloomsPal. NOTA: Ya tienes sus datos, NO le pidas nombre ni empresa."
             else:
                 user_context = f"CONTEXTO USUARIO: Cliente registrado. Nombre: {user_data['nombre']}. Llámalo '{dn}'. Empresa: {user_data.get('cliente', 'No especificada')}. NOTA: Ya tienes nombre y empresa, NO los vuelvas a preguntar."
         else:
             user_context = f"CONTEXTO USUARIO: Usuario NUEVO, no registrado. Su número de WhatsApp es {from_number}. IMPORTANTE: NO proceses cotizaciones, tracking, tickets ni ninguna otra función hasta que el usuario se registre. Tu ÚNICA tarea ahora es recopilar su información (nombre completo, empresa, y opcionalmente un nickname/apodo). Cuando tengas los datos, DEBES responder con el JSON de action 'register_user' con los campos nombre, cliente y nickname. NUNCA confirmes el registro con un simple chat - SIEMPRE usa el action register_user."
 
-# Procesar con Claude
-        logger.info("🤖 Procesando con Claude AI...")
-        response = await processor.process_text(user_text, history, user_context)
+        # Atajo local: guías, agradecimientos y confirmaciones simples no necesitan a Claude
+        # Cotización vigente (persistida): habilita "order" aunque ya no esté en la ventana reciente
+        quote_presented = bool(last_quote)
+        response = intent_router.classify(user_text, user_data, history, quote_draft, quote_presented)
+        cache_key = None
+        if response:
+            intent_router.record_turn(f"fast_{response['action']}")
+        else:
+            # Preguntas frecuentes sin estado: respuesta ya generada por Claude
+            cache_key = response_cache.key_for(
+                user_text, user_state, history, bool(quote_draft or last_quote or conversation_summary)
+            )
+            response = response_cache.get(cache_key)
+            if response:
+                logger.info("💾 Respuesta servida desde caché de preguntas frecuentes")
+                intent_router.record_turn("response_cache")
+
+        if not response:
+            # Procesar con Claude
+            logger.info("🤖 Procesando con Claude AI...")
+            intent_router.record_turn("llm")
+            response = await processor.process_text(
+                user_text, history, user_context, user_state, conversation_summary,
+                (format_quote_draft(quote_draft) or format_last_quote(last_quote)) if user_data else "",
+                quote_presented
+            )
+            response_cache.put(cache_key, response, user_data)
 
         action = response.get("action", "chat")
         response_message = response.get("message", "")
@@ -1936,8 +5403,14 @@ async def handle_webhook(request: Request):
             response_message = "Antes de poder ayudarte con eso, necesito conocerte un poco. ¿Podrías decirme tu nombre completo y a qué empresa perteneces?"
             action = "chat"
 
-        # ===== FALLBACK: Extraer registro si Claude respondió chat pero hay datos =====
-        if not user_data and action == "chat" and len(history) >= 2:
+        # Punto seguro: las acciones que escriben en Odoo ya no se pueden descartar
+        if action in ("support", "order", "register_user", "update_nickname", "claim_employee"):
+            turn.commit()
+
+        # ===== FALLBACK (solo modo legado "json"): Extraer registro si Claude respondió chat pero hay datos =====
+        # Con tool use el registro llega validado en la misma llamada (herramienta register_user)
+        if CLAUDE_OUTPUT_MODE == "json" and not user_data and action == "chat" and len(history) >= 2:
+            claude_output.record_extra_call()
             try:
                 extraction_prompt = f"""Analiza esta conversación y extrae los datos del usuario SI los proporcionó.
 Conversación reciente:
@@ -1950,8 +5423,9 @@ Si el usuario YA proporcionó su nombre completo y empresa/compañía, responde
 
 Si NO hay suficiente información (falta nombre O empresa), responde SOLO: NO_DATA"""
                 
-                extraction_response = await processor.client.messages.create(
-                    model="claude-sonnet-4-20250514",
+                extraction_response = await processor.create_message(
+                    "registration_fallback",
+                    CLAUDE_MODEL_SMALL if MODEL_ROUTING else CLAUDE_MODEL_LARGE,
                     max_tokens=200,
                     messages=[{"role": "user", "content": extraction_prompt}]
                 )
@@ -1966,6 +5440,7 @@ Si NO hay suficiente información (falta nombre O empresa), responde SOLO: NO_DA
                         nombre = ext_data["nombre"]
                         cliente = ext_data["cliente"]
                         nickname = ext_data.get("nickname", "")
+                        turn.commit()
                         try:
                             odoo_reg = OdooClient()
                             ss_row = odoo_reg.add_user_to_spreadsheet(
@@ -1983,11 +5458,36 @@ Si NO hay suficiente información (falta nombre O empresa), responde SOLO: NO_DA
             except Exception as e:
                 logger.warning(f"⚠️ Error en fallback de extracción: {e}")
 
+        # ===== BORRADOR DE COTIZACIÓN: aplicar solo los campos nuevos o modificados =====
+        if action in ("ask", "quote"):
+            update = response.get("data" if action == "quote" else "draft")
+            if response.get("new_quote"):
+                base_draft = {}
+            elif response.get("from_last_quote") and last_quote and not quote_draft:
+                base_draft = seed_from_last_quote(last_quote, update)
+            else:
+                base_draft = quote_draft
+            quote_draft = merge_quote_draft(base_draft, update)
+            save_quote_draft(conversation_id, quote_draft)
+            logger.info(f"🧾 Borrador de cotización: {len(QUOTE_SLOTS) - len(missing_quote_slots(quote_draft))}/{len(QUOTE_SLOTS)} campos")
+
         # Si es una solicitud de cotización
-        if action == "quote":
-            quote_data = response.get("data", {})
+        if action == "quote" and missing_quote_slots(quote_draft):
+            missing_labels = [QUOTE_SLOTS[key] for key in missing_quote_slots(quote_draft)]
+            logger.info(f"🧾 Cotización incompleta, faltan: {missing_labels}")
+            response_message = "Para cotizar me falta:\n" + "\n".join(f"• {label}" for label in missing_labels)
+
+        elif action == "quote":
+            quote_data = dict(quote_draft)
+            quote_data.setdefault("num_boxes", len(quote_data.get("packages") or []) or 1)
             logger.info(f"📊 Calculando cotización: {quote_data}")
-            quote_result = await calculator.calculate(quote_data)
+            scenarios = response.get("scenarios") if isinstance(response.get("scenarios"), list) else []
+            if scenarios:
+                scenario_results = await calculator.calculate_scenarios(quote_data, scenarios)
+                quote_result = scenario_results[0]["result"]
+            else:
+                scenario_results = []
+                quote_result = await calculator.calculate(quote_data)
 
             if quote_result["success"]:
                 # Formatear mensaje de cotización
@@ -2021,21 +5521,28 @@ Si NO hay suficiente información (falta nombre O empresa), responde SOLO: NO_DA
                         svc_cost_per_kg = svc['total_charge'] / (quote_data.get('weight_kg', 1) or 1)
                         response_message += f"\n  • Opción {i}: ${svc['total_charge']:.2f} USD | {svc['transit_days']} días | ${svc_cost_per_kg:.2f} USD/kg"
 
+                if len(scenario_results) > 1:
+                    response_message += "\n\n" + format_scenario_table(scenario_results)
+
                 response_message += "\n\n¿Deseas proceder con este envío? Responde *SÍ* para confirmar o escríbeme si necesitas otra cotización."
 
                 # Guardar cotización
+                turn.commit()
                 quote_data["quote_amount"] = quote_result["amount"]
                 quote_data["fedex_account_used"] = quote_result["fedex_account_used"]
                 save_quotation(conversation_id, from_number, quote_data)
+                # El borrador se cierra: la próxima cotización empieza limpia o desde esta ("lo mismo pero...")
+                archive_quote_draft(conversation_id, quote_draft)
             else:
                 response_message = f"❌ {quote_result['details']}\n\nPor favor verifica la información e intenta de nuevo."
+                if any(s["result"]["success"] for s in scenario_results[1:]):
+                    response_message += "\n\n" + format_scenario_table(scenario_results)
 
         # Si es una solicitud de rastreo
         elif action == "track":
             tracking_number = response.get("tracking_number", "")
             logger.info(f"📦 Procesando rastreo para: {tracking_number}")
 
-            tracker = TrackingProcessor()
             track_result = await tracker.track(tracking_number)
 
             if track_result["success"]:
@@ -2127,6 +5634,7 @@ Nuestro equipo de atención al cliente revisará tu caso y te contactará pronto
 
             if ticket_result["success"]:
                 ticket_id = ticket_result["ticket_id"]
+                archive_quote_draft(conversation_id, None)
                 response_message = f"""📋 *ORDEN DE ENVÍO REGISTRADA*
 
 ✅ *Ticket #:* {ticket_id}
@@ -2254,27 +5762,40 @@ Nuestro equipo de ventas revisará los detalles y te contactará para confirmar
         if not response_message:
             response_message = "Disculpa, no pude generar una respuesta. ¿Podrías repetir tu consulta?"
 
-        # Guardar respuesta
+        # Punto seguro: a partir de aquí el turno ya no se puede descartar
+        turn.commit()
+
+        # Guardar mensaje del usuario y respuesta
+        save_inbound()
         save_message(conversation_id, "assistant", response_message)
+        summarizer.schedule(conversation_id)
 
-        # Enviar respuesta por WhatsApp
-        logger.info(f"📤 Enviando respuesta a {from_number}...")
-        send_result = await whatsapp.send_message(from_number, response_message)
-        logger.info(f"✅ Respuesta enviada exitosamente a {from_number}")
+        # Enviar respuesta por WhatsApp (cola de salida: el worker no espera reintentos)
+        send_result = await whatsapp.send_message(from_number, response_message, wait=False)
+        logger.info(f"📤 Respuesta a {from_number} encolada (envío #{send_result.get('outbound_id')})")
 
         return {"status": "processed"}
 
+    except TurnSuperseded:
+        raise
     except Exception as e:
-        logger.error(f"❌ Error procesando webhook: {str(e)}")
+        logger.error(f"❌ Error procesando mensaje de {from_number}: {str(e)}")
         import traceback
         traceback.print_exc()
 
+        # El mensaje del usuario queda en el historial aunque el turno falle
+        try:
+            save_inbound()
+        except Exception:
+            logger.error("❌ No se pudo guardar el mensaje del usuario")
+
         # Intentar enviar mensaje de error al usuario
         try:
             if from_number:
                 await whatsapp.send_message(
                     from_number,
-                    "Disculpa, tuve un problema procesando tu mensaje. Por favor intenta de nuevo en unos momentos."
+                    "Disculpa, tuve un problema procesando tu mensaje. Por favor intenta de nuevo en unos momentos.",
+                    wait=False
                 )
         except Exception:
             logger.error("❌ No se pudo enviar mensaje de error al usuario")
@@ -2317,6 +5838,36 @@ async def get_stats():
     }
 
 
+@app.get("/metrics/prompts")
+async def get_prompt_metrics():
+    """Tamaño en tokens de cada variante del system prompt (estado/fase)"""
+    return await processor.prompt_report()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Métricas operativas de los componentes internos (colas, cachés, clientes)"""
+    return {
+        "webhook_queue": message_pool.stats(),
+        "deduplication": deduplicator.stats(),
+        "http_clients": http_clients.stats(),
+        "outbound": outbound.stats(),
+        "media_transfers": media_transfers.stats(),
+        "media_cache": media_cache.stats(),
+        "claude": claude_usage.stats(),
+        "claude_output": claude_output.stats(),
+        "models": model_router.stats(),
+        "anthropic_gateway": processor.gateway.stats(),
+        "summaries": summarizer.stats(),
+        "fast_path": intent_router.stats(),
+        "response_cache": response_cache.stats(),
+        "fedex_tokens": fedex_tokens.stats(),
+        "fedex_rate_cache": rate_cache.stats(),
+        "quotes": calculator.stats(),
+        "rate_cards": rate_cards.stats()
+    }
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # PUNTO DE ENTRADA
 
@@ -2326,15 +5877,123 @@ async def get_stats():
 # ══════════════════════════════════════════════════════════════════════════════
 
 SONIA_CORE_API_KEY = os.getenv("SONIA_CORE_API_KEY", "sonia-core-2026")
+BULK_MAX_RECIPIENTS = int(os.getenv("BULK_MAX_RECIPIENTS", "1000"))
+BULK_SEND_CONCURRENCY = int(os.getenv("BULK_SEND_CONCURRENCY", "20"))
+BULK_JOBS_RETAINED = int(os.getenv("BULK_JOBS_RETAINED", "50"))
 
 class SendMessageRequest(BaseModel):
     phone_number: str
     message: str
+    wait: bool = True  # False: solo encolar y responder 202 sin esperar a Meta
 
 class SendReportRequest(BaseModel):
     phone_number: str
     report: str
     client_name: str = ""
+    wait: bool = True
+
+class BulkRecipient(BaseModel):
+    phone_number: str
+    message: str = ""
+    report: str = ""
+    client_name: str = ""
+
+class SendBulkRequest(BaseModel):
+    recipients: List[BulkRecipient]
+    concurrency: int = BULK_SEND_CONCURRENCY
+    stream: bool = True  # False: responder 202 con el job_id y consultar el progreso después
+
+
+def format_tracking_report(report: str, client_name: str = "") -> str:
+    """Agrega el encabezado del reporte de tracking si hay nombre de cliente"""
+    if client_name:
+        return f"📦 *Reporte de Tracking - {client_name}*\n\n{report}"
+    return report
+
+
+class BulkSendJobs:
+    """Trabajos de envío masivo: fan-out concurrente por la cola de salida, con progreso consultable"""
+
+    def __init__(self):
+        self.jobs: "OrderedDict[str, Dict]" = OrderedDict()
+        self.listeners: Dict[str, List[asyncio.Queue]] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def create(self, recipients: List[BulkRecipient], concurrency: int) -> Dict:
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "status": "running",
+            "total": len(recipients),
+            "completed": 0,
+            "sent": 0,
+            "failed": 0,
+            "created_at": datetime.now().isoformat(),
+            "finished_at": None,
+            "results": []
+        }
+        self.jobs[job_id] = job
+        while len(self.jobs) > BULK_JOBS_RETAINED:
+            old_id, old_job = next(iter(self.jobs.items()))
+            if old_job["status"] == "running":
+                break
+            self.jobs.pop(old_id)
+        self.listeners[job_id] = []
+        self.tasks[job_id] = asyncio.create_task(self._run(job, recipients, concurrency))
+        return job
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self.listeners.setdefault(job_id, []).append(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        listeners = self.listeners.get(job_id, [])
+        if queue in listeners:
+            listeners.remove(queue)
+
+    def _publish(self, job_id: str, event: Optional[Dict]):
+        for queue in self.listeners.get(job_id, []):
+            queue.put_nowait(event)
+
+    async def _run(self, job: Dict, recipients: List[BulkRecipient], concurrency: int):
+        semaphore = asyncio.Semaphore(max(1, min(concurrency, 100)))
+
+        async def deliver(index: int, recipient: BulkRecipient):
+            text = recipient.message or format_tracking_report(recipient.report, recipient.client_name)
+            result = {"index": index, "phone_number": recipient.phone_number}
+            if not text.strip():
+                result.update(status="failed", error="Sin message ni report")
+            else:
+                async with semaphore:
+                    try:
+                        sent = await whatsapp.send_message(recipient.phone_number, text)
+                        result.update(status="sent", message_ids=[m.get("id") for m in sent.get("messages", [])])
+                    except Exception as e:
+                        result.update(status="failed", error=str(e))
+            job["completed"] += 1
+            job["sent" if result["status"] == "sent" else "failed"] += 1
+            job["results"].append(result)
+            self._publish(job["job_id"], result)
+
+        try:
+            await asyncio.gather(*(deliver(i, r) for i, r in enumerate(recipients)))
+            job["status"] = "completed"
+        except Exception as e:
+            job["status"] = "error"
+            logger.error(f"❌ Error en envío masivo {job['job_id']}: {e}")
+        finally:
+            job["finished_at"] = datetime.now().isoformat()
+            self._publish(job["job_id"], None)
+            self.listeners.pop(job["job_id"], None)
+            self.tasks.pop(job["job_id"], None)
+            logger.info(f"📣 Envío masivo {job['job_id']}: {job['sent']} enviados, {job['failed']} fallidos de {job['total']}")
+
+    def summary(self, job: Dict) -> Dict:
+        return {k: v for k, v in job.items() if k != "results"}
+
+
+bulk_jobs = BulkSendJobs()
 
 
 @app.post("/api/send-message")
@@ -2346,11 +6005,19 @@ async def api_send_message(req: SendMessageRequest, request: Request):
         raise HTTPException(status_code=401, detail="Invalid API key")
     
     try:
-        result = await whatsapp.send_message(req.phone_number, req.message)
+        result = await whatsapp.send_message(req.phone_number, req.message, wait=req.wait)
+        if not req.wait:
+            return JSONResponse(status_code=202, content={
+                "status": "queued",
+                "phone_number": req.phone_number,
+                "outbound_id": result["outbound_id"],
+                "outbound_ids": result["outbound_ids"]
+            })
         return {
             "status": "sent",
             "phone_number": req.phone_number,
-            "message_id": result.get("messages", [{}])[0].get("id", "unknown") if isinstance(result, dict) else "sent"
+            "message_id": result.get("messages", [{}])[0].get("id", "unknown") if isinstance(result, dict) else "sent",
+            "message_ids": [m.get("id") for m in result.get("messages", [])] if isinstance(result, dict) else []
         }
     except Exception as e:
         logger.error(f"Error sending message to {req.phone_number}: {e}")
@@ -2367,22 +6034,84 @@ async def api_send_report(req: SendReportRequest, request: Request):
     
     try:
         # Agregar encabezado si hay nombre de cliente
-        report_text = req.report
-        if req.client_name:
-            report_text = f"📦 *Reporte de Tracking - {req.client_name}*\n\n{req.report}"
-        
-        result = await whatsapp.send_message(req.phone_number, report_text)
+        report_text = format_tracking_report(req.report, req.client_name)
+
+        result = await whatsapp.send_message(req.phone_number, report_text, wait=req.wait)
+        if not req.wait:
+            return JSONResponse(status_code=202, content={
+                "status": "queued",
+                "phone_number": req.phone_number,
+                "client_name": req.client_name,
+                "outbound_id": result["outbound_id"],
+                "outbound_ids": result["outbound_ids"]
+            })
         return {
             "status": "sent",
             "phone_number": req.phone_number,
             "client_name": req.client_name,
-            "message_id": result.get("messages", [{}])[0].get("id", "unknown") if isinstance(result, dict) else "sent"
+            "message_id": result.get("messages", [{}])[0].get("id", "unknown") if isinstance(result, dict) else "sent",
+            "message_ids": [m.get("id") for m in result.get("messages", [])] if isinstance(result, dict) else []
         }
     except Exception as e:
         logger.error(f"Error sending report to {req.phone_number}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/send-bulk")
+async def api_send_bulk(req: SendBulkRequest, request: Request):
+    """Envío masivo para SonIA Core: fan-out concurrente y resultados por destinatario en NDJSON.
+
+    La primera línea trae el job_id, luego una línea por destinatario a medida que se
+    envían y al final el resumen. El trabajo sigue aunque el cliente se desconecte y
+    puede consultarse en GET /api/send-bulk/{job_id}.
+    """
+    api_key = request.headers.get("X-API-Key", "")
+    if api_key != SONIA_CORE_API_KEY:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    if not req.recipients:
+        raise HTTPException(status_code=400, detail="Sin destinatarios")
+    if len(req.recipients) > BULK_MAX_RECIPIENTS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BULK_MAX_RECIPIENTS} destinatarios por envío")
+
+    job = bulk_jobs.create(req.recipients, req.concurrency)
+    logger.info(f"📣 Envío masivo {job['job_id']} iniciado: {job['total']} destinatarios")
+
+    if not req.stream:
+        return JSONResponse(status_code=202, content=bulk_jobs.summary(job))
+
+    events = bulk_jobs.subscribe(job["job_id"])
+
+    async def stream_results():
+        try:
+            yield json.dumps({"job_id": job["job_id"], "total": job["total"]}) + "\n"
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+            yield json.dumps(bulk_jobs.summary(job)) + "\n"
+        finally:
+            bulk_jobs.unsubscribe(job["job_id"], events)
+
+    return StreamingResponse(
+        stream_results(),
+        media_type="application/x-ndjson",
+        headers={"X-Job-Id": job["job_id"]}
+    )
+
+
+@app.get("/api/send-bulk/{job_id}")
+async def api_send_bulk_status(job_id: str, request: Request):
+    """Consulta el progreso y los resultados de un envío masivo"""
+    api_key = request.headers.get("X-API-Key", "")
+    if api_key != SONIA_CORE_API_KEY:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    job = bulk_jobs.jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+    return job
+
+
 @app.post("/api/send-file")
 async def api_send_file(
     request: Request,
@@ -2396,13 +6125,13 @@ async def api_send_file(
         raise HTTPException(status_code=401, detail="Invalid API key")
 
     try:
-        file_data = await file.read()
+        # UploadFile ya está en un archivo temporal: se sube por bloques sin file.read()
         filename = file.filename or "document"
         mime_type = file.content_type or "application/octet-stream"
 
         result = await whatsapp.send_document(
             to=phone_number,
-            file_data=file_data,
+            file_data=file.file,
             filename=filename,
             caption=caption,
             mime_type=mime_type
@@ -2415,7 +6144,8 @@ async def api_send_file(
             "status": "sent",
             "phone_number": phone_number,
             "filename": filename,
-            "message_id": result.get("messages", [{}])[0].get("id", "unknown") if isinstance(result, dict) else "sent"
+            "message_id": result.get("messages", [{}])[0].get("id", "unknown") if isinstance(result, dict) else "sent",
+            "message_ids": [m.get("id") for m in result.get("messages", [])] if isinstance(result, dict) else []
         }
     except HTTPException:
         raise
@@ -2424,6 +6154,19 @@ async def api_send_file(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/rate-cards/reload")
+async def api_reload_rate_cards(request: Request):
+    """Recarga el tarifario sin esperar la próxima revisión automática."""
+    api_key = request.headers.get("X-API-Key", "")
+    if api_key != SONIA_CORE_API_KEY:
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+    reloaded = rate_cards.reload(force=True)
+    if not reloaded and rate_cards.last_error:
+        raise HTTPException(status_code=422, detail=rate_cards.last_error)
+    return {"status": "reloaded", **rate_cards.stats()}
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 
 if __name__ == "__main__":